@@ -3,11 +3,17 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import BaseHTTPServer
+import SocketServer
 import argparse
+import gzip
+import hashlib
 import sys
 import re
+import threading
 import urlparse
+from cStringIO import StringIO
 from telemetry.revision_cache import RevisionCache
+from telemetry.util.lru import LRUCache
 import telemetry.histogram_tools as histogram_tools
 import simplejson as json
 # For compatibility with python 2.6
@@ -27,13 +33,123 @@ REVISION_FIELD = "revision"
 HIST_VALID_PREFIX = HIST_PATH + "?" + REVISION_FIELD + "="
 HIST_BUCKET_VALID_PREFIX = HIST_BUCKET_PATH + "?" + REVISION_FIELD + "="
 MINIMAL_JSON = True
+# Name of the bucket ranges format when saved in the revision cache.
+BUCKETS_FORMAT = "buckets1"
+# Revisions never change, so clients may cache responses for this long.
+MAX_AGE = 86400
+# Fields of a batch request, POSTed to HIST_BUCKET_PATH as a JSON object.
+BATCH_REVISIONS_FIELD = "revisions"
+BATCH_HISTOGRAMS_FIELD = "histograms"
+MAX_BATCH_BYTES = 10 * 1024 * 1024
 
 # + 1 to skip the "?"
 HIST_QUERY_OFFSET = len(HIST_PATH) + 1
 HIST_BUCKET_QUERY_OFFSET = len(HIST_BUCKET_PATH) + 1
 
 
+def ranges_from_definitions(parsed, names=None):
+    """Return the bucket ranges JSON for parsed histogram definitions.
+
+    If `names` (a set) is given, only those histograms are included.
+    """
+    def wanted(name):
+        return names is None or name in names
+
+    all_histograms = OrderedDict()
+    for (name, definition) in parsed.iteritems():
+        startup_name = None
+        if startup_histogram_re.search(name) is not None:
+            startup_name = "STARTUP_" + name
+        if not wanted(name) and not (startup_name and wanted(startup_name)):
+            continue
+        histogram = histogram_tools.Histogram(name, definition)
+        parameters = OrderedDict()
+        table = {
+            'boolean': '2',
+            'flag': '3',
+            'enumerated': '1',
+            'linear': '1',
+            'exponential': '0'
+            }
+        # Use __setitem__ because Python lambdas are so limited.
+        histogram_tools.table_dispatch(histogram.kind(), table,
+                                       lambda k: parameters.__setitem__('kind', k))
+        if histogram.low() == 0:
+            parameters['min'] = 1
+        else:
+            parameters['min'] = histogram.low()
+
+        try:
+            buckets = histogram.ranges()
+            parameters['buckets'] = buckets
+            parameters['max'] = buckets[-1]
+            parameters['bucket_count'] = len(buckets)
+        except histogram_tools.DefinitionException:
+            continue
+
+        if wanted(name):
+            all_histograms.update({ name: parameters });
+
+        if startup_name is not None and wanted(startup_name):
+            all_histograms.update({ startup_name: parameters })
+    if MINIMAL_JSON:
+        result = json.dumps({'histograms': all_histograms}, separators=(',', ':'))
+    else:
+        result = json.dumps({'histograms': all_histograms})
+    return result
+
+
+def accepts_gzip(accept_encoding):
+    """Whether an Accept-Encoding header allows a gzipped response.
+
+    Codings with a q-value of 0 are refused, and an explicit gzip entry
+    overrides "*".
+    """
+    qvalues = {}
+    for coding in accept_encoding.split(","):
+        params = coding.split(";")
+        name = params[0].strip().lower()
+        if name == "x-gzip":
+            name = "gzip"
+        qvalue = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name] = qvalue
+    return qvalues.get("gzip", qvalues.get("*", 0.0)) > 0
+
+
+class CachedResponse:
+    """A response body, with its ETag and gzipped version."""
+    def __init__(self, body):
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        out = StringIO()
+        gz = gzip.GzipFile(fileobj=out, mode="wb")
+        gz.write(body)
+        gz.close()
+        self.gzipped = out.getvalue()
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
 class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Set up in main(). Shared by the request threads: it only locks its
+    # in-memory caches, so slow fetches from hg don't hold up other requests.
+    revision_cache = None
+    # (revision, buckets?) -> CachedResponse
+    responses = None
+    responses_lock = threading.Lock()
+    # Save bucket ranges in the revision cache's directory.
+    save_buckets = False
+
     def send_HEAD(self, code, message=None):
         self.send_response(code)
         self.send_header("Content-type", "text/plain")
@@ -52,44 +168,123 @@ class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         else:
             return self.send_HEAD(404, "Not Found")
 
-    def ranges_from_histograms(self, histograms):
-        all_histograms = OrderedDict()
-        parsed = json.loads(histograms, object_pairs_hook=OrderedDict)
-        for (name, definition) in parsed.iteritems():
-            histogram = histogram_tools.Histogram(name, definition)
-            parameters = OrderedDict()
-            table = {
-                'boolean': '2',
-                'flag': '3',
-                'enumerated': '1',
-                'linear': '1',
-                'exponential': '0'
-                }
-            # Use __setitem__ because Python lambdas are so limited.
-            histogram_tools.table_dispatch(histogram.kind(), table,
-                                           lambda k: parameters.__setitem__('kind', k))
-            if histogram.low() == 0:
-                parameters['min'] = 1
-            else:
-                parameters['min'] = histogram.low()
+    def do_POST(self):
+        if self.path != HIST_BUCKET_PATH:
+            return self.send_HEAD(404, "Not Found")
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return self.send_HEAD(411, "Must provide a Content-Length")
+        if length > MAX_BATCH_BYTES:
+            return self.send_HEAD(413, "Request too large")
+        try:
+            request = json.loads(self.rfile.read(length))
+            revisions = request[BATCH_REVISIONS_FIELD]
+            names = request.get(BATCH_HISTOGRAMS_FIELD)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self.send_HEAD(400, "Must provide a JSON object with a list of revision URLs")
+        if not isinstance(revisions, list) or \
+                not (names is None or isinstance(names, list)):
+            return self.send_HEAD(400, "Revisions and histograms must be lists")
+        if names is not None:
+            names = set(names)
+        self.send_batch(revisions, names)
 
-            try:
-                buckets = histogram.ranges()
-                parameters['buckets'] = buckets
-                parameters['max'] = buckets[-1]
-                parameters['bucket_count'] = len(buckets)
-            except histogram_tools.DefinitionException:
-                continue
+    def ranges_from_histograms(self, histograms, names=None):
+        return ranges_from_definitions(json.loads(histograms,
+                object_pairs_hook=OrderedDict), names)
 
-            all_histograms.update({ name: parameters });
+    def load_body(self, revision, get_buckets):
+        if get_buckets and self.save_buckets:
+            return self.revision_cache.get_compiled_for_revision(revision,
+                    BUCKETS_FORMAT, ranges_from_definitions)
+        histograms = self.revision_cache.get_histograms_for_revision(revision, False)
+        if histograms is None or not get_buckets:
+            return histograms
+        # Convert to bucket ranges
+        return self.ranges_from_histograms(histograms)
 
-            if startup_histogram_re.search(name) is not None:
-                all_histograms.update({ "STARTUP_" + name: parameters })
-        if MINIMAL_JSON:
-            result = json.dumps({'histograms': all_histograms}, separators=(',', ':'))
-        else:
-            result = json.dumps({'histograms': all_histograms})
-        return result
+    def send_cached(self, response):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(",")]
+            if response.etag in tags or "*" in tags:
+                self.send_response(304)
+                self.send_header("ETag", response.etag)
+                self.end_headers()
+                return
+        body = response.body
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain")
+        self.send_header("ETag", response.etag)
+        self.send_header("Cache-Control", "public, max-age=%d" % MAX_AGE)
+        self.send_header("Vary", "Accept-Encoding")
+        if accepts_gzip(self.headers.get("Accept-Encoding", "")):
+            body = response.gzipped
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_response(self, revision, get_buckets):
+        """Return the CachedResponse for a revision, or None if it wasn't
+        found."""
+        key = (revision, get_buckets)
+        with self.responses_lock:
+            response = self.responses.get(key)
+        if response is None:
+            # Get revision from cache. Concurrent requests for a revision
+            # that isn't on disk yet wait for a single fetch from hg.
+            body = self.load_body(revision, get_buckets)
+            if body is None:
+                return None
+            response = CachedResponse(body)
+            with self.responses_lock:
+                self.responses.put(key, response)
+        return response
+
+    def get_batch_layout(self, revision, names):
+        if names is None:
+            response = self.get_response(revision, True)
+            return response and response.body
+        histograms = self.revision_cache.get_histograms_for_revision(revision, False)
+        if histograms is None:
+            return None
+        return self.ranges_from_histograms(histograms, names)
+
+    def send_batch(self, revisions, names):
+        """Stream bucket ranges for many revisions, one JSON object per line.
+
+        Each revision gets a line like
+            {"revision": <url>, "definitions": <sha1>}
+        or {"revision": <url>, "error": <message>}. The first time a digest
+        is seen, it is preceded by
+            {"definitions": <sha1>, "layout": {"histograms": {...}}}
+        so revisions sharing a Histograms.json are only sent once.
+        """
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain")
+        self.end_headers()
+        sent = set()
+        for revision in revisions:
+            result = OrderedDict([("revision", revision)])
+            try:
+                digest = self.revision_cache.get_digest_for_revision(revision)
+                if digest is not None and digest not in sent:
+                    layout = self.get_batch_layout(revision, names)
+                    if layout is None:
+                        digest = None
+                    else:
+                        self.wfile.write('{"definitions":%s,"layout":%s}\n' % (
+                                json.dumps(digest), layout))
+                        sent.add(digest)
+                if digest is None:
+                    result["error"] = "Not Found"
+                else:
+                    result["definitions"] = digest
+            except Exception, e:
+                result["error"] = str(e)
+            self.wfile.write(json.dumps(result, separators=(',', ':')) + "\n")
 
     def send_histograms(self, query_string, get_buckets):
         params = urlparse.parse_qs(query_string)
@@ -100,35 +295,28 @@ class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             return self.send_HEAD(400, "Must provide a revision URL")
         # Use the first one, ignore any others
         revision = revisions[0]
-        # Get revision from cache
         try:
-            histograms = self.revision_cache.get_histograms_for_revision(revision, False)
+            response = self.get_response(revision, get_buckets)
         except Exception, e:
             return self.send_HEAD(500, e.message)
 
-        if histograms is None:
+        if response is None:
             return self.send_HEAD(404, "Not Found: " + str(revision))
-
-        if get_buckets:
-            # Convert to bucket ranges
-            ranges = self.ranges_from_histograms(histograms)
-            # Write out bucket ranges
-            self.send_HEAD(200)
-            self.wfile.write(ranges)
-        else:
-            # Send raw Histograms.json
-            self.send_HEAD(200)
-            self.wfile.write(histograms)
+        self.send_cached(response)
 
 def main():
     parser = argparse.ArgumentParser(description='Start a caching histogram server', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("-p", "--port", help="Server Port", type=int, default=9898)
     parser.add_argument("-c", "--cache-dir", help="Directory to cache Histograms.json revisions", default="./histogram_cache")
+    parser.add_argument("-n", "--cache-size", help="Number of responses to keep in memory", type=int, default=100)
+    parser.add_argument("--save-buckets", help="Save bucket ranges in the cache directory too", action="store_true")
     args = parser.parse_args()
     # This is ugly, but seems the easiest way to get this into MyHandler
     MyHandler.revision_cache = RevisionCache(args.cache_dir, "hg.mozilla.org")
+    MyHandler.responses = LRUCache(args.cache_size)
+    MyHandler.save_buckets = args.save_buckets
 
-    httpd = BaseHTTPServer.HTTPServer(("localhost", args.port), MyHandler)
+    httpd = ThreadingHTTPServer(("localhost", args.port), MyHandler)
     try:
         print "Server running on port", args.port
         httpd.serve_forever()
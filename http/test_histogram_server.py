@@ -0,0 +1,226 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import hashlib
+import httplib
+import threading
+import unittest
+import simplejson as json
+from cStringIO import StringIO
+from http.histogram_server import MyHandler, ThreadingHTTPServer, accepts_gzip
+from telemetry.util.lru import LRUCache
+
+REVISION_URL = "http://hg.mozilla.org/mozilla-central/rev/"
+
+DEFINITIONS = {
+    "a" * 12: '{"A11Y_INSTANTIATED_FLAG": {"kind": "flag"}, ' \
+              '"HTTP_REQUEST_COUNT": {"kind": "linear", "low": 1, ' \
+              '"high": 100, "n_buckets": 10}}',
+    "b" * 12: '{"B_FLAG": {"kind": "flag"}}',
+    "c" * 12: '{"C_FLAG": {"kind": "flag"}}',
+}
+# Same definitions as "a".
+DEFINITIONS["e" * 12] = DEFINITIONS["a" * 12]
+
+class FakeRevisionCache:
+    """Serves DEFINITIONS, and counts the revisions it was asked for."""
+    def __init__(self):
+        self.requests = []
+
+    def get_histograms_for_revision(self, revision_url, parse=True):
+        self.requests.append(revision_url)
+        return DEFINITIONS.get(revision_url[len(REVISION_URL):])
+
+    def get_digest_for_revision(self, revision_url):
+        if not revision_url.startswith(REVISION_URL):
+            raise ValueError("Invalid revision URL: %s" % revision_url)
+        definitions = DEFINITIONS.get(revision_url[len(REVISION_URL):])
+        return definitions and hashlib.sha1(definitions).hexdigest()
+
+class QuietHandler(MyHandler):
+    def log_message(self, *args):
+        pass
+
+class TestHistogramServer(unittest.TestCase):
+    def setUp(self):
+        MyHandler.revision_cache = FakeRevisionCache()
+        MyHandler.responses = LRUCache(2)
+        MyHandler.save_buckets = False
+        self.server = ThreadingHTTPServer(("localhost", 0), QuietHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, path, headers={}):
+        conn = httplib.HTTPConnection("localhost",
+                                      self.server.server_address[1])
+        conn.request("GET", path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+    def post(self, body=None, headers={}):
+        conn = httplib.HTTPConnection("localhost",
+                                      self.server.server_address[1])
+        conn.putrequest("POST", "/histogram_buckets")
+        if body is not None:
+            conn.putheader("Content-Length", str(len(body)))
+        for name, value in headers.iteritems():
+            conn.putheader(name, value)
+        conn.endheaders()
+        if body is not None:
+            conn.send(body)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+    def post_batch(self, revisions, names=None):
+        request = {"revisions": [REVISION_URL + r for r in revisions]}
+        if names is not None:
+            request["histograms"] = names
+        response, body = self.post(json.dumps(request))
+        self.assertEqual(200, response.status)
+        return [json.loads(line) for line in body.splitlines()]
+
+    def get(self, revision, buckets=False, headers={}):
+        path = "/histogram_buckets" if buckets else "/histograms"
+        return self.request(path + "?revision=" + REVISION_URL + revision,
+                            headers)
+
+    def test_accepts_gzip(self):
+        self.assertTrue(accepts_gzip("gzip"))
+        self.assertTrue(accepts_gzip("deflate, GZIP;q=0.5"))
+        self.assertTrue(accepts_gzip("x-gzip"))
+        self.assertTrue(accepts_gzip("*"))
+        self.assertFalse(accepts_gzip(""))
+        self.assertFalse(accepts_gzip("identity"))
+        self.assertFalse(accepts_gzip("gzip;q=0"))
+        self.assertFalse(accepts_gzip("gzip; q=0.0, identity"))
+        self.assertFalse(accepts_gzip("gzip;q=0, *"))
+        self.assertTrue(accepts_gzip("*;q=0, gzip"))
+
+    def test_histograms(self):
+        response, body = self.get("a" * 12)
+        self.assertEqual(200, response.status)
+        self.assertEqual(DEFINITIONS["a" * 12], body)
+        self.assertEqual("Accept-Encoding", response.getheader("Vary"))
+        self.assertIsNone(response.getheader("Content-Encoding"))
+        etag = response.getheader("ETag")
+        self.assertIsNotNone(etag)
+
+        # Unchanged.
+        response, body = self.get("a" * 12,
+                headers={"If-None-Match": '"other", ' + etag})
+        self.assertEqual(304, response.status)
+        self.assertEqual("", body)
+        self.assertEqual(etag, response.getheader("ETag"))
+
+        response, body = self.get("d" * 12)
+        self.assertEqual(404, response.status)
+
+    def test_buckets(self):
+        response, body = self.get("a" * 12, buckets=True)
+        self.assertEqual(200, response.status)
+        histograms = json.loads(body)["histograms"]
+        self.assertEqual(["A11Y_INSTANTIATED_FLAG", "HTTP_REQUEST_COUNT",
+                          "STARTUP_HTTP_REQUEST_COUNT"],
+                         sorted(histograms.keys()))
+        self.assertEqual(10, histograms["HTTP_REQUEST_COUNT"]["bucket_count"])
+        # Bucket ranges have their own ETag.
+        plain, body = self.get("a" * 12)
+        self.assertNotEqual(response.getheader("ETag"),
+                            plain.getheader("ETag"))
+
+    def test_gzip(self):
+        plain, plain_body = self.get("a" * 12)
+        response, body = self.get("a" * 12,
+                headers={"Accept-Encoding": "deflate, gzip"})
+        self.assertEqual(200, response.status)
+        self.assertEqual("gzip", response.getheader("Content-Encoding"))
+        self.assertEqual("Accept-Encoding", response.getheader("Vary"))
+        self.assertEqual(plain.getheader("ETag"), response.getheader("ETag"))
+        self.assertEqual(str(len(body)), response.getheader("Content-Length"))
+        self.assertEqual(plain_body,
+                         gzip.GzipFile(fileobj=StringIO(body)).read())
+
+        response, body = self.get("a" * 12,
+                headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertIsNone(response.getheader("Content-Encoding"))
+        self.assertEqual(plain_body, body)
+
+    def test_lru(self):
+        requests = MyHandler.revision_cache.requests
+        for revision in ["a", "b", "a"]:
+            self.assertEqual(200, self.get(revision * 12)[0].status)
+        self.assertEqual(2, len(requests))
+        # "b" is the least recently used, so it makes way for "c".
+        self.get("c" * 12)
+        self.get("a" * 12)
+        self.assertEqual(3, len(requests))
+        self.get("b" * 12)
+        self.assertEqual(REVISION_URL + "b" * 12, requests[-1])
+        self.assertEqual(4, len(requests))
+        # Revisions that weren't found aren't kept.
+        self.get("d" * 12)
+        self.get("d" * 12)
+        self.assertEqual(6, len(requests))
+
+    def test_batch(self):
+        lines = self.post_batch(["a" * 12, "e" * 12, "b" * 12, "d" * 12,
+                                 "a" * 12])
+        digest_a = hashlib.sha1(DEFINITIONS["a" * 12]).hexdigest()
+        digest_b = hashlib.sha1(DEFINITIONS["b" * 12]).hexdigest()
+        # Each layout is sent once, before the first revision that uses it.
+        self.assertEqual([
+            {"definitions": digest_a},
+            {"revision": REVISION_URL + "a" * 12, "definitions": digest_a},
+            {"revision": REVISION_URL + "e" * 12, "definitions": digest_a},
+            {"definitions": digest_b},
+            {"revision": REVISION_URL + "b" * 12, "definitions": digest_b},
+            {"revision": REVISION_URL + "d" * 12, "error": "Not Found"},
+            {"revision": REVISION_URL + "a" * 12, "definitions": digest_a},
+        ], [dict((k, v) for k, v in l.iteritems() if k != "layout")
+            for l in lines])
+        response, body = self.get("a" * 12, buckets=True)
+        self.assertEqual(json.loads(body), lines[0]["layout"])
+        self.assertEqual(["B_FLAG"],
+                         lines[3]["layout"]["histograms"].keys())
+
+    def test_batch_filter(self):
+        lines = self.post_batch(["a" * 12, "b" * 12],
+                                ["STARTUP_HTTP_REQUEST_COUNT", "B_FLAG"])
+        self.assertEqual(["STARTUP_HTTP_REQUEST_COUNT"],
+                         lines[0]["layout"]["histograms"].keys())
+        self.assertEqual(["B_FLAG"], lines[2]["layout"]["histograms"].keys())
+
+        lines = self.post_batch(["a" * 12], ["A11Y_INSTANTIATED_FLAG",
+                                             "UNKNOWN"])
+        self.assertEqual(["A11Y_INSTANTIATED_FLAG"],
+                         lines[0]["layout"]["histograms"].keys())
+
+    def test_batch_errors(self):
+        response, body = self.post(json.dumps({"revisions": ["bad"]}))
+        self.assertEqual(200, response.status)
+        self.assertEqual([{"revision": "bad",
+                           "error": "Invalid revision URL: bad"}],
+                         [json.loads(line) for line in body.splitlines()])
+
+        for body in ["not json", "[]", '{"histograms": []}',
+                     '{"revisions": "x"}',
+                     '{"revisions": [], "histograms": "x"}']:
+            self.assertEqual(400, self.post(body)[0].status)
+        self.assertEqual(411, self.post()[0].status)
+        self.assertEqual(413, self.post(headers={
+                "Content-Length": str(10 * 1024 * 1024 + 1)})[0].status)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Compare intermediate (map output) formats for the MapReduce shuffle.
+
+Writes the same synthetic map output using the old one-marshal-per-record
+format and the framed run format with each available block codec, then reads
+it back. Sizes and timings are scaled to "per GB of map output", where the
+size of the marshal version is taken to be the size of the map output.
+
+Example usage:
+    python -m mapreduce.bench_shuffle --records 500000 --values histogram
+"""
+
+import argparse
+import marshal
+import os
+import random
+import shutil
+import tempfile
+from datetime import datetime
+from telemetry.util.compress import BLOCK_CODECS, block_codec_available
+from mapreduce.shuffle import RunWriter, read_run, default_partition
+import telemetry.util.timer as timer
+
+CHANNELS = ["release", "beta", "aurora", "nightly"]
+OSES = ["WINNT", "Darwin", "Linux", "Android"]
+
+def generate(count, values, seed=42):
+    rand = random.Random(seed)
+    records = []
+    for i in range(count):
+        key = (rand.choice(CHANNELS), rand.choice(OSES),
+               "%d.0" % rand.randint(20, 40),
+               "HISTOGRAM_%d" % rand.randint(0, 500))
+        if values == "count":
+            value = 1
+        elif values == "histogram":
+            value = [rand.randint(0, 100) for b in range(rand.randint(10, 60))]
+        else:
+            value = '{"simpleMeasurements":{"uptime":%d,"main":%d},' \
+                    '"info":{"OS":"%s","appUpdateChannel":"%s"}}' % (
+                    rand.randint(0, 10000), rand.randint(0, 1000), key[1],
+                    key[0])
+        records.append((key, value))
+    records.sort()
+    return records
+
+def bench_marshal(records, filename):
+    start = datetime.now()
+    with open(filename, "wb") as out:
+        for record in records:
+            marshal.dump(record, out)
+    write_sec = timer.delta_sec(start)
+    start = datetime.now()
+    count = 0
+    with open(filename, "rb") as f:
+        try:
+            while True:
+                marshal.load(f)
+                count += 1
+        except EOFError:
+            pass
+    read_sec = timer.delta_sec(start)
+    assert count == len(records)
+    return os.path.getsize(filename), write_sec, read_sec
+
+def bench_runs(records, filename, codec):
+    start = datetime.now()
+    with RunWriter(filename, codec) as out:
+        out.write_many(records)
+    write_sec = timer.delta_sec(start)
+    start = datetime.now()
+    count = 0
+    for record in read_run(filename):
+        count += 1
+    read_sec = timer.delta_sec(start)
+    assert count == len(records)
+    return os.path.getsize(filename), write_sec, read_sec
+
+def skew(records, partition_count, partition):
+    counts = [0] * partition_count
+    for key, value in records:
+        counts[partition(key, partition_count)] += 1
+    return max(counts) / (float(len(records)) / partition_count)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MapReduce intermediate formats.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", "--records", help="Number of map output records", type=int, default=200000)
+    parser.add_argument("-V", "--values", help="Kind of values to emit", choices=["count", "histogram", "json"], default="histogram")
+    parser.add_argument("-r", "--num-reducers", help="Number of partitions to check for skew", type=int, default=8)
+    args = parser.parse_args()
+
+    print "Generating", args.records, args.values, "records..."
+    records = generate(args.records, args.values)
+    work_dir = tempfile.mkdtemp()
+    try:
+        base_size, base_write, base_read = bench_marshal(records,
+                os.path.join(work_dir, "marshal"))
+        scale = 1024.0 * 1024.0 * 1024.0 / base_size
+        print "Map output: %d bytes with marshal" % base_size
+        print
+        print "%-8s %14s %10s %10s %14s %12s" % ("Format", "Bytes/GB",
+                "Write s/GB", "Read s/GB", "Bytes saved/GB", "Secs saved/GB")
+        def report(name, size, write_sec, read_sec):
+            print "%-8s %14d %10.2f %10.2f %14d %12.2f" % (name,
+                    size * scale, write_sec * scale, read_sec * scale,
+                    (base_size - size) * scale,
+                    (base_write + base_read - write_sec - read_sec) * scale)
+        report("marshal", base_size, base_write, base_read)
+        for codec in BLOCK_CODECS:
+            if not block_codec_available(codec):
+                print "%-8s (not available)" % codec
+                continue
+            report(codec, *bench_runs(records,
+                    os.path.join(work_dir, codec), codec))
+    finally:
+        shutil.rmtree(work_dir)
+
+    print
+    print "Largest partition vs. average over %d partitions:" % args.num_reducers
+    print "  hash(key):          %.2f" % skew(records, args.num_reducers,
+            lambda k, n: hash(k) % n)
+    print "  default_partition:  %.2f" % skew(records, args.num_reducers,
+            default_partition)
+
+if __name__ == "__main__":
+    main()
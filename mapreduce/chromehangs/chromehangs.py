@@ -13,6 +13,9 @@ except ImportError:
 def check_obj(key, o):
     return len(o.get(key, {}).get("memoryMap", [])) > 0
 
+# Only decode the parts of each message that we use.
+heka_fields = ["payload.chromeHangs", "payload.lateWrites"]
+
 def map(k, v, cx):
     try:
         o = v["payload"]
@@ -1,9 +1,15 @@
 # Same as the osdistribution.py example in jydoop
 import json
 
+# Only decode the part of each message that we use.
+heka_fields = ["environment.system.os.name"]
+
 def map(k, v, cx):
     os = v['environment']['system']['os']['name']
     cx.write(os, 1)
 
 def reduce(k, v, cx):
     cx.write(k, sum(v))
+
+# Counting can be done incrementally, so combine map output as we go.
+combine = reduce
@@ -4,3 +4,6 @@ def map(key, dims, value, context):
 
 def reduce(key, values, context):
     context.write(key, sum(values))
+
+# Counting can be done incrementally, so combine map output as we go.
+combine = reduce
@@ -28,3 +28,6 @@ def map(k, d, v, cx):
 
 def reduce(k, v, cx):
     cx.writecsv(list(k) + [sum(v)])
+
+def combine(k, v, cx):
+    cx.write(k, sum(v))
@@ -7,3 +7,6 @@ def map(k, d, v, cx):
 
 def reduce(k, v, cx):
     cx.write(k, sum(v))
+
+# Counting can be done incrementally, so combine map output as we go.
+combine = reduce
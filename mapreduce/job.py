@@ -10,13 +10,21 @@ import imp
 import sys
 import os
 import json
-import marshal
+import cPickle as pickle
 import traceback
 import errno
+import threading
+import Queue
+import glob
+import heapq
+import itertools
 from datetime import datetime
-from multiprocessing import Process
+from multiprocessing import Process, Value
 from telemetry.telemetry_schema import TelemetrySchema
-from telemetry.util.compress import CompressedFile
+from telemetry.util.compress import CompressedFile, CompressedStream, \
+        BLOCK_CODECS, block_codec_available
+from mapreduce.shuffle import RunWriter, read_run, sort_key, \
+        default_partition
 import telemetry.util.s3 as s3util
 import telemetry.util.timer as timer
 import subprocess
@@ -27,11 +35,53 @@ import collections
 import gc
 try:
     from boto.s3.connection import S3Connection
+    from boto.s3.key import Key
     BOTO_AVAILABLE=True
 except ImportError:
     BOTO_AVAILABLE=False
 
 
+class TextInputReader:
+    """Reads input in the v2 storage format.
+
+    Each line of a (compressed) input file contains a key and a JSON value,
+    separated by a tab. The job's map function is called with the key, the
+    dimensions of the input file, the value and the map context.
+    """
+    # Whether all the dimensions are in the directory names (as opposed to
+    # the last few being in the file name).
+    dirs_only = False
+
+    def list_remote(self, bucket, schema):
+        return s3util.list_partitions(bucket, schema=schema, include_keys=True)
+
+    def setup(self, module):
+        """Called with the job script module once it has been loaded."""
+        pass
+
+    def open(self, input_file, source):
+        """Open `source`, which is either a filename or an S3ChunkReader."""
+        if isinstance(source, S3ChunkReader):
+            compression_type = CompressedFile(input_file.name).compression_type
+            return CompressedStream(source, compression_type, input_file.name)
+        return CompressedFile(source)
+
+    def map_input(self, input_file, handle, mapfunc, context):
+        """Call `mapfunc` for each record in `handle`, return the count."""
+        line_num = 0
+        for line in handle:
+            line_num += 1
+            try:
+                # Remove the trailing EOL character(s) before passing to
+                # the map function.
+                key, value = line.rstrip('\r\n').split("\t", 1)
+                mapfunc(key, input_file.dimensions, value, context)
+            except ValueError, e:
+                # TODO: increment "bad line" metrics.
+                print "Bad line:", input_file.name, ":", line_num, e
+        return line_num
+
+
 class Job:
     """A class for orchestrating a Telemetry MapReduce job"""
     # 1. read input filter
@@ -44,6 +94,10 @@ class Job:
     # 7. combine map output for each file
     # 8. reduce combine output overall
 
+    # How to find and read the input files. Subclasses can override this to
+    # handle other storage formats (see hekajob.py).
+    InputReader = TextInputReader
+
     def __init__(self, config):
         # Sanity check args.
         if config.get("num_mappers") <= 0:
@@ -75,43 +129,29 @@ class Job:
         self._aws_secret_key = config.get("aws_secret_key")
         self._profile = config.get("profile")
         self._delete_data = config.get("delete_data")
+        self._spill_bytes = config.get("spill_mb", 128) * 1024 * 1024
+        self._use_cache = not config.get("stream", False)
+        self._shuffle_codec = config.get("shuffle_compression", "zlib")
+        if self._spill_bytes <= 0:
+            raise ValueError("Spill size must be greater than zero")
+        if not block_codec_available(self._shuffle_codec):
+            raise ValueError("Shuffle compression '%s' is not available" % (
+                    self._shuffle_codec))
+        self._reader = self.InputReader()
         with open(config.get("job_script")) as modulefd:
             # let the job script import additional modules under its path
             sys.path.append(os.path.dirname(config.get("job_script")))
             ## Lifted from FileDriver.py in jydoop.
             self._job_module = imp.load_module(
                 "telemetry_job", modulefd, config.get("job_script"), ('.py', 'U', 1))
+        self._reader.setup(self._job_module)
 
-    def dump_stats(self, partitions):
-        total = sum(partitions)
-        avg = total / len(partitions)
-        for i in range(len(partitions)):
-            print "Partition %d contained %d (%+d)" % (i, partitions[i], float(partitions[i]) - avg)
-
-    def fetch_remotes(self, remotes):
-        # TODO: fetch remotes inside Mappers, and process each one as it becomes available.
-        remote_names = ( r.name for r in remotes if r.remote )
-
-        # TODO: check cache first.
-        result = 0
-
-        fetch_cwd = os.path.join(self._work_dir, "cache")
-        if not os.path.isdir(fetch_cwd):
-            os.makedirs(fetch_cwd)
-        loader = s3util.Loader(fetch_cwd, self._bucket_name, aws_key=self._aws_key, aws_secret_key=self._aws_secret_key)
-        start = datetime.now()
-        downloaded_bytes = 0
-        for local, remote, err in loader.get_list(remote_names):
-            if err is None:
-                print "Downloaded", remote
-                downloaded_bytes += os.path.getsize(local)
-            else:
-                print "Failed to download", remote
-                result += 1
-        duration_sec = timer.delta_sec(start)
-        downloaded_mb = float(downloaded_bytes) / 1024.0 / 1024.0
-        print "Downloaded %.2fMB in %.2fs (%.2fMB/s)" % (downloaded_mb, duration_sec, downloaded_mb / duration_sec)
-        return result
+    def get_fetcher(self):
+        if self._local_only:
+            return InputFetcher(self._work_dir)
+        return InputFetcher(self._work_dir, self._bucket_name,
+                aws_key=self._aws_key, aws_secret_key=self._aws_secret_key,
+                use_cache=self._use_cache)
 
     def dedupe_remotes(self, remote_files, local_files):
         return ( r for r in remote_files
@@ -127,25 +167,22 @@ class Job:
         # that exist in the data dir.
         remote_files = self.dedupe_remotes(remote_files, files)
 
-        # Partition files into reasonably equal groups for use by mappers
-        print "Partitioning input data..."
-        partitions = self.partition(files, remote_files)
-        print "Done"
+        # Queue up the input files for mappers to take from as they go.
+        print "Queueing input data..."
+        inputs = InputQueue(self.get_inputs(files, remote_files))
+        print "Done. Queued %d inputs (%d bytes)" % (len(inputs), inputs.total_size)
 
-        if not any(part for part in partitions):
+        if len(inputs) == 0:
              print "Filter didn't match any files... nothing to do"
              return
 
-        partitions = [part for part in partitions if part]
-
-        # Not useful to have more mappers than partitions.
-        if len(partitions) < self._num_mappers:
+        # Not useful to have more mappers than inputs.
+        if len(inputs) < self._num_mappers:
             print "Filter matched only %d input files (%d local in %s and %d " \
                   "remote from %s). Reducing number of mappers accordingly." % (
-                  len(partitions), len(files), self._input_dir,
-                  sum(len(part) for part in partitions) - len(files),
-                  self._bucket_name)
-            self._num_mappers = len(partitions)
+                  len(inputs), len(files), self._input_dir,
+                  len(inputs) - len(files), self._bucket_name)
+            self._num_mappers = len(inputs)
 
         # Free up our set of names. We want to minimize
         # our memory usage prior to forking map jobs.
@@ -160,30 +197,32 @@ class Job:
             elif proc.exitcode:
                 raise OSError("%s exited with code %d" % (proc.name, proc.exitcode))
 
-        # Partitions are ready. Map.
+        # Remove any map output left over from a previous (failed) job in the
+        # same work dir, since reducers will merge every run they find.
+        for r in range(self._num_reducers):
+            for mfile in Reducer.find_runs(self._work_dir, r):
+                os.remove(mfile)
+
+        # Inputs are ready. Map. Each mapper takes the next input from the
+        # queue whenever it finishes one, and fetches its own remote inputs
+        # as it goes.
+        fetcher = self.get_fetcher()
+        start = datetime.now()
         mappers = []
         for i in range(self._num_mappers):
-            if len(partitions[i]) > 0:
-                # Fetch the files we need for each mapper
-                if not self._local_only:
-                    print "Fetching remotes for partition", i
-                    fetch_result = self.fetch_remotes(partitions[i])
-                    if fetch_result == 0:
-                        print "Remote files fetched successfully"
-                    else:
-                        print "ERROR: Failed to fetch", fetch_result, "files."
-                        # TODO: Bail, since results will be unreliable?
-                p = Process(
-                        target=Mapper,
-                        name=("Mapper-%d" % i),
-                        args=(i, self._profile, partitions[i], self._work_dir, self._job_module, self._num_reducers, self._delete_data))
-                mappers.append(p)
-                p.start()
-            else:
-                print "Skipping mapper", i, "- no input files to process"
+            p = Process(
+                    target=Mapper,
+                    name=("Mapper-%d" % i),
+                    args=(i, self._profile, inputs, self._work_dir, self._job_module, self._num_reducers, self._delete_data, fetcher, self._reader, self._spill_bytes, self._shuffle_codec))
+            mappers.append(p)
+            p.start()
         for m in mappers:
             m.join()
             checkExitCode(m)
+        duration = timer.delta_sec(start)
+        print "Mapped %d bytes in %.2f seconds (%.2f MB/s)" % (
+                inputs.total_size, duration,
+                inputs.total_size / 1024.0 / 1024.0 / max(duration, 0.001))
 
         # Mappers are done. Reduce.
         reducers = []
@@ -191,7 +230,7 @@ class Job:
             p = Process(
                     target=Reducer,
                     name=("Reducer-%d" % i),
-                    args=(i, self._profile, self._work_dir, self._job_module, self._num_mappers))
+                    args=(i, self._profile, self._work_dir, self._job_module, self._num_mappers, self._shuffle_codec))
             reducers.append(p)
             p.start()
         for r in reducers:
@@ -221,61 +260,30 @@ class Job:
                         out.write(reducer_output.read())
                     os.remove(reducer_filename)
 
-        # TODO: clean up downloaded files?
-
         # Clean up mapper outputs
-        for m in range(self._num_mappers):
-            for r in range(self._num_reducers):
-                mfile = os.path.join(self._work_dir, "mapper_%d_%d" % (m, r))
-                if os.path.exists(mfile):
-                    os.remove(mfile)
-                else:
-                    print "Warning: Could not find", mfile
+        for r in range(self._num_reducers):
+            for mfile in Reducer.find_runs(self._work_dir, r):
+                os.remove(mfile)
 
     MapperInput = collections.namedtuple('MapperInput',
         ('remote', 'name', 'size', 'dimensions'))
 
-    # Split up the input files into groups of approximately-equal on-disk size.
-    def partition(self, files, remote_files):
-        namesize = ( self.MapperInput(
-            remote=False,
-            name=fn,
-            size=os.stat(fn).st_size,
-            dimensions=self._input_filter.get_dimensions(self._input_dir, fn)
-        ) for fn in files )
-
-        partitions = [[] for i in range(self._num_mappers)]
-        sums = [0 for i in range(self._num_mappers)]
-        min_idx = 0
-
-        def find_min_idx(stuff):
-            return min(enumerate(stuff), key=lambda x: x[1])[0]
-
-        # Greedily assign the largest file to the smallest partition
-        for current in namesize:
-            #print "putting", current, "into partition", min_idx
-            partitions[min_idx].append(current)
-            sums[min_idx] += current.size
-            min_idx = find_min_idx(sums)
-
-        # And now do the same with the remote files.
+    def get_inputs(self, files, remote_files):
+        for fn in files:
+            yield self.MapperInput(
+                remote=False,
+                name=fn,
+                size=os.stat(fn).st_size,
+                dimensions=self._input_filter.get_dimensions(self._input_dir,
+                        fn, dirs_only=self._reader.dirs_only))
+
         for r in remote_files:
-            size = r.size
-            dims = self._input_filter.get_dimensions(".", r.name)
-            remote = self.MapperInput(
+            yield self.MapperInput(
                 remote=True,
                 name=r.name,
-                size=size,
-                dimensions=dims
-            )
-            #print "putting", remote, "into partition", min_idx
-            partitions[min_idx].append(remote)
-            sums[min_idx] += size
-            min_idx = find_min_idx(sums)
-
-        # Print out some info to see how balanced the partitions were:
-        self.dump_stats(sums)
-        return partitions
+                size=r.size,
+                dimensions=self._input_filter.get_dimensions(".", r.name,
+                        dirs_only=self._reader.dirs_only))
 
     def get_filtered_files(self, searchdir):
         level_offset = searchdir.count(os.path.sep)
@@ -284,7 +292,8 @@ class Job:
             dirs[:] = [i for i in dirs if self.filter_includes(level, i)]
             for f in files:
                 full_filename = os.path.join(root, f)
-                dims = self._input_filter.get_dimensions(searchdir, full_filename)
+                dims = self._input_filter.get_dimensions(searchdir,
+                        full_filename, dirs_only=self._reader.dirs_only)
                 include = True
                 for l in range(level, len(self._allowed_values)):
                     if not self.filter_includes(l, dims[l]):
@@ -307,7 +316,7 @@ class Job:
             # Filter input files by partition. If the filter is reasonably
             # selective, this can be much faster than listing all files in the
             # bucket.
-            for f in s3util.list_partitions(bucket, schema=self._input_filter, include_keys=True):
+            for f in self._reader.list_remote(bucket, self._input_filter):
                 count += 1
                 if count == 1 or count % 1000 == 0:
                     print "Listed", count, "so far"
@@ -322,28 +331,124 @@ class Job:
 
 
 class Context:
-    def __init__(self, out, partition_count):
+    """Collects map output and writes it to disk as sorted runs.
+
+    Output is buffered in memory until it reaches `spill_bytes`, at which point
+    each partition's buffer is sorted by key and written out as a new run
+    named `<out>_<partition>.<run number>` (see mapreduce/shuffle.py for the
+    format). Reducers merge these runs, so they only ever need to hold the
+    values for a single key in memory.
+
+    If the job has a `combine` function, values are grouped by key in memory
+    and combined before they are written, so a key that is emitted many times
+    by a mapper only takes up one record per run.
+
+    Keys are assigned to partitions by `partition_func(key, partition_count)`
+    if given, or by `shuffle.default_partition` otherwise.
+    """
+    # Spill combined output once we're holding this many distinct keys.
+    MAX_COMBINE_KEYS = 100000
+    # Measure the serialized size of one in this many records to estimate
+    # how much memory the buffered output is using.
+    SIZE_SAMPLE_RATE = 64
+
+    def __init__(self, out, partition_count, spill_bytes=128*1024*1024,
+                 combine_func=None, partition_func=None, codec="zlib"):
         self._basename = out
         self._partition_count = partition_count
-        self._sinks = {}
-        # Pre-open all the files to make sure they exist for the reducer. This
-        # takes care of the situation where we don't get a key value hashing
-        # to a particular partition.
-        for i in range(partition_count):
-            self._sinks[i] = open("%s_%d" % (self._basename, i), "wb")
+        self._spill_bytes = spill_bytes
+        self._codec = codec
+        self._run_count = 0
+        self._buffers = [[] for i in range(partition_count)]
+        self._buffered_records = 0
+        self._sample_count = 0
+        self._sample_bytes = 0
+        self._partition = default_partition
+        if callable(partition_func):
+            self._partition = partition_func
+        self._combine = None
+        if callable(combine_func):
+            self._combine = combine_func
+            self._collectors = [Collector(combine_func, Reducer.COMBINE_SIZE)
+                                for i in range(partition_count)]
+            self._key_count = 0
 
     def partition(self, key):
-        #print "hash of", key, "is", hash(key) % self._partition_count
-        return hash(key) % self._partition_count
+        return self._partition(key, self._partition_count)
+
+    def sample_size(self, key, value):
+        if self._buffered_records % Context.SIZE_SAMPLE_RATE == 0:
+            self._sample_count += 1
+            self._sample_bytes += len(pickle.dumps((key, value), 2))
+
+    def estimated_bytes(self):
+        if self._sample_count == 0:
+            return 0
+        return self._buffered_records * self._sample_bytes / self._sample_count
 
     def write(self, key, value):
-        p = self.partition(key)
-        out = self._sinks[p]
-        marshal.dump((key, value), out)
+        if self._combine is not None:
+            self.collect(key, value)
+            return
+        self.sample_size(key, value)
+        self._buffers[self.partition(key)].append((sort_key(key), (key, value)))
+        self._buffered_records += 1
+        if self.estimated_bytes() >= self._spill_bytes:
+            self.spill()
+
+    def collect(self, key, value):
+        collector = self._collectors[self.partition(key)]
+        values = collector.get(key)
+        if values is None:
+            self._key_count += 1
+            # Serializing every value would defeat the purpose, so estimate
+            # memory use from a sample of the new keys.
+            if self._key_count % Context.SIZE_SAMPLE_RATE == 1:
+                self._sample_count += 1
+                self._sample_bytes += len(pickle.dumps((key, value), 2))
+            before = 0
+        else:
+            before = len(values)
+        collector.collect(key, value)
+        # The collector may have just combined this key's values into one,
+        # or none at all.
+        self._buffered_records += len(collector.get(key, ())) - before
+        if self._key_count >= Context.MAX_COMBINE_KEYS or \
+                self.estimated_bytes() >= self._spill_bytes:
+            self.spill()
+
+    def drain_collectors(self):
+        for p, collector in enumerate(self._collectors):
+            buf = self._buffers[p]
+            for key in collector.keys():
+                values = collector[key]
+                if len(values) > 1:
+                    self._combine(key, values, collector)
+                skey = sort_key(key)
+                for value in collector.get(key, ()):
+                    buf.append((skey, (key, value)))
+            collector.clear()
+        self._key_count = 0
+
+    def spill(self):
+        if self._combine is not None:
+            self.drain_collectors()
+        for p, buf in enumerate(self._buffers):
+            if not buf:
+                continue
+            # Only compare the keys, values may not be comparable at all.
+            buf.sort(key=lambda r: r[0])
+            run_file = "%s_%d.%d" % (self._basename, p, self._run_count)
+            with RunWriter(run_file, self._codec) as out:
+                out.write_many([record for skey, record in buf])
+            self._buffers[p] = []
+        self._run_count += 1
+        self._buffered_records = 0
+        self._sample_count = 0
+        self._sample_bytes = 0
 
     def finish(self):
-        for s in self._sinks.itervalues():
-            s.close()
+        self.spill()
 
 
 class TextContext(Context):
@@ -367,62 +472,226 @@ class TextContext(Context):
         self._sink.write(value)
         self._sink.write(self.record_separator)
 
+    def finish(self):
+        self._sink.close()
+
+class S3ChunkReader:
+    """Read the contents of an S3 key in chunks from a background thread.
+
+    Up to `depth` chunks are buffered ahead of the consumer, so the network
+    transfer overlaps with whatever the consumer does with each chunk.
+    """
+    def __init__(self, bucket_name, key_name, aws_key=None,
+                 aws_secret_key=None, chunk_size=1024*1024, depth=8):
+        self.name = key_name
+        self._chunks = Queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._read_all, args=(
+                bucket_name, key_name, aws_key, aws_secret_key, chunk_size))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _read_all(self, bucket_name, key_name, aws_key, aws_secret_key,
+                  chunk_size):
+        try:
+            conn = S3Connection(aws_key, aws_secret_key)
+            key = Key(conn.get_bucket(bucket_name, validate=False), key_name)
+            while True:
+                chunk = key.read(chunk_size)
+                if chunk == '' or not self._put(chunk):
+                    break
+            key.close()
+            conn.close()
+        except Exception, e:
+            self._put(e)
+        self._put(None)
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        self._stopped.set()
+
+
+class InputFetcher:
+    """Open Mapper inputs, fetching remote ones from S3 in the background.
+
+    The next input is fetched by a separate thread while the Mapper works on
+    the current one. It is only taken from `inputs` (which may be shared with
+    other Mappers) once the Mapper has started on the current input, so
+    near the end of a job no Mapper holds on to inputs that an idle one
+    could be working on. If `use_cache` is False, remote inputs are
+    decompressed straight from S3 instead of being downloaded to
+    `<work_dir>/cache` first.
+    """
+    def __init__(self, work_dir, bucket_name=None, aws_key=None,
+                 aws_secret_key=None, use_cache=True):
+        self.cache_dir = os.path.join(work_dir, "cache")
+        self.bucket_name = bucket_name
+        self.aws_key = aws_key
+        self.aws_secret_key = aws_secret_key
+        self.use_cache = use_cache
+
+    def open_inputs(self, inputs, reader):
+        """Yield (input_file, local_file, handle, error) for each of `inputs`.
+
+        Each input is opened using `reader`. `local_file` is the name of the
+        file the input was read from, or None if it was streamed from S3.
+        """
+        ready = Queue.Queue()
+        # Released each time the Mapper starts on an input, to let the
+        # prefetcher take the next one.
+        wanted = threading.Semaphore(1)
+        prefetcher = threading.Thread(target=self.prefetch,
+                                      args=(inputs, ready, wanted))
+        prefetcher.daemon = True
+        prefetcher.start()
+        while True:
+            item = ready.get()
+            if item is None:
+                break
+            wanted.release()
+            input_file, source, err = item
+            handle = None
+            local_file = None
+            if not isinstance(source, S3ChunkReader):
+                local_file = source
+            if err is None:
+                try:
+                    handle = reader.open(input_file, source)
+                except Exception, e:
+                    err = e
+            yield input_file, local_file, handle, err
+        prefetcher.join()
+
+    def prefetch(self, inputs, ready, wanted):
+        transfers = None
+        inputs = iter(inputs)
+        while True:
+            wanted.acquire()
+            input_file = next(inputs, None)
+            if input_file is None:
+                break
+            source = input_file.name
+            err = None
+            if input_file.remote:
+                try:
+                    if not self.use_cache:
+                        source = S3ChunkReader(self.bucket_name,
+                                input_file.name, self.aws_key,
+                                self.aws_secret_key)
+                    else:
+                        if transfers is None:
+                            transfers = s3util.TransferManager(
+                                    self.bucket_name, self.aws_key,
+                                    self.aws_secret_key)
+                        source = os.path.join(self.cache_dir, input_file.name)
+                        err, size, sec = transfers.download(input_file.name,
+                                                            source)
+                except Exception, e:
+                    err = e
+            ready.put((input_file, source, err))
+        if transfers is not None:
+            transfers.close()
+        ready.put(None)
+
+
+class InputQueue:
+    """A queue of Mapper inputs shared by all the Mappers of a job.
+
+    Rather than splitting the inputs up front, each Mapper takes the next
+    input whenever it is ready for more work, so a Mapper that gets slow
+    inputs doesn't hold up the rest of the job. Inputs are handed out
+    largest first, leaving the small ones to even things out at the end.
+
+    The list of inputs is shared with the Mapper processes when they are
+    forked, so the only thing that needs to be synchronized is the index of
+    the next input.
+    """
+    def __init__(self, inputs):
+        self._inputs = sorted(inputs, key=lambda i: i.size, reverse=True)
+        self._next = Value('l', 0)
+        self.total_size = sum(i.size for i in self._inputs)
+
+    def __len__(self):
+        return len(self._inputs)
+
+    def __iter__(self):
+        while True:
+            with self._next.get_lock():
+                idx = self._next.value
+                self._next.value += 1
+            if idx >= len(self._inputs):
+                return
+            yield self._inputs[idx]
+
+
 class Mapper:
-    def __init__(self, mapper_id, do_profile, inputs, work_dir, module, partition_count, delete_files):
+    def __init__(self, mapper_id, do_profile, inputs, work_dir, module, partition_count, delete_files, fetcher, reader, spill_bytes, codec):
         if do_profile:
             profile_out = os.path.join(work_dir, "profile_mapper_" + str(mapper_id))
             pr = cProfile.Profile()
             pr.enable()
 
-        self.run_mapper(mapper_id, inputs, work_dir, module, partition_count, delete_files)
+        self.run_mapper(mapper_id, inputs, work_dir, module, partition_count, delete_files, fetcher, reader, spill_bytes, codec)
 
         if do_profile:
             pr.disable()
             pr.dump_stats(profile_out)
 
-    def run_mapper(self, mapper_id, inputs, work_dir, module, partition_count, delete_files):
+    def run_mapper(self, mapper_id, inputs, work_dir, module, partition_count, delete_files, fetcher, reader, spill_bytes, codec):
         self.work_dir = work_dir
 
-        print "I am mapper", mapper_id, ", and I'm mapping", len(inputs), "inputs"
+        print "I am mapper", mapper_id, ", and I'm taking inputs from a queue of", len(inputs)
         output_file = os.path.join(work_dir, "mapper_" + str(mapper_id))
         mapfunc = getattr(module, 'map', None)
-        context = Context(output_file, partition_count)
+        # Combine map output before writing it out, if the job supports it.
+        combinefunc = getattr(module, 'combine', None)
+        # Let the job decide which reducer gets each key, if it wants to.
+        partitionfunc = getattr(module, 'partition', None)
+        context = Context(output_file, partition_count, spill_bytes,
+                          combinefunc, partitionfunc, codec)
         if not callable(mapfunc):
             print "No map function!!!"
             sys.exit(1)
 
-        # TODO: Stream/decompress the files directly.
-        for input_file in inputs:
-            try:
-                handle = self.open_input_file(input_file)
-            except:
-                print "Error opening", input_file.name, "(skipping)"
-                traceback.print_exc(file=sys.stderr)
+        start = datetime.now()
+        input_count = 0
+        input_bytes = 0
+        record_count = 0
+        for input_file, local_file, handle, err in fetcher.open_inputs(inputs, reader):
+            if err is not None:
+                print "Error opening", input_file.name, "(skipping):", err
                 continue
-            line_num = 0
-            for line in handle:
-                line_num += 1
-                try:
-                    # Remove the trailing EOL character(s) before passing to
-                    # the map function.
-                    key, value = line.rstrip('\r\n').split("\t", 1)
-                    mapfunc(key, input_file.dimensions, value, context)
-                except ValueError, e:
-                    # TODO: increment "bad line" metrics.
-                    print "Bad line:", input_file.name, ":", line_num, e
+            input_count += 1
+            input_bytes += input_file.size
+            record_count += reader.map_input(input_file, handle, mapfunc, context)
             handle.close()
-            if delete_files:
+            if delete_files and local_file is not None:
                 print "Removing", input_file.name
-                os.remove(handle.filename)
+                os.remove(local_file)
         context.finish()
-
-    def open_input_file(self, input_file):
-        filename = input_file.name
-        if input_file.remote:
-            # Read so-called remote files from the local cache. Go on the
-            # assumption that they have already been downloaded.
-            filename = os.path.join(self.work_dir, "cache", input_file.name)
-        return CompressedFile(filename)
+        duration = timer.delta_sec(start)
+        print "Mapper %d mapped %d inputs (%d bytes, %d records) in %.2f " \
+              "seconds (%.2f MB/s, %.0f records/s)" % (mapper_id, input_count,
+                input_bytes, record_count, duration,
+                input_bytes / 1024.0 / 1024.0 / max(duration, 0.001),
+                record_count / max(duration, 0.001))
 
 
 class Collector(dict):
@@ -450,12 +719,13 @@ class Collector(dict):
 
 
 class Reducer:
-    def __init__(self, reducer_id, do_profile, work_dir, module, mapper_count):
+    def __init__(self, reducer_id, do_profile, work_dir, module, mapper_count, codec="zlib"):
         if do_profile:
             profile_out = os.path.join(work_dir, "profile_reducer_" + str(reducer_id))
             pr = cProfile.Profile()
             pr.enable()
 
+        self.codec = codec
         self.run_reducer(reducer_id, work_dir, module, mapper_count)
 
         if do_profile:
@@ -463,6 +733,38 @@ class Reducer:
             pr.dump_stats(profile_out)
 
     COMBINE_SIZE = 50
+    # Maximum number of runs to merge at once. If there are more than this,
+    # merge them in several passes to avoid running out of file handles.
+    MAX_MERGE_FANIN = 256
+
+    @staticmethod
+    def find_runs(work_dir, reducer_id):
+        return glob.glob(os.path.join(work_dir, "mapper_*_%d.*" % reducer_id))
+
+    def merge_runs(self, run_files):
+        # Tag each record with the index of its run so that records with
+        # equal keys never fall back to comparing values.
+        tagged = [ ((sort_key(key), i, key, value) for key, value in read_run(f))
+                   for i, f in enumerate(run_files) ]
+        return heapq.merge(*tagged)
+
+    def merge_passes(self, work_dir, reducer_id, run_files):
+        # Merge groups of runs into bigger (still sorted) runs until there
+        # are few enough to merge in one go.
+        merge_count = 0
+        while len(run_files) > Reducer.MAX_MERGE_FANIN:
+            group = run_files[0:Reducer.MAX_MERGE_FANIN]
+            merged_file = os.path.join(work_dir, "mapper_merged%d_%d.0" % (
+                    merge_count, reducer_id))
+            with RunWriter(merged_file, self.codec) as out:
+                for skey, i, key, value in self.merge_runs(group):
+                    out.write(key, value)
+            for f in group:
+                os.remove(f)
+            run_files = run_files[Reducer.MAX_MERGE_FANIN:] + [merged_file]
+            merge_count += 1
+        return run_files
+
     def run_reducer(self, reducer_id, work_dir, module, mapper_count):
         #print "I am reducer", reducer_id, ", and I'm reducing", mapper_count, "mapped files"
         output_file = os.path.join(work_dir, "reducer_" + str(reducer_id))
@@ -478,29 +780,28 @@ class Reducer:
             print "No reduce function (that's ok). Writing out all the data."
             map_only = True
 
-        collected = Collector(combinefunc, Reducer.COMBINE_SIZE)
-        for i in range(mapper_count):
-            mapper_file = os.path.join(work_dir, "mapper_%d_%d" % (i, reducer_id))
-            # read, group by key, call reducefunc, output
-            input_fd = open(mapper_file, "rb")
-            try:
-                while True:
-                    key, value = marshal.load(input_fd)
-                    if map_only:
-                        # Just write out each row as we see it
-                        context.write(key, value)
-                    else:
-                        collected.collect(key, value)
-            except EOFError:
-                input_fd.close()
-        if not map_only:
-            # invoke the reduce function on each combined output.
-            for k,v in collected.iteritems():
-                reducefunc(k, v, context)
+        run_files = self.merge_passes(work_dir, reducer_id,
+                                      Reducer.find_runs(work_dir, reducer_id))
+        merged = self.merge_runs(run_files)
+        if map_only:
+            # Just write out each row as we see it
+            for skey, i, key, value in merged:
+                context.write(key, value)
+        else:
+            # Runs are sorted by key, so we only need to collect the values
+            # for one key at a time.
+            collected = Collector(combinefunc, Reducer.COMBINE_SIZE)
+            for skey, records in itertools.groupby(merged, lambda r: r[0]):
+                # Use the first key we see for the whole group.
+                skey, i, key, value = records.next()
+                collected.collect(key, value)
+                for skey, i, k, value in records:
+                    collected.collect(key, value)
+                reducefunc(key, collected.pop(key), context)
         context.finish()
 
 
-def main():
+def main(job_class=Job):
     parser = argparse.ArgumentParser(description='Run a MapReduce Job.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("job_script", help="The MapReduce script to run")
     parser.add_argument("-l", "--local-only", help="Only process local files (exclude S3 data)", action="store_true")
@@ -517,6 +818,9 @@ def main():
     parser.add_argument("-v", "--verbose", help="Print verbose output", action="store_true")
     parser.add_argument("-X", "--delete-data", help="Delete raw data files after mapping", action="store_true")
     parser.add_argument("-p", "--profile", help="Profile mappers and reducers using cProfile", action="store_true")
+    parser.add_argument("--stream", help="Stream remote files from S3 instead of saving them in the local cache", action="store_true")
+    parser.add_argument("--spill-mb", metavar="N", help="Sort map output and spill it to disk every N MB (per mapper)", type=int, default=128)
+    parser.add_argument("--shuffle-compression", help="Compression to use for intermediate map output", choices=BLOCK_CODECS, default="zlib")
     args = parser.parse_args()
 
     if not args.local_only:
@@ -533,7 +837,7 @@ def main():
                 return -1
 
     args = args.__dict__
-    job = Job(args)
+    job = job_class(args)
     start = datetime.now()
     exit_code = 0
     try:
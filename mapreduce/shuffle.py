@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Intermediate data format used between Mappers and Reducers.
+
+Map output is written in sorted "runs". A run file starts with a short magic
+string, followed by any number of frames. Each frame is a header of:
+    1 byte codec id, 4 byte uncompressed length, 4 byte compressed length
+(big-endian) followed by the compressed, pickled list of (key, value) records
+in that frame. Batching records into frames lets us serialize and compress
+them in bulk, which is much faster than handling them one at a time, and
+pickle (unlike marshal) is readable by any version of Python.
+"""
+
+import cPickle as pickle
+import cStringIO
+import itertools
+import struct
+import zlib
+from telemetry.util.compress import BLOCK_CODECS, compress_block, \
+        decompress_block
+
+RUN_MAGIC = "TMRRUN1\n"
+FRAME_HEADER = struct.Struct(">BII")
+PICKLE_PROTOCOL = 2
+
+
+def sort_key(key):
+    """Return a version of `key` that can be safely ordered against any other.
+
+    Python 2 compares str and unicode by value but everything else by type
+    name, so a mix of str, unicode and tuple keys has no consistent ordering.
+    Encoding unicode (including inside tuples) as UTF-8 fixes that, and keys
+    that compare equal as map output keys still sort together.
+    """
+    if isinstance(key, unicode):
+        return key.encode("utf-8")
+    if isinstance(key, tuple):
+        return tuple([sort_key(k) for k in key])
+    return key
+
+
+def stable_key(key):
+    """Return a byte string that is the same for any two equal keys.
+
+    Unlike hash(), this does not depend on the Python version or platform,
+    and spreads out tuples of similar strings well when fed to crc32.
+    """
+    if isinstance(key, str):
+        return key
+    if isinstance(key, unicode):
+        return key.encode("utf-8")
+    if isinstance(key, (int, long)):
+        return "%d" % key
+    if isinstance(key, float) and key.is_integer():
+        # 1.0 == 1, so they must land in the same partition.
+        return "%d" % key
+    if isinstance(key, tuple):
+        return "(" + "\x1f".join([stable_key(k) for k in key]) + ")"
+    return repr(key)
+
+
+def default_partition(key, partition_count):
+    return (zlib.crc32(stable_key(key)) & 0xffffffff) % partition_count
+
+
+class RunWriter:
+    """Write (key, value) records to a run file in compressed frames.
+
+    The number of records per frame is adjusted as we go so that frames stay
+    close to `TARGET_FRAME_BYTES` regardless of how big the records are.
+    """
+    TARGET_FRAME_BYTES = 1024 * 1024
+    MAX_FRAME_RECORDS = 65536
+
+    def __init__(self, filename, codec="zlib"):
+        if codec not in BLOCK_CODECS:
+            raise ValueError("Unknown block codec: '{}'".format(codec))
+        self._codec = codec
+        self._codec_id = BLOCK_CODECS.index(codec)
+        self._records = []
+        self._frame_records = 256
+        self._out = open(filename, "wb")
+        self._out.write(RUN_MAGIC)
+        self.bytes_written = len(RUN_MAGIC)
+
+    def write(self, key, value):
+        self._records.append((key, value))
+        if len(self._records) >= self._frame_records:
+            self.flush()
+
+    def write_many(self, records):
+        """Write a list of (key, value) tuples.
+
+        This is much faster than calling write() for each record.
+        """
+        self.flush()
+        pos = 0
+        while len(records) - pos >= self._frame_records:
+            end = pos + self._frame_records
+            self.write_frame(records[pos:end])
+            pos = end
+        self._records = records[pos:]
+
+    def flush(self):
+        if self._records:
+            self.write_frame(self._records)
+            self._records = []
+
+    def write_frame(self, records):
+        buf = cStringIO.StringIO()
+        pickler = pickle.Pickler(buf, PICKLE_PROTOCOL)
+        # Map output can't contain cycles, so skip pickle's bookkeeping for
+        # shared references. This makes pickling much faster.
+        pickler.fast = True
+        pickler.dump(records)
+        data = buf.getvalue()
+        if len(data) > RunWriter.TARGET_FRAME_BYTES:
+            self._frame_records = max(1, self._frame_records / 2)
+        elif len(data) < RunWriter.TARGET_FRAME_BYTES / 2:
+            self._frame_records = min(RunWriter.MAX_FRAME_RECORDS,
+                                      self._frame_records * 2)
+        compressed = compress_block(data, self._codec)
+        self._out.write(FRAME_HEADER.pack(self._codec_id, len(data),
+                                          len(compressed)))
+        self._out.write(compressed)
+        self.bytes_written += FRAME_HEADER.size + len(compressed)
+
+    def close(self):
+        self.flush()
+        self._out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_frames(filename):
+    """Yield the list of (key, value) records in each frame of a run file."""
+    with open(filename, "rb") as run:
+        if run.read(len(RUN_MAGIC)) != RUN_MAGIC:
+            raise ValueError("Not a run file: {}".format(filename))
+        while True:
+            header = run.read(FRAME_HEADER.size)
+            if header == "":
+                break
+            if len(header) != FRAME_HEADER.size:
+                raise ValueError("Truncated frame header in {}".format(filename))
+            codec_id, raw_length, length = FRAME_HEADER.unpack(header)
+            if codec_id >= len(BLOCK_CODECS):
+                raise ValueError("Unknown codec id {} in {}".format(codec_id,
+                                                                   filename))
+            compressed = run.read(length)
+            if len(compressed) != length:
+                raise ValueError("Truncated frame in {}".format(filename))
+            data = decompress_block(compressed, BLOCK_CODECS[codec_id])
+            if len(data) != raw_length:
+                raise ValueError("Corrupt frame in {}".format(filename))
+            yield pickle.loads(data)
+
+
+def read_run(filename):
+    """Return an iterator over the (key, value) records in a run file."""
+    return itertools.chain.from_iterable(read_frames(filename))
@@ -45,6 +45,9 @@ def safe_key(pieces):
     # remove the trailing EOL chars:
     return unicode(output.getvalue().strip().translate(eol_trans_table))
 
+# Only decode the parts of each message that we use.
+heka_fields = ["application", "payload.slowSQL"]
+
 def map(k, v, cx):
     submission_date = v["meta"].get("submissionDate", None)
     appName = v["application"].get("name", None)
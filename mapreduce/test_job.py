@@ -0,0 +1,52 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest
+from mapreduce.job import Job, InputFetcher, InputQueue
+
+class FakeReader:
+    def open(self, input_file, source):
+        return source
+
+class TestInputFetcher(unittest.TestCase):
+    def get_inputs(self, count):
+        return [Job.MapperInput(remote=False, name="input_%d" % i, size=i,
+                                dimensions=[]) for i in range(count)]
+
+    def test_claims_one_ahead(self):
+        queue = InputQueue(self.get_inputs(5))
+        claimed = []
+        def claim():
+            for input_file in queue:
+                claimed.append(input_file.name)
+                yield input_file
+        fetcher = InputFetcher("/tmp/test_telemetry_job")
+        opened = []
+        for input_file, local_file, handle, err in fetcher.open_inputs(
+                claim(), FakeReader()):
+            self.assertIsNone(err)
+            self.assertEqual(input_file.name, handle)
+            opened.append(handle)
+            # Give the prefetcher time to claim more than it should.
+            time.sleep(0.05)
+            self.assertEqual(opened, claimed[0:len(opened)])
+            self.assertTrue(len(claimed) <= len(opened) + 1)
+        # Largest first.
+        self.assertEqual(["input_%d" % i for i in range(4, -1, -1)], opened)
+
+    def test_shared_queue(self):
+        # Inputs one Mapper hasn't claimed are left for the others.
+        queue = InputQueue(self.get_inputs(5))
+        fetcher = InputFetcher("/tmp/test_telemetry_job")
+        first = fetcher.open_inputs(queue, FakeReader())
+        self.assertEqual("input_4", next(first)[0].name)
+        time.sleep(0.05)
+        rest = [i[0].name for i in fetcher.open_inputs(queue, FakeReader())]
+        self.assertEqual(["input_2", "input_1", "input_0"], rest)
+        self.assertEqual(["input_3"], [i[0].name for i in first])
+
+
+if __name__ == "__main__":
+    unittest.main()
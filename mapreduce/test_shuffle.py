@@ -0,0 +1,140 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import imp
+import os
+import shutil
+import unittest
+from mapreduce.job import Context, Reducer
+from mapreduce.shuffle import RunWriter, read_run, default_partition
+from telemetry.util.compress import BLOCK_CODECS, block_codec_available
+
+def reduce_sum(key, values, context):
+    context.write(key, sum(values))
+
+def combine_sum(key, values, collector):
+    collector.write(key, sum(values))
+
+def combine_nonzero(key, values, collector):
+    total = sum(values)
+    if total == 0:
+        del collector[key]
+    else:
+        collector.write(key, total)
+
+class TestShuffle(unittest.TestCase):
+    def setUp(self):
+        test_dir = self.get_test_dir()
+        assert not os.path.exists(test_dir)
+        os.makedirs(test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.get_test_dir())
+
+    def get_test_dir(self):
+        return "/tmp/test_telemetry_shuffle"
+
+    def get_records(self):
+        return [("a", 1), (u"b", [2, "x"]), (("c", 3), {"d": 4.5}),
+                (5, None), ("e" * 5000, "f" * 100000)]
+
+    def get_module(self, combine=False):
+        module = imp.new_module("test_job")
+        module.reduce = reduce_sum
+        if combine:
+            module.combine = combine_sum
+        return module
+
+    def map_runs(self, mapper_id, records, runs, combine=None):
+        """Write `records` as `runs` runs for one reducer, like a Mapper."""
+        context = Context(os.path.join(self.get_test_dir(),
+                "mapper_%d" % mapper_id), 1, combine_func=combine)
+        for i, (key, value) in enumerate(records):
+            context.write(key, value)
+            if (i + 1) % (len(records) / runs) == 0:
+                context.spill()
+        context.finish()
+
+    def reduce(self, module):
+        Reducer(0, False, self.get_test_dir(), module, 1)
+        with open(os.path.join(self.get_test_dir(), "reducer_0")) as f:
+            return f.read().splitlines()
+
+    def test_run_round_trip(self):
+        for codec in BLOCK_CODECS:
+            if not block_codec_available(codec):
+                continue
+            filename = os.path.join(self.get_test_dir(), "run." + codec)
+            with RunWriter(filename, codec) as out:
+                out.write_many(self.get_records()[0:2])
+                for key, value in self.get_records()[2:]:
+                    out.write(key, value)
+            self.assertEqual(self.get_records(), list(read_run(filename)))
+
+    def test_bad_run(self):
+        filename = os.path.join(self.get_test_dir(), "run.zlib")
+        with RunWriter(filename) as out:
+            out.write_many(self.get_records())
+        with open(filename, "rb") as f:
+            data = f.read()
+        with open(filename, "wb") as f:
+            f.write(data[0:-10])
+        with self.assertRaises(ValueError):
+            list(read_run(filename))
+
+    def test_merge_passes(self):
+        records = [("k%d" % (i % 7), i) for i in range(100)]
+        self.map_runs(0, records, 10)
+        self.assertEqual(10, len(Reducer.find_runs(self.get_test_dir(), 0)))
+        saved = Reducer.MAX_MERGE_FANIN
+        Reducer.MAX_MERGE_FANIN = 3
+        try:
+            output = self.reduce(self.get_module())
+        finally:
+            Reducer.MAX_MERGE_FANIN = saved
+        expected = ["k%d\t%d" % (k, sum(range(k, 100, 7))) for k in range(7)]
+        self.assertEqual(expected, output)
+        # Intermediate runs are cleaned up as they are merged.
+        self.assertTrue(len(Reducer.find_runs(self.get_test_dir(), 0)) <= 3)
+
+    def test_combine(self):
+        records = [(("k", i % 5), i) for i in range(1000)]
+        self.map_runs(0, records, 4)
+        uncombined = self.reduce(self.get_module())
+        shutil.rmtree(self.get_test_dir())
+        os.makedirs(self.get_test_dir())
+        self.map_runs(0, records, 4, combine=combine_sum)
+        # Combining leaves one record per key in each run.
+        runs = Reducer.find_runs(self.get_test_dir(), 0)
+        self.assertEqual(20, sum([len(list(read_run(r))) for r in runs]))
+        self.assertEqual(uncombined, self.reduce(self.get_module(True)))
+
+    def test_combine_drops_key(self):
+        # Combining removes the keys whose values cancel out, both while
+        # collecting and when spilling.
+        records = []
+        for i in range(120):
+            records += [("zero", 1), ("zero", -1), ("one", 1)]
+        records.append(("zero", 0))
+        self.map_runs(0, records, 1, combine=combine_nonzero)
+        self.assertEqual(["one\t120"], self.reduce(self.get_module()))
+
+    def test_default_partition(self):
+        # These must not change, or reducers would disagree with mappers
+        # from other versions about where keys go.
+        self.assertEqual(default_partition("abc", 16),
+                         default_partition(u"abc", 16))
+        self.assertEqual(default_partition(1, 16), default_partition(1L, 16))
+        self.assertEqual(default_partition(1, 16), default_partition(1.0, 16))
+        self.assertEqual(default_partition(("a", 1), 16),
+                         default_partition((u"a", 1.0), 16))
+        self.assertEqual([2, 7, 13, 14],
+                         [default_partition(k, 16) for k in
+                          ["abc", 1, ("a", 1), u"\xe9"]])
+        for key in ["abc", 1, ("a", 1), u"\xe9"]:
+            self.assertTrue(0 <= default_partition(key, 3) < 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
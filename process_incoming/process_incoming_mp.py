@@ -15,63 +15,51 @@ import sys
 import os
 from datetime import date, datetime
 from telemetry.telemetry_schema import TelemetrySchema
-import subprocess
 from subprocess import Popen
 from boto.s3.connection import S3Connection
 from boto.exception import S3ResponseError
 import telemetry.util.timer as timer
 import telemetry.util.files as fileutil
+import telemetry.util.s3 as s3util
 from telemetry.convert import Converter, BadPayloadError
 from telemetry.revision_cache import RevisionCache
 from telemetry.persist import StorageLayout
 import boto.sqs
 import traceback
 
-S3FUNNEL_PATH = "/usr/local/bin/s3funnel"
+# Number of files to upload or download at once.
+NUM_TRANSFERS = 8
 def fetch_s3_files(incoming_files, fetch_cwd, bucket, aws_key, aws_secret_key):
     result = 0
     if len(incoming_files) > 0:
         if not os.path.isdir(fetch_cwd):
             os.makedirs(fetch_cwd)
 
-        files = []
+        # Get the size and checksum of every file from the bucket listing,
+        # rather than asking for each one separately.
+        keys = s3util.list_keys(bucket, incoming_files)
+        transfers = s3util.TransferPool(bucket.name, aws_key, aws_secret_key,
+                num_transfers=NUM_TRANSFERS)
+        start = datetime.now()
         for f in incoming_files:
-            full_filename = os.path.join(fetch_cwd, f)
-            if os.path.isfile(full_filename):
-                md5, size = fileutil.md5file(full_filename)
-                # f is the key name - it does not include the full path to the
-                # data dir.
-                key = bucket.get_key(f)
-                # Strip quotes from md5
-                remote_md5 = key.etag[1:-1]
-                if md5 != remote_md5:
-                    files.append(f)
-                else:
-                    print "Already downloaded", f
+            key = keys.get(f)
+            if key is None:
+                print "ERROR: could not find", f, "in bucket", bucket.name
+                result = -1
+                continue
+            # Files that were already downloaded are checked and skipped.
+            transfers.get(f, os.path.join(fetch_cwd, f), key)
+        downloaded_bytes = 0
+        for local, remote, err, size, sec in transfers.results():
+            if err is None:
+                downloaded_bytes += size
             else:
-                files.append(f)
-        fetch_cmd = [S3FUNNEL_PATH]
-        fetch_cmd.append(bucket.name)
-        fetch_cmd.append("get")
-        fetch_cmd.append("-a")
-        fetch_cmd.append(aws_key)
-        fetch_cmd.append("-s")
-        fetch_cmd.append(aws_secret_key)
-        fetch_cmd.append("-t")
-        fetch_cmd.append("8")
-        # Fetch in batches of 8 files at a time
-        while len(files) > 0:
-            current_files = files[0:8]
-            files = files[8:]
-            start = datetime.now()
-            result = subprocess.call(fetch_cmd + current_files, cwd=fetch_cwd)
-            duration_sec = timer.delta_sec(start)
-            # TODO: verify MD5s
-            downloaded_bytes = sum([ os.path.getsize(os.path.join(fetch_cwd, f)) for f in current_files ])
-            downloaded_mb = downloaded_bytes / 1024.0 / 1024.0
-            print "Downloaded %.2fMB in %.2fs (%.2fMB/s)" % (downloaded_mb, duration_sec, downloaded_mb / duration_sec)
-            if result != 0:
-                break
+                print "ERROR:", err
+                result = -1
+        transfers.close()
+        duration_sec = timer.delta_sec(start)
+        downloaded_mb = downloaded_bytes / 1024.0 / 1024.0
+        print "Downloaded %.2fMB in %.2fs (%.2fMB/s)" % (downloaded_mb, duration_sec, downloaded_mb / duration_sec)
     return result
 
 def wait_for(processes, label):
@@ -322,7 +310,6 @@ class CompressCompletedStep(PipeStep):
 class ExportCompressedStep(PipeStep):
     def __init__(self, num, name, q_in, base_dir, key, skey, bucket, dry_run):
         self.dry_run = dry_run
-        self.batch_size = 8
         self.retries = 10
         self.base_dir = base_dir
         self.aws_key = key
@@ -331,61 +318,43 @@ class ExportCompressedStep(PipeStep):
         PipeStep.__init__(self, num, name, q_in)
 
     def setup(self):
-        self.batch = []
-        self.s3f_cmd = [S3FUNNEL_PATH, self.aws_bucket_name, "put",
-                "-a", self.aws_key, "-s", self.aws_secret_key, "-t",
-                str(self.batch_size), "--put-only-new", "--put-full-path"]
+        self.attempts = {}
         if self.dry_run:
-            self.conn = None
-            self.bucket = None
+            self.transfers = None
             return
-        self.conn = S3Connection(self.aws_key, self.aws_secret_key)
-        self.bucket = self.conn.get_bucket(self.aws_bucket_name)
-
-    def export_batch(self, data_dir, conn, bucket, files):
-        print self.label, "Uploading", ",".join(files)
-        if self.dry_run:
-            return 0
-
-        # Time the s3funnel call:
-        start = datetime.now()
-        result = subprocess.call(self.s3f_cmd + files, cwd=data_dir)
-        sec = timer.delta_sec(start)
-
-        total_size = 0
-        if result == 0:
-            # Success! Verify each file's checksum, then truncate it.
-            for f in files:
-                # Verify checksum and track cumulative size so we can figure out MB/s
-                full_filename = os.path.join(data_dir, f)
-                md5, size = fileutil.md5file(full_filename)
-                total_size += size
-                # f is the key name - it does not include the full path to the
-                # data dir.
-                key = bucket.get_key(f)
-                # Strip quotes from md5
-                remote_md5 = key.etag[1:-1]
-                if md5 != remote_md5:
-                    # TODO: add it to a "failed" queue.
-                    print "ERROR: %s failed checksum verification: Local=%s, Remote=%s" % (f, md5, remote_md5)
-                    self.bad_records += 1
-                    result = -1
-                # TODO: else add it to a "succeeded" queue and remove it locally.
-        else:
-            print "Failed to upload one or more files in the current batch. Error code was", result
-
-        total_mb = float(total_size) / 1024.0 / 1024.0
-        print "Transferred %.2fMB in %.2fs (%.2fMB/s)" % (total_mb, sec, total_mb / sec)
-        return result
-
-    def retry_export_batch(self, data_dir, conn, bucket, files):
-        success = False
-        for i in range(self.retries):
-            batch_response = self.export_batch(self.base_dir, self.conn, self.bucket, self.batch)
-            if batch_response == 0:
-                success = True
-                break
-        return success
+        self.transfers = s3util.TransferPool(self.aws_bucket_name,
+                self.aws_key, self.aws_secret_key, num_transfers=NUM_TRANSFERS)
+
+    def export(self, stripped_name):
+        self.attempts[stripped_name] = self.attempts.get(stripped_name, 0) + 1
+        # Never overwrite published files.
+        self.transfers.put(os.path.join(self.base_dir, stripped_name),
+                stripped_name, only_new=True)
+
+    def check_exports(self, wait=False):
+        # Uploads are checked against the ETag S3 returns for them, so
+        # there's no need to look the keys up again.
+        for local, remote, err, size, sec in self.transfers.results(wait):
+            if err is None:
+                mb = size / 1024.0 / 1024.0
+                print self.label, "Uploaded %s: %.2fMB in %.2fs (%.2fMB/s)" % (remote, mb, sec, s3util.mb_per_sec(size, sec))
+                del self.attempts[remote]
+                self.records_written += 1
+                self.bytes_written += size
+                # Delete local files once they've been uploaded successfully.
+                try:
+                    os.remove(local)
+                    print self.label, "Removed uploaded file", remote
+                except Exception, e:
+                    print self.label, "Failed to remove uploaded file", remote
+            elif self.attempts[remote] < self.retries:
+                print self.label, "Retrying upload of", remote
+                self.export(remote)
+            else:
+                # TODO: add it to a "failed" queue.
+                print self.label, "ERROR: failed to upload", remote, err
+                del self.attempts[remote]
+                self.bad_records += 1
 
     def strip_data_dir(self, data_dir, full_file):
         if full_file.startswith(data_dir):
@@ -404,31 +373,19 @@ class ExportCompressedStep(PipeStep):
         except Exception, e:
             print self.label, "Warning: couldn't strip base dir from", record, e
             stripped_name = record
-        self.batch.append(stripped_name)
-        if len(self.batch) >= self.batch_size:
-            success = self.retry_export_batch(self.base_dir, self.conn, self.bucket, self.batch)
-            if success:
-                # Delete local files once they've been uploaded successfully.
-                if not self.dry_run:
-                    for b in self.batch:
-                        try:
-                            os.remove(os.path.join(self.base_dir, b))
-                            print self.label, "Removed uploaded file", b
-                        except Exception, e:
-                            print self.label, "Failed to remove uploaded file", b
-                self.batch = []
-            else:
-                print self.label, "ERROR: failed to upload a batch:", ",".join(self.batch)
-                # TODO: add to a "failures" queue, save them or something?
+        print self.label, "Uploading", stripped_name
+        if self.dry_run:
+            return
+        self.export(stripped_name)
+        self.check_exports()
 
     def finish(self):
-        if len(self.batch) > 0:
-            print "Sending last batch of", len(self.batch)
-            success = self.retry_export_batch(self.base_dir, self.conn, self.bucket, self.batch)
-            if not success:
-                print self.label, "ERROR: failed to upload a batch:", ",".join(self.batch)
-                # TODO: add to a "failures" queue, save them or something?
-        self.dump_stats()
+        if self.transfers is not None:
+            self.check_exports(wait=True)
+            self.transfers.close()
+            self.end_time = datetime.now()
+        PipeStep.finish(self)
+
 
 def start_workers(count, name, clazz, q_in, more_args):
     workers = []
@@ -461,11 +418,6 @@ def main():
     parser.add_argument("-C", "--skip-conversion", help="Skip validation/conversion of payloads", action="store_true")
     args = parser.parse_args()
 
-    if not os.path.isfile(S3FUNNEL_PATH):
-        print "ERROR: s3funnel not found at", S3FUNNEL_PATH
-        print "You can get it from github: https://github.com/sstoiana/s3funnel"
-        return -1
-
     if not os.path.isdir(args.output_dir):
         os.makedirs(args.output_dir)
 
@@ -558,7 +510,7 @@ def main():
                 incoming_bucket, args.aws_key, args.aws_secret_key)
 
     if result != 0:
-        print "Error downloading files. Return code of s3funnel was", result
+        print "Error downloading files."
         return result
     print "Done"
 
@@ -9,9 +9,11 @@ import argparse
 import logging
 import multiprocessing
 import io
+import math
 import os
 import Queue as Q
 import re
+import resource
 import signal
 import simplejson as json
 import subprocess
@@ -68,6 +70,37 @@ def start_workers(logger, count, name, clazz, q_in, more_args):
     logger.log("{0}s all started".format(name))
     return workers
 
+# Don't bother splitting raw files into pieces smaller than this.
+MIN_SPLIT_BYTES = 32 * 1024 * 1024
+
+# Split raw files into pieces at record boundaries, so that all the readers
+# have something to do even when there are fewer files than readers. Returns
+# a list of (filename, file version, start offset, end offset).
+def split_raw_files(logger, filenames, num_readers):
+    sizes = {}
+    for f in filenames:
+        try:
+            sizes[f] = os.path.getsize(f)
+        except OSError:
+            sizes[f] = 0
+    total_size = max(sum(sizes.values()), 1)
+    pieces = []
+    for f in filenames:
+        # Give each file a share of the readers based on its size.
+        parts = int(math.ceil(num_readers * sizes[f] / float(total_size)))
+        try:
+            file_version = fileutil.detect_file_version(f, simple_detection=True)
+            ranges = fileutil.split_file(f, file_version, parts, MIN_SPLIT_BYTES)
+        except Exception, e:
+            # Let the reader deal with (and report) it.
+            logger.log("Not splitting {0}: {1}".format(f, e))
+            pieces.append(f)
+            continue
+        logger.log("Split {0} ({1} version {2}) into {3} pieces".format(f,
+                   sizes[f], file_version, len(ranges)))
+        pieces.extend([(f, file_version, s, e) for s, e in ranges])
+    return pieces
+
 # Insert the required number of sentinel values to signal subprocesses that
 # there is no more data.
 def finish_queue(queue, num_procs):
@@ -81,6 +114,16 @@ def datetime_to_json(d):
 # Use UTC dates throughout for consistency.
 now = datetime.utcnow
 
+# Resident memory of the current process in bytes, or the peak if the current
+# value isn't available.
+def get_rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
 # Convert a timestamp (in milliseconds) to a YYYYMMDD string
 def ts_to_yyyymmdd(ts):
     # Incoming timestamps are in milliseconds, so convert to POSIX first
@@ -91,11 +134,18 @@ class InterruptProcessingError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
-# Convert OS Signal to an exception
+# Number of SIGINTs received. The first one asks the pipeline to finish what
+# it's doing and stop, the next one stops it right away.
+sigint_count = 0
+
+# Count SIGINTs, and convert all but the first to an exception
 def handle_sigint(signum, frame):
+    global sigint_count
     print "Caught signal", str(signum), "in pid", os.getpid()
     if signum == signal.SIGINT:
-        raise InterruptProcessingError("It's quittin' time")
+        sigint_count += 1
+        if sigint_count > 1:
+            raise InterruptProcessingError("It's quittin' time")
 
 # Output labeled log messages
 class Log(object):
@@ -197,12 +247,79 @@ class Stats(object):
         if update_end_time:
             self.update_end_time()
 
+    def increment_counters(self, prefix, counters):
+        """Add each of `counters` to the overall stats as prefix.name."""
+        for name, value in counters.iteritems():
+            self.overall["{}.{}".format(prefix, name)] += value
+
+    def set_value(self, name, value):
+        """Set a gauge (such as memory use) in the overall stats."""
+        self.overall[name] = value
+
+
+# Per-record counters, cheap enough to update for every record. Each channel
+# gets a fixed list of slots, and nothing else (like the time) is looked at
+# until they are added to a Stats object.
+class Counters(object):
+    RECORDS_READ, RECORDS_WRITTEN, BYTES_READ, BYTES_UNCOMPRESSED, \
+            BYTES_WRITTEN = range(5)
+    NAMES = ("records_read", "records_written", "bytes_read",
+             "bytes_uncompressed", "bytes_written")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # channel (None if unknown) -> slots
+        self.channels = {}
+        # (channel, bad record type) -> count
+        self.bad_records = defaultdict(int)
+
+    def get_slots(self, channel):
+        slots = self.channels.get(channel)
+        if slots is None:
+            slots = self.channels[channel] = [0] * len(Counters.NAMES)
+        return slots
+
+    def read(self, channel, bytes_read, bytes_uncompressed):
+        slots = self.get_slots(channel)
+        slots[Counters.RECORDS_READ] += 1
+        slots[Counters.BYTES_READ] += bytes_read
+        slots[Counters.BYTES_UNCOMPRESSED] += bytes_uncompressed
+
+    def written(self, channel, bytes_written):
+        slots = self.get_slots(channel)
+        slots[Counters.RECORDS_WRITTEN] += 1
+        slots[Counters.BYTES_WRITTEN] += bytes_written
+
+    def bad(self, channel, bad_record_type):
+        self.bad_records[(channel, bad_record_type)] += 1
+
+    def add_to(self, stats):
+        """Add the counts to `stats`, and start counting from zero."""
+        for channel, slots in self.channels.iteritems():
+            stats.increment(channel=channel, update_end_time=False,
+                    **dict(zip(Counters.NAMES, slots)))
+        for (channel, bad_record_type), count in self.bad_records.iteritems():
+            stats.increment(channel=channel, bad_records=count,
+                    bad_record_type=bad_record_type, update_end_time=False)
+        self.reset()
+
+
+# Marks the end of a batch of raw files in the readers' queue. See Pipeline.
+class BatchEnd(object):
+    def __init__(self, batch_id):
+        self.batch_id = batch_id
+
 
 # Base class for pipline workers
 class PipeStep(object):
     SENTINEL = 'STOP'
     def __init__(self, num, name, q_in, q_out=None, log_file=None,
             stats_file=None):
+        # The master process decides when to stop, and tells us by sending
+        # SENTINEL.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
         self.print_stats = True
         self.num = num
         self.label = " ".join((name, str(num)))
@@ -229,6 +346,9 @@ class PipeStep(object):
     def handle(self, record):
         pass
 
+    def end_batch(self, marker):
+        pass
+
     def work(self):
         self.log("Starting up")
         while True:
@@ -236,6 +356,9 @@ class PipeStep(object):
                 raw = self.q_in.get()
                 if raw == PipeStep.SENTINEL:
                     break
+                if isinstance(raw, BatchEnd):
+                    self.end_batch(raw)
+                    continue
                 self.stats.reset()
                 self.handle(raw)
                 self.stats.update_end_time()
@@ -253,50 +376,171 @@ class PipeStep(object):
 # Read from raw input files, validate and convert data, save output to disk
 class ReadRawStep(PipeStep):
     UUID_ONLY_PATH = re.compile('^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+    # Check whether it's time to save stats every this many records...
+    STATS_CHECK_RECORDS = 1000
+    # ...and save them if it has been this many seconds.
+    STATS_INTERVAL = 10.0
     def __init__(self, num, name, raw_files, completed_files, log_file,
-            stats_file, schema, converter, storage, bad_filename):
+            stats_file, schema, converter, storage, bad_filename,
+            compressed_files=None, acks=None, resume=None):
+        """Output files are queued as (batch id, filename), to
+        `completed_files` if they need compressing, and to `compressed_files`
+        if they were compressed as they were written.
+
+        At the end of each batch, the reader closes its output, puts
+        (batch id, reader num, number of files queued) on `acks` and waits
+        for a message on `resume[num]`.
+        """
         self.schema = schema
         self.converter = converter
         self.storage = storage
         self.bad_filename = bad_filename
+        self.compressed_files = compressed_files
+        self.acks = acks
+        self.resume = resume
         PipeStep.__init__(self, num, name, raw_files, completed_files,
                 log_file, stats_file)
 
     def setup(self):
         self.expected_dim_count = len(self.schema._dimensions)
-
-    def handle(self, raw_file):
-        self.log("Reading " + raw_file)
+        self.counters = Counters()
+        # Dimension value -> sanitized channel name.
+        self.channels = {}
+        self.channel_dim = None
+        for i, dim in enumerate(self.schema._dimensions):
+            if dim["field_name"] == "appUpdateChannel":
+                self.channel_dim = i
+        # Only count cache activity from here on, not the pre-warming done
+        # before the reader was started.
+        self.cache_stats = {}
+        if self.converter is not None:
+            self.cache_stats = {
+                "histogram_cache": self.converter.get_cache_stats(),
+                "revision_cache": self.converter.get_revision_cache_stats()}
+        self.batch_id = 0
+        self.batch_outputs = 0
+
+    def queue_output(self, queue, filename):
+        queue.put((self.batch_id, filename))
+        self.batch_outputs += 1
+
+    def queue_finished(self):
+        for filename in self.storage.pop_finished():
+            self.queue_output(self.compressed_files, filename)
+
+    def end_batch(self, marker):
+        try:
+            self.storage.close_all()
+        except Exception, e:
+            self.log("Error closing output files: {0}".format(e))
+        self.queue_finished()
+        self.acks.put((marker.batch_id, self.num, self.batch_outputs))
+        self.batch_id = marker.batch_id + 1
+        self.batch_outputs = 0
+        # Wait until all the readers have finished the batch, so we don't
+        # take another reader's marker.
+        self.resume[self.num].get()
+
+    def record_cache_stats(self):
+        # Report cache activity since the last call, and how much memory
+        # this reader is using.
+        self.stats.set_value("rss_bytes", get_rss_bytes())
+        if self.converter is None:
+            return
+        current = {
+            "histogram_cache": self.converter.get_cache_stats(),
+            "revision_cache": self.converter.get_revision_cache_stats()}
+        for prefix, counters in current.iteritems():
+            previous = self.cache_stats.get(prefix, {})
+            delta = {}
+            for name, value in counters.iteritems():
+                if name != "size":
+                    delta[name] = value - previous.get(name, 0)
+            self.stats.increment_counters(prefix, delta)
+            lookups = delta["hits"] + delta["misses"]
+            if lookups > 0:
+                self.stats.set_value(prefix + ".hit_rate",
+                        float(delta["hits"]) / lookups)
+        self.stats.set_value("histogram_cache.size",
+                current["histogram_cache"]["size"])
+        self.cache_stats = current
+
+    def get_channel(self, dims):
+        try:
+            return self.channels[dims[self.channel_dim]]
+        except (KeyError, IndexError, TypeError):
+            pass
+        try:
+            channel = self.schema.get_field(dims, "appUpdateChannel", True,
+                    True)
+        except ValueError, e:
+            return "UNKNOWN"
+        # Dimensions are limited to their allowed values, so there are only
+        # a few of these.
+        if self.channel_dim is not None and self.channel_dim < len(dims):
+            self.channels[dims[self.channel_dim]] = channel
+        return channel
+
+    def add_counters(self):
+        self.counters.add_to(self.stats)
+        self.record_cache_stats()
+        self.stats.update_end_time()
+
+    def save_stats(self):
+        # Save what we have so far. Stats are reset after saving, so that
+        # PipeStep.work only saves what's left at the end of the file.
+        self.add_counters()
+        self.stats.save()
+        if self.print_stats:
+            self.log(self.stats.get_summary())
+        self.stats.reset()
+
+    def handle(self, raw_input):
+        # We get either a filename, or (filename, file version, start, end)
+        # for a piece of a file (see split_raw_files).
+        if isinstance(raw_input, tuple):
+            raw_file, file_version, start_offset, end_offset = raw_input
+            self.log("Reading {0} bytes {1} to {2}".format(raw_file,
+                     start_offset, end_offset))
+        else:
+            raw_file, file_version, start_offset, end_offset = raw_input, None, 0, None
+            self.log("Reading " + raw_file)
         try:
             record_count = 0
             bytes_read = 0
             start = now()
-            file_version = fileutil.detect_file_version(raw_file, simple_detection=True)
-            self.log("Detected version {0} for file {1}".format(file_version,
-                     raw_file))
-            for unpacked in fileutil.unpack(raw_file, file_version=file_version):
+            if file_version is None:
+                file_version = fileutil.detect_file_version(raw_file, simple_detection=True)
+                self.log("Detected version {0} for file {1}".format(file_version,
+                         raw_file))
+            for unpacked in fileutil.unpack(raw_file, file_version=file_version,
+                    start=start_offset, end=end_offset):
                 record_count += 1
                 common_bytes = unpacked.len_path + fileutil.RECORD_PREAMBLE_LENGTH[file_version]
                 current_bytes = common_bytes + unpacked.len_data
                 current_bytes_uncompressed = common_bytes + len(unpacked.data)
                 bytes_read += current_bytes
+                if record_count % ReadRawStep.STATS_CHECK_RECORDS == 0:
+                    this_update = now()
+                    if timer.delta_sec(self.last_update, this_update) > \
+                            ReadRawStep.STATS_INTERVAL:
+                        self.last_update = this_update
+                        self.save_stats()
                 if unpacked.error:
                     self.log("ERROR: Found corrupted data for record {0} in " \
                              "{1} path: {2} Error: {3}".format(record_count,
                                  raw_file, unpacked.path, unpacked.error))
-                    self.stats.increment(records_read=1,
-                            bytes_read=current_bytes,
-                            bytes_uncompressed=current_bytes_uncompressed,
-                            bad_records=1, bad_record_type="corrupted_data")
+                    self.counters.read(None, current_bytes,
+                            current_bytes_uncompressed)
+                    self.counters.bad(None, "corrupted_data")
                     continue
                 if len(unpacked.data) == 0:
                     self.log("WARN: Found empty data for record {0} in " \
                              "{2} path: {2}".format(record_count, raw_file,
                                  unpacked.path))
-                    self.stats.increment(records_read=1,
-                            bytes_read=current_bytes,
-                            bytes_uncompressed=current_bytes_uncompressed,
-                            bad_records=1, bad_record_type="empty_data")
+                    self.counters.read(None, current_bytes,
+                            current_bytes_uncompressed)
+                    self.counters.bad(None, "empty_data")
                     continue
 
                 submission_date = ts_to_yyyymmdd(unpacked.timestamp)
@@ -321,10 +565,9 @@ class ReadRawStep(PipeStep):
                     else:
                         self.log("Found an invalid path in record {0}: " \
                              "{1}".format(record_count, path))
-                    self.stats.increment(records_read=1,
-                            bytes_read=current_bytes,
-                            bytes_uncompressed=current_bytes_uncompressed,
-                            bad_records=1, bad_record_type=bad_record_type)
+                    self.counters.read(None, current_bytes,
+                            current_bytes_uncompressed)
+                    self.counters.bad(None, bad_record_type)
                     continue
 
                 key = path_components.pop(0)
@@ -335,12 +578,9 @@ class ReadRawStep(PipeStep):
                 info["appUpdateChannel"] = path_components.pop(0)
                 info["appBuildID"] = path_components.pop(0)
                 dims = self.schema.dimensions_from(info, submission_date)
-                channel = self.schema.get_field(dims, "appUpdateChannel",
-                        True, True)
-
-                self.stats.increment(channel=channel, records_read=1,
-                        bytes_read=current_bytes,
-                        bytes_uncompressed=current_bytes_uncompressed)
+                channel = self.get_channel(dims)
+                self.counters.read(channel, current_bytes,
+                        current_bytes_uncompressed)
 
                 try:
                     # Convert data:
@@ -366,11 +606,11 @@ class ReadRawStep(PipeStep):
                         # Write to persistent storage
                         n = self.storage.write(key, serialized_data, dims,
                                 data_version)
-                        self.stats.increment(channel=channel, records_written=1,
-                            bytes_written=len(key) + len(serialized_data) + 2)
+                        self.counters.written(channel,
+                                len(key) + len(serialized_data) + 2)
                         # Compress rotated files as we generate them
                         if n.endswith(StorageLayout.PENDING_COMPRESSION_SUFFIX):
-                            self.q_out.put(n)
+                            self.queue_output(self.q_out, n)
                     except Exception, e:
                         self.write_bad_record(key, dims, serialized_data,
                                 str(e), "ERROR Writing to output file:",
@@ -383,8 +623,7 @@ class ReadRawStep(PipeStep):
                     if err_message == "Missing in payload: info.revision":
                         # We don't need to write these bad records out - we know
                         # why they are being skipped.
-                        self.stats.increment(channel=channel, bad_records=1,
-                                bad_record_type="missing_revision")
+                        self.counters.bad(channel, "missing_revision")
                     elif err_message == "Invalid revision URL: /rev/":
                         # We do want to log these payloads, but we don't want
                         # the full stack trace.
@@ -401,13 +640,6 @@ class ReadRawStep(PipeStep):
                                 "Conversion Error", "conversion_error")
                         self.log(traceback.format_exc())
 
-                if self.print_stats:
-                    this_update = now()
-                    sec = timer.delta_sec(self.last_update, this_update)
-                    if sec > 10.0:
-                        self.last_update = this_update
-                        self.log(self.stats.get_summary())
-
             duration = timer.delta_sec(start, now())
             mb_read = bytes_read / 1024.0 / 1024.0
             # Stats for the current file:
@@ -417,17 +649,24 @@ class ReadRawStep(PipeStep):
             # Corrupted data, let's skip this record.
             self.log("Error reading raw data from {0} {1}\n{2}".format(
                     raw_file, e, traceback.format_exc()))
+        self.add_counters()
+        try:
+            self.storage.flush()
+        except Exception, e:
+            self.log("Error flushing output files: {0}".format(e))
+        self.queue_finished()
+
+    def finish(self):
+        try:
+            self.storage.close_all()
+        except Exception, e:
+            self.log("Error closing output files: {0}".format(e))
+        PipeStep.finish(self)
 
 
     def write_bad_record(self, key, dims, data, error, message=None,
             bad_record_type=None):
-        try:
-            channel = self.schema.get_field(dims, "appUpdateChannel", True,
-                    True)
-        except ValueError, e:
-            channel = "UNKNOWN"
-        self.stats.increment(channel=channel, bad_records=1,
-                bad_record_type=bad_record_type)
+        self.counters.bad(self.get_channel(dims), bad_record_type)
         if message is not None:
             self.log("{0} - {1}".format(message, error))
         if self.bad_filename is not None:
@@ -440,14 +679,32 @@ class ReadRawStep(PipeStep):
 
 # Compress completed output files from ReadRawStep
 class CompressCompletedStep(PipeStep):
+    """Compresses (batch id, filename) records from `completed_files`, and
+    queues (batch id, compressed filename) to `compressed_files`. Failures
+    are reported to `results` as (batch id, filename, error)."""
+    def __init__(self, num, name, completed_files, compressed_files, results,
+            log_file, stats_file):
+        self.results = results
+        PipeStep.__init__(self, num, name, completed_files, compressed_files,
+                log_file, stats_file)
+
     def handle(self, record):
-        filename = record
+        batch_id, filename = record
+        try:
+            err = self.compress(batch_id, filename)
+        except Exception, e:
+            err = "Error compressing file {0}: {1}".format(filename, e)
+            self.log(err)
+        if err is not None:
+            self.results.put((batch_id, filename, err))
+
+    def compress(self, batch_id, filename):
         base_ends = filename.find(".log") + 4
         if base_ends < 4:
             self.log("Bad filename encountered, skipping: " + filename)
             self.stats.increment(records_read=1, bad_records=1,
                     bad_record_type="bad_filename")
-            return
+            return "Bad filename"
         basename = filename[0:base_ends]
         # Get a unique name for the compressed file:
         comp_name = basename + "." + uuid.uuid4().hex + StorageLayout.COMPRESSED_SUFFIX
@@ -465,7 +722,12 @@ class CompressCompletedStep(PipeStep):
             self.stats.increment(records_read=1, bad_records=1,
                     bad_record_type="compression_error")
             self.log("Error compressing file {0}: {1}".format(filename, e))
-            return
+            # Put the file back, so it is compressed again the next time the
+            # output dir is scanned.
+            if os.path.exists(comp_name):
+                os.remove(comp_name)
+            os.rename(tmp_name, filename)
+            return str(e)
         raw_bytes = os.stat(tmp_name).st_size
         comp_bytes = os.stat(comp_name).st_size
         raw_mb = float(raw_bytes) / 1024.0 / 1024.0
@@ -480,12 +742,16 @@ class CompressCompletedStep(PipeStep):
         self.log("Compressed %s as %s in %.2fs. Size before: %.2fMB, after:" \
                  " %.2fMB (r: %.2fMB/s, w: %.2fMB/s)" % (filename, comp_name,
                     sec, raw_mb, comp_mb, (raw_mb/sec), (comp_mb/sec)))
+        self.q_out.put((batch_id, comp_name))
 
 
 # Export compressed output files to S3 for long-term storage and analysis
 class ExportCompressedStep(PipeStep):
-    def __init__(self, num, name, q_in, log_file, stats_file,
+    """Uploads (batch id, filename) records from `q_in`, and reports each one
+    to `results` as (batch id, filename, error)."""
+    def __init__(self, num, name, q_in, results, log_file, stats_file,
             base_dir, config, dry_run):
+        self.results = results
         self.dry_run = dry_run
         self.base_dir = base_dir
         self.aws_key = config.get("aws_key", None)
@@ -496,11 +762,15 @@ class ExportCompressedStep(PipeStep):
 
     def setup(self):
         if self.dry_run:
-            self.conn = None
-            self.bucket = None
+            self.transfers = None
             return
-        self.conn = S3Connection(self.aws_key, self.aws_secret_key)
-        self.bucket = self.conn.get_bucket(self.aws_bucket_name)
+        self.transfers = s3util.TransferManager(self.aws_bucket_name,
+                self.aws_key, self.aws_secret_key)
+
+    def finish(self):
+        if self.transfers is not None:
+            self.transfers.close()
+        PipeStep.finish(self)
 
     def strip_data_dir(self, data_dir, full_file):
         if full_file.startswith(data_dir):
@@ -512,6 +782,15 @@ class ExportCompressedStep(PipeStep):
             raise ValueError("Invalid full filename: " + str(full_file))
 
     def handle(self, record):
+        batch_id, record = record
+        try:
+            err = self.export(record)
+        except Exception, e:
+            err = "Error exporting {0}: {1}".format(record, e)
+            self.log(err)
+        self.results.put((batch_id, record, err))
+
+    def export(self, record):
         try:
             # Remove the output dir prefix from filenames
             stripped_name = self.strip_data_dir(self.base_dir, record)
@@ -521,19 +800,19 @@ class ExportCompressedStep(PipeStep):
             stripped_name = record
 
         self.log("Uploading {0}".format(stripped_name))
-        start = now()
+        current_size = os.path.getsize(record)
         if self.dry_run:
-            local_filename = record
-            remote_filename = stripped_name
             err = None
+            sec = 0
         else:
-            local_filename, remote_filename, err = s3util.upload_one([
-                    self.base_dir, self.bucket, stripped_name])
-        sec = timer.delta_sec(start, now())
-        current_size = os.path.getsize(record)
+            err, current_size, sec = self.transfers.upload(record,
+                    stripped_name)
         self.stats.increment(records_read=1, bytes_read=current_size)
         if err is None:
             # Everything went well.
+            self.log("Uploaded {0}: {1:.2f}MB in {2:.2f}s ({3:.2f}MB/s)".format(
+                    stripped_name, current_size / 1024.0 / 1024.0, sec,
+                    s3util.mb_per_sec(current_size, sec)))
             self.stats.increment(records_written=1, bytes_written=current_size)
             # Delete local files once they've been uploaded successfully.
             if not self.dry_run:
@@ -548,6 +827,415 @@ class ExportCompressedStep(PipeStep):
                     err))
             self.stats.increment(bad_records=1)
             # TODO: add to a "failures" queue, save them or something?
+        return err
+
+
+class Batch(object):
+    """A set of incoming files that are processed and committed together."""
+    def __init__(self, batch_id, filenames, messages):
+        self.batch_id = batch_id
+        self.filenames = filenames
+        # Remote filename -> list of SQS messages for it.
+        self.messages = messages
+        self.start = now()
+        self.downloading = 0
+        self.downloaded_bytes = 0
+        self.read = []
+        self.failed = []
+        # Number of readers that have finished the batch.
+        self.acks = 0
+        self.closed = False
+        # Number of output files holding the batch's records, and how many
+        # of them have been exported (or failed).
+        self.outputs = 0
+        self.exported = 0
+        self.errors = 0
+
+
+class Pipeline(object):
+    """Runs batches of incoming files through long-lived worker processes.
+
+    Readers start on each file as soon as it has been downloaded, and the
+    next batch is fetched and downloaded while the current one is still
+    being read, compressed and exported. At the end of a batch, every reader
+    closes its output (see BatchEnd) and the files still being written are
+    rotated, so each output file only holds records from one batch. A batch
+    is committed (its files deleted from S3 and its messages from SQS) once
+    all of its output files have been exported. If any of them fail, the
+    batch is left to be processed again.
+
+    Output files that weren't exported (or compressed), whether by this run
+    or an earlier one, are picked up by a scan of the output dir at startup
+    and every ORPHAN_SCAN_INTERVAL seconds after that. Scans run alongside
+    the batches, so they skip files modified since the oldest batch in
+    progress started (those may still be queued by it), and a scan waits
+    until the files found by the one before have been exported.
+    """
+    # Fetch the next batch when fewer than this many are in progress.
+    MAX_BATCHES = 2
+    # Seconds to wait before polling an empty queue again.
+    IDLE_SLEEP = 5
+    # Seconds between scans of the output dir for left over files.
+    ORPHAN_SCAN_INTERVAL = 300
+    # Leave files modified less than this many seconds before the oldest
+    # batch in progress started, to allow for coarse file times.
+    ORPHAN_MIN_AGE = 60
+    # After a SIGINT, wait this many seconds for the current batches to
+    # finish before giving up on them.
+    SHUTDOWN_TIMEOUT = 600
+
+    def __init__(self, args, config, schema, converter, storage, logger,
+            num_cpus, incoming_bucket, incoming_queue):
+        self.args = args
+        self.config = config
+        self.storage = storage
+        self.logger = logger
+        self.num_cpus = num_cpus
+        self.incoming_bucket = incoming_bucket
+        self.incoming_queue = incoming_queue
+        self.batches = {}
+        self.next_batch_id = 0
+        # The batch whose files are being downloaded, if any.
+        self.downloading = None
+        self.last_empty_poll = None
+        self.done = False
+        self.last_orphan_scan = None
+        # Number of left over files that are being compressed or exported.
+        self.orphans = 0
+        self.shutdown_stats = None
+
+        self.raw_files = Queue()
+        self.completed_files = Queue()
+        self.compressed_files = Queue()
+        self.results = Queue()
+        self.acks = Queue()
+        self.resume = [Queue() for i in range(num_cpus)]
+        self.readers = start_workers(logger, num_cpus, "Reader", ReadRawStep,
+                self.raw_files, (self.completed_files, args.log_file,
+                args.stats_file, schema, converter, storage,
+                args.bad_data_log, self.compressed_files, self.acks,
+                self.resume))
+        self.compressors = start_workers(logger, num_cpus, "Compressor",
+                CompressCompletedStep, self.completed_files,
+                (self.compressed_files, self.results, args.log_file,
+                args.stats_file))
+        self.exporters = start_workers(logger, num_cpus, "Exporter",
+                ExportCompressedStep, self.compressed_files, (self.results,
+                args.log_file, args.stats_file, args.output_dir, config,
+                args.dry_run))
+        # Start the download threads after forking the workers.
+        self.transfers = None
+        if not args.dry_run:
+            self.transfers = s3util.TransferPool(config["incoming_bucket"],
+                    config.get("aws_key", None),
+                    config.get("aws_secret_key", None),
+                    num_transfers=num_cpus)
+
+    def run(self):
+        while not self.done:
+            if sigint_count > 0 and self.shutdown_stats is None:
+                self.logger.log("Received shutdown request... waiting for " \
+                                "the current batches to finish")
+                self.shutdown_stats = Stats("ShutdownDuringExport",
+                        self.args.stats_file, self.logger)
+                self.shutdown_stats.increment(records_read=1)
+                self.shutdown_stats.save()
+            busy = self.check_downloads()
+            busy = self.check_acks() or busy
+            busy = self.check_results() or busy
+            if self.shutdown_stats is not None:
+                # Don't start anything new, just finish what we have.
+                if len(self.batches) == 0:
+                    break
+                if timer.delta_sec(self.shutdown_stats.start_time,
+                                   now()) > self.SHUTDOWN_TIMEOUT:
+                    raise InterruptProcessingError("Timed out waiting for " \
+                                                   "batches to finish")
+            else:
+                if self.orphans == 0 and self.orphan_scan_due():
+                    busy = self.queue_orphans() or busy
+                if self.downloading is None and \
+                        len(self.batches) < self.MAX_BATCHES:
+                    busy = self.start_batch() or busy
+            if not busy:
+                time.sleep(0.1)
+        self.stop()
+        if self.shutdown_stats is not None:
+            self.logger.log("OK, cleaning up")
+
+    def orphan_scan_due(self):
+        return self.last_orphan_scan is None or timer.delta_sec(
+                self.last_orphan_scan, now()) >= self.ORPHAN_SCAN_INTERVAL
+
+    def queue_orphans(self):
+        """Queue the output files that were left behind to be compressed
+        and exported. Results for them have no batch id."""
+        self.last_orphan_scan = now()
+        cutoff = None
+        if len(self.batches) > 0:
+            oldest = min(b.start for b in self.batches.itervalues())
+            cutoff = time.mktime(oldest.timetuple()) - self.ORPHAN_MIN_AGE
+        found = 0
+        for root, dirs, files in os.walk(self.args.output_dir):
+            for f in files:
+                full = os.path.join(root, f)
+                if not f.endswith(StorageLayout.PENDING_COMPRESSION_SUFFIX) \
+                        and not f.endswith(StorageLayout.COMPRESSED_SUFFIX):
+                    continue
+                if cutoff is not None:
+                    try:
+                        if os.path.getmtime(full) >= cutoff:
+                            continue
+                    except OSError:
+                        # It was compressed or exported since we listed it.
+                        continue
+                if f.endswith(StorageLayout.PENDING_COMPRESSION_SUFFIX):
+                    self.completed_files.put((None, full))
+                else:
+                    self.compressed_files.put((None, full))
+                self.logger.log("Found left over output file " + full)
+                found += 1
+        self.orphans += found
+        return found > 0
+
+    def fetch_filenames(self):
+        """Return a list of incoming files to process, and a dict of
+        filename -> SQS messages for them."""
+        if self.args.dry_run:
+            self.logger.log("Dry run mode... can't read from the queue " \
+                            "without messing things up...")
+            filenames = []
+            if self.args.input_files and self.next_batch_id == 0:
+                self.logger.log("Fetching file list from file {}".format(
+                        self.args.input_files))
+                filenames = [l.strip() for l in self.args.input_files.readlines()]
+            return filenames, {}
+
+        self.logger.log("Fetching file list from queue " + \
+                        self.config["incoming_queue"])
+        # Sometimes we don't get all the messages, even if more are available,
+        # so keep trying until we have enough (or there aren't any left)
+        messages = []
+        for i in range(self.num_cpus):
+            fetched = self.incoming_queue.get_messages(self.num_cpus - len(messages))
+            messages.extend(fetched)
+            if len(fetched) == 0 or len(messages) >= self.num_cpus:
+                break
+        # Make sure the files exist in S3 first
+        keys = s3util.list_keys(self.incoming_bucket,
+                                [m.get_body() for m in messages])
+        filenames = []
+        by_filename = {}
+        for m in messages:
+            filename = m.get_body()
+            if filename not in keys:
+                self.logger.log("Could not find queued filename in bucket " \
+                                "{0}: {1}".format(self.config["incoming_bucket"],
+                                                  filename))
+                # try to delete it:
+                self.incoming_queue.delete_message(m)
+            elif filename in by_filename:
+                by_filename[filename].append(m)
+            else:
+                filenames.append(filename)
+                by_filename[filename] = [m]
+        self.keys = keys
+        return filenames, by_filename
+
+    def start_batch(self):
+        if self.last_empty_poll is not None and timer.delta_sec(
+                self.last_empty_poll, now()) < self.IDLE_SLEEP:
+            return False
+        filenames, messages = self.fetch_filenames()
+        if len(filenames) == 0:
+            self.last_empty_poll = now()
+            if len(self.batches) == 0:
+                if self.args.dry_run:
+                    self.done = True
+                else:
+                    self.logger.log("Nothing to do! Sleeping...")
+            return False
+        self.last_empty_poll = None
+
+        batch = Batch(self.next_batch_id, filenames, messages)
+        self.next_batch_id += 1
+        self.batches[batch.batch_id] = batch
+        self.logger.log("Batch {0}: {1} files".format(batch.batch_id,
+                                                       len(filenames)))
+        for f in filenames:
+            self.logger.log("  " + f)
+
+        if self.args.dry_run:
+            self.logger.log("Dry run mode: skipping download from S3")
+            for f in filenames:
+                self.read_file(batch, f)
+            self.end_reading(batch)
+            return True
+
+        self.logger.log("Downloading {0} files...".format(len(filenames)))
+        self.downloading = batch
+        for f in filenames:
+            batch.downloading += 1
+            self.transfers.get(f, os.path.join(self.args.work_dir, f),
+                               self.keys[f])
+        return True
+
+    def check_downloads(self):
+        if self.downloading is None:
+            return False
+        batch = self.downloading
+        busy = False
+        for local, remote, err, size, sec in self.transfers.results(wait=False):
+            busy = True
+            batch.downloading -= 1
+            if err is None:
+                batch.downloaded_bytes += os.path.getsize(local)
+                self.read_file(batch, remote)
+            else:
+                # The download has already been retried, leave the file for
+                # the next time its message comes around.
+                self.logger.log("Error downloading {0} Error: {1}".format(
+                        local, err))
+                batch.failed.append(remote)
+            if batch.downloading == 0:
+                download_stats = Stats("Downloader", self.args.stats_file,
+                        self.logger)
+                download_stats.increment(records_read=len(batch.filenames),
+                        records_written=len(batch.read),
+                        bytes_read=batch.downloaded_bytes,
+                        bytes_written=batch.downloaded_bytes,
+                        bad_records=len(batch.failed))
+                self.logger.log(download_stats.get_summary())
+                download_stats.save()
+                self.end_reading(batch)
+        return busy
+
+    def read_file(self, batch, filename):
+        batch.read.append(filename)
+        local_filename = os.path.join(self.args.work_dir, filename)
+        for piece in split_raw_files(self.logger, [local_filename],
+                                     self.num_cpus):
+            self.raw_files.put(piece)
+
+    def end_reading(self, batch):
+        # Each reader takes one of these, then waits for the others.
+        for i in range(self.num_cpus):
+            self.raw_files.put(BatchEnd(batch.batch_id))
+        self.downloading = None
+
+    def check_acks(self):
+        busy = False
+        while True:
+            try:
+                batch_id, reader_num, outputs = self.acks.get_nowait()
+            except Q.Empty:
+                break
+            busy = True
+            batch = self.batches[batch_id]
+            batch.acks += 1
+            batch.outputs += outputs
+            if batch.acks == self.num_cpus:
+                self.close_batch(batch)
+        return busy
+
+    def close_batch(self, batch):
+        # All the readers are waiting, so it's safe to rotate the files
+        # they were writing.
+        if not self.args.compress_output:
+            for root, dirs, files in os.walk(self.args.output_dir):
+                for f in files:
+                    if f.endswith(".log"):
+                        filename = os.path.join(root, f)
+                        rotated = self.storage.rotate(filename)
+                        if rotated != filename:
+                            self.completed_files.put((batch.batch_id,
+                                                      rotated))
+                            batch.outputs += 1
+        batch.closed = True
+        self.logger.log("Batch {0}: read all files, waiting for {1} output " \
+                        "files".format(batch.batch_id, batch.outputs))
+        for resume in self.resume:
+            resume.put(batch.batch_id)
+        self.maybe_commit(batch)
+
+    def check_results(self):
+        busy = False
+        while True:
+            try:
+                batch_id, filename, err = self.results.get_nowait()
+            except Q.Empty:
+                break
+            busy = True
+            if batch_id is None:
+                self.orphans -= 1
+                if err is not None:
+                    self.logger.log("Left over file {0} failed again, will " \
+                                    "retry later: {1}".format(filename, err))
+                continue
+            batch = self.batches[batch_id]
+            batch.exported += 1
+            if err is not None:
+                batch.errors += 1
+            self.maybe_commit(batch)
+        return busy
+
+    def maybe_commit(self, batch):
+        if not batch.closed or batch.exported < batch.outputs:
+            return
+        del self.batches[batch.batch_id]
+        if batch.errors > 0:
+            # Keep the incoming files and messages, so the messages come
+            # back and the batch is processed again. The failed output files
+            # are retried by the next scan of the output dir.
+            self.logger.log("Batch {0}: {1} output files failed, leaving " \
+                            "its incoming files to be processed " \
+                            "again".format(batch.batch_id, batch.errors))
+            if self.args.dry_run:
+                self.done = True
+            return
+
+        self.logger.log("Removing processed logs from S3...")
+        for f in batch.read:
+            if self.args.dry_run:
+                self.logger.log("  Dry run, so not really deleting " + f)
+            else:
+                self.logger.log("  Deleting " + f)
+                self.incoming_bucket.delete_key(f)
+                # Delete file locally too.
+                os.remove(os.path.join(self.args.work_dir, f))
+        self.logger.log("Done")
+
+        messages = [m for f in batch.read for m in batch.messages.get(f, [])]
+        if len(messages) > 0:
+            self.logger.log("Removing processed messages from SQS...")
+            for m in messages:
+                self.logger.log("  Deleting {0}".format(m.get_body()))
+                if self.incoming_queue.delete_message(m):
+                    self.logger.log("  Message deleted successfully")
+                else:
+                    self.logger.log("  Failed to delete message :(")
+            self.logger.log("Done")
+
+        self.logger.log("Batch {0}: all done in {1:.2f}s".format(
+                batch.batch_id, timer.delta_sec(batch.start, now())))
+        if self.args.dry_run:
+            self.done = True
+
+    def stop(self):
+        finish_queue(self.raw_files, self.num_cpus)
+        wait_for(self.logger, self.readers, "Raw Readers")
+        finish_queue(self.completed_files, self.num_cpus)
+        wait_for(self.logger, self.compressors, "Compressors")
+        finish_queue(self.compressed_files, self.num_cpus)
+        wait_for(self.logger, self.exporters, "Exporters")
+        if self.transfers is not None:
+            self.transfers.close()
+
+    def terminate(self):
+        """Stop the workers right away, for when stop() takes too long."""
+        terminate(self.logger, self.readers, "Readers")
+        terminate(self.logger, self.compressors, "Compressors")
+        terminate(self.logger, self.exporters, "Exporters")
 
 
 def main():
@@ -571,10 +1259,23 @@ def main():
             help="Log statistics to this file")
     parser.add_argument("--histogram-cache-path", default="./histogram_cache",
             help="Path to store a local cache of histograms")
+    parser.add_argument("--prewarm-revisions", metavar="N", type=int,
+            default=100, help="Load the N most recent revisions from the " \
+                              "histogram cache before starting the readers")
     parser.add_argument("-t", "--telemetry-schema", required=True,
             help="Location of the desired telemetry schema")
     parser.add_argument("-m", "--max-output-size", metavar="N", type=int,
             default=500000000, help="Rotate output files after N bytes")
+    parser.add_argument("--max-open-files", metavar="N", type=int,
+            default=256, help="Keep up to N output files open per reader " \
+                              "(0 to open and close them for every record)")
+    parser.add_argument("--compress-output", action="store_true",
+            help="Compress output as it is written instead of compressing " \
+                 "completed files (needs --max-open-files). Each open file " \
+                 "then holds an lzma compressor of about 10MB, so at most " \
+                 "%d files are kept open per reader; the others are " \
+                 "resumed when they are next written to" % (
+                    StorageLayout.MAX_COMPRESSED_OPEN_FILES))
     parser.add_argument("-D", "--dry-run", action="store_true",
             help="Don't modify remote files")
     parser.add_argument("-n", "--no-clean", action="store_true",
@@ -598,17 +1299,21 @@ def main():
     schema_data.close()
     cache = RevisionCache(args.histogram_cache_path, "hg.mozilla.org")
     converter = Converter(cache, schema)
-    storage = StorageLayout(schema, args.output_dir, args.max_output_size)
+    storage = StorageLayout(schema, args.output_dir, args.max_output_size,
+            args.max_open_files, args.compress_output)
     logger = Log(args.log_file, "Master")
+    if args.prewarm_revisions > 0:
+        # Readers are forked from this process, so they all start with these
+        # histogram definitions and layouts already parsed.
+        start = now()
+        loaded = converter.prewarm(args.prewarm_revisions)
+        logger.log("Pre-warmed {0} histogram revisions in {1:.2f}s ({2:.1f}MB " \
+                   "resident)".format(loaded, timer.delta_sec(start),
+                   get_rss_bytes() / 1024.0 / 1024.0))
     num_cpus = multiprocessing.cpu_count()
     conn = None
     incoming_bucket = None
     incoming_queue = None
-    s3downloader = None
-    raw_readers = None
-    compressors = None
-    exporters = None
-    done = False
 
     if args.no_clean:
         logger.log("Not removing log files in {}".format(args.output_dir))
@@ -618,7 +1323,7 @@ def main():
         logger.log("Removing log files in {}".format(args.output_dir))
         for root, dirs, files in os.walk(args.output_dir):
             for f in files:
-                if f.endswith(".log"):
+                if f.endswith(".log") or f.endswith(StorageLayout.IN_PROGRESS_SUFFIX):
                     full = os.path.join(root, f)
                     if args.dry_run:
                         logger.log("Would be deleting {}, except it's a " \
@@ -652,185 +1357,14 @@ def main():
             logger.log("Bucket {0} not found. Attempting to create it.".format(
                     config["publish_bucket"]))
             publish_bucket = conn.create_bucket(config["publish_bucket"])
-        s3downloader = s3util.Loader(args.work_dir, config["incoming_bucket"],
-                poolsize=num_cpus, aws_key=config.get("aws_key", None),
-                aws_secret_key=config.get("aws_secret_key", None))
 
-    while not done:
-        if args.dry_run:
-            done = True
-        try:
-            start = now()
-            incoming_filenames = []
-            incoming_queue_messages = []
-            logger.log("Fetching file list from queue " + config["incoming_queue"])
-            if args.dry_run:
-                logger.log("Dry run mode... can't read from the queue " \
-                           "without messing things up...")
-                if args.input_files:
-                    logger.log("Fetching file list from file {}".format(
-                            args.input_files))
-                    incoming_filenames = [ l.strip() for l in args.input_files.readlines() ]
-            else:
-                # Sometimes we don't get all the messages, even if more are
-                # available, so keep trying until we have enough (or there
-                # aren't any left)
-                for i in range(num_cpus):
-                    messages = incoming_queue.get_messages(num_cpus - len(incoming_filenames))
-                    for m in messages:
-                        # Make sure this file exists in S3 first
-                        possible_filename = m.get_body()
-                        key = incoming_bucket.get_key(possible_filename)
-                        if key is None:
-                            logger.log("Could not find queued filename in" \
-                                       " bucket {0}: {1}".format(
-                                            config["incoming_bucket"],
-                                            possible_filename))
-                            # try to delete it:
-                            incoming_queue.delete_message(m)
-                        else:
-                            incoming_filenames.append(possible_filename)
-                            incoming_queue_messages.append(m)
-                    if len(messages) == 0 or len(incoming_filenames) >= num_cpus:
-                        break
-            logger.log("Done")
-
-            if len(incoming_filenames) == 0:
-                logger.log("Nothing to do! Sleeping...")
-                time.sleep(5)
-                continue
-
-            for f in incoming_filenames:
-                logger.log("  " + f)
-
-            before_download = now()
-            logger.log("Downloading {0} files...".format(len(incoming_filenames)))
-            local_filenames = []
-            download_stats = Stats("Downloader", args.stats_file, logger)
-            if args.dry_run:
-                logger.log("Dry run mode: skipping download from S3")
-                local_filenames = [ os.path.join(args.work_dir, f) for f in incoming_filenames ]
-            else:
-                for local_filename, remote_filename, err in s3downloader.get_list(incoming_filenames):
-                    if err is None:
-                        local_filenames.append(local_filename)
-                    else:
-                        # s3downloader already retries 3 times.
-                        logger.log("Error downloading {0} Error: {1}".format(
-                                local_filename, err))
-                        download_stats.increment(
-                                records_read=len(incoming_filenames),
-                                records_written=len(local_filenames),
-                                bad_records=1)
-                        download_stats.save()
-                        return 2
-            downloaded_bytes = sum([os.path.getsize(f) for f in local_filenames])
-            download_stats.increment(records_read=len(incoming_filenames),
-                    records_written=len(local_filenames),
-                    bytes_read=downloaded_bytes,
-                    bytes_written=downloaded_bytes)
-            logger.log(download_stats.get_summary())
-            download_stats.save()
-            after_download = now()
-
-            raw_files = Queue()
-            for l in local_filenames:
-                raw_files.put(l)
-
-            completed_files = Queue()
-
-            # Begin reading raw input
-            raw_readers = start_workers(logger, num_cpus, "Reader", ReadRawStep,
-                    raw_files, (completed_files, args.log_file, args.stats_file,
-                    schema, converter, storage, args.bad_data_log))
-
-            # Tell readers to stop when they get to the end:
-            finish_queue(raw_files, num_cpus)
-
-            # Compress completed files.
-            compressors = start_workers(logger, num_cpus, "Compressor",
-                    CompressCompletedStep, completed_files, (None,
-                    args.log_file, args.stats_file))
-            wait_for(logger, raw_readers, "Raw Readers")
-
-            # `find <out_dir> -type f -not -name ".compressme"`
-            # Add them to completed_files
-            for root, dirs, files in os.walk(args.output_dir):
-                for f in files:
-                    if f.endswith(".log"):
-                        completed_files.put(os.path.join(root, f))
-
-            # Tell compressors to stop:
-            finish_queue(completed_files, num_cpus)
-            wait_for(logger, compressors, "Compressors")
-
-            shutdown_requested = False
-            try:
-                # Export compressed files to S3.
-                compressed_files = Queue()
-                exporters = start_workers(logger, num_cpus, "Exporter",
-                        ExportCompressedStep, compressed_files, (args.log_file,
-                        args.stats_file, args.output_dir, config, args.dry_run))
-                for root, dirs, files in os.walk(args.output_dir):
-                    for f in files:
-                        if f.endswith(StorageLayout.COMPRESSED_SUFFIX):
-                            compressed_files.put(os.path.join(root, f))
-                finish_queue(compressed_files, num_cpus)
-                wait_for(logger, exporters, "Exporters")
-            except InterruptProcessingError, e:
-                logger.log("Received shutdown request... waiting for " \
-                           "exporters to finish")
-                shutdown_requested = True
-                shutdown_stats = Stats("ShutdownDuringExport", args.stats_file,
-                    logger)
-                shutdown_stats.increment(records_read=1)
-                shutdown_stats.save()
-                done = True
-                wait_for(logger, exporters, "Exporters")
-                logger.log("OK, cleaning up")
-
-            logger.log("Removing processed logs from S3...")
-            for f in incoming_filenames:
-                if args.dry_run:
-                    logger.log("  Dry run, so not really deleting " + f)
-                else:
-                    logger.log("  Deleting " + f)
-                    incoming_bucket.delete_key(f)
-                    # Delete file locally too.
-                    os.remove(os.path.join(args.work_dir, f))
-            logger.log("Done")
-
-            if len(incoming_queue_messages) > 0:
-                logger.log("Removing processed messages from SQS...")
-                for m in incoming_queue_messages:
-                    if args.dry_run:
-                        logger.log("  Dry run, so not really deleting " \
-                                   "{0}".format(m.get_body()))
-                    else:
-                        logger.log("  Deleting {0}".format(m.get_body()))
-                        if incoming_queue.delete_message(m):
-                            logger.log("  Message deleted successfully")
-                        else:
-                            logger.log("  Failed to delete message :(")
-                logger.log("Done")
-
-            if shutdown_requested:
-                shutdown_stats.increment(records_written=1)
-                shutdown_stats.save()
-            all_done = now()
-            duration = timer.delta_sec(start, all_done)
-            logger.log("All done in %.2fs (%.2fs excluding download time)" % (
-                duration, timer.delta_sec(after_download, all_done)))
-        except InterruptProcessingError, e:
-            logger.log("Received normal shutdown request... quittin' time!")
-            if raw_readers is not None:
-                terminate(logger, raw_readers, "Readers")
-            if compressors is not None:
-                terminate(logger, compressors, "Compressors")
-            if exporters is not None:
-                terminate(logger, exporters, "Exporters")
-
-            done = True
+    pipeline = Pipeline(args, config, schema, converter, storage, logger,
+            num_cpus, incoming_bucket, incoming_queue)
+    try:
+        pipeline.run()
+    except InterruptProcessingError, e:
+        logger.log("Stopping immediately: {0}".format(e.msg))
+        pipeline.terminate()
     shutdown_stats = Stats("ShutdownComplete", args.stats_file, logger)
     shutdown_stats.increment(records_read=1, records_written=1)
     shutdown_stats.save()
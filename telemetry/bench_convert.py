@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Measure how many pings per second the Converter can handle.
+
+Converts the test payloads from test_convert.py over and over, using both the
+current histogram conversion and the previous one (which looked up each
+bucket's index in a map hung off a shared Histogram object), and prints
+pings/sec for each.
+
+Example usage (from the top level of the repo):
+    PYTHONPATH=telemetry python -m telemetry.bench_convert -c ./histogram_cache
+"""
+
+import argparse
+import copy
+import sys
+from datetime import datetime
+import revision_cache
+import simplejson as json
+from convert import Converter, BadPayloadError
+from histogram_tools import Histogram, DefinitionException
+from telemetry_schema import TelemetrySchema
+from test_convert import ConvertTest
+import telemetry.util.timer as timer
+
+class LegacyConverter(Converter):
+    """Converts histograms the way we did before HistogramLayout."""
+    def __init__(self, cache, schema):
+        Converter.__init__(self, cache, schema)
+        self._histocache = {}
+
+    def map_value(self, histogram, val):
+        rewritten = []
+        try:
+            bucket_count = int(histogram.n_buckets())
+            rewritten = [0] * bucket_count
+            value_map = val["values"]
+            try:
+                try:
+                    allowed_ranges = histogram.allowed_ranges
+                except AttributeError:
+                    histogram.allowed_ranges = histogram.ranges()
+                    allowed_ranges = histogram.allowed_ranges
+                try:
+                    range_map = histogram.range_map
+                except AttributeError:
+                    range_map = {}
+                    for index, allowed_range in enumerate(allowed_ranges):
+                        range_map[allowed_range] = index
+                    histogram.range_map = range_map
+                for bucket in value_map.keys():
+                    ib = int(bucket)
+                    try:
+                        bucket_val = value_map[bucket]
+                        if isinstance(bucket_val, (int, long)):
+                            rewritten[range_map[ib]] = bucket_val
+                        else:
+                            raise BadPayloadError("non-integer bucket value")
+                    except KeyError:
+                        raise BadPayloadError("invalid bucket")
+            except DefinitionException:
+                pass
+        except ValueError:
+            pass
+        for k in ("sum", "log_sum", "log_sum_squares", "sum_squares_lo", "sum_squares_hi"):
+            rewritten.append(val.get(k, -1))
+        return rewritten
+
+    def rewrite_hists(self, revision_url, histograms):
+        histogram_defs = self._cache.get_histograms_for_revision(revision_url)
+        if histogram_defs is None:
+            raise ValueError("Failed to fetch histograms for URL: %s" % revision_url)
+        rewritten = dict()
+        for key, val in histograms.iteritems():
+            if key in histogram_defs:
+                real_histogram_name = key
+            elif key.startswith("STARTUP_") and key[8:] in histogram_defs:
+                real_histogram_name = key[8:]
+            else:
+                continue
+            cache_key = "%s.%s" % (key, revision_url)
+            if cache_key not in self._histocache:
+                self._histocache[cache_key] = Histogram(key,
+                        histogram_defs[real_histogram_name])
+            histogram = self._histocache[cache_key]
+            rewritten[self.map_key(histogram_defs, key)] = self.map_value(histogram, val)
+        return rewritten
+
+def get_payloads(revision):
+    test = ConvertTest("test_histograms")
+    payloads = []
+    for desc in ["normal", "anr", "fxos"]:
+        payload = test.get_payload(desc)
+        if "info" in payload and "histograms" in payload:
+            payload["info"]["revision"] = revision
+        payloads.append(json.dumps(payload))
+    return payloads
+
+def bench(converter, payloads, iterations, batch_size=1000):
+    parsed = [json.loads(p) for p in payloads]
+    total = 0.0
+    done = 0
+    while done < iterations:
+        # Conversion modifies the payload in place, so convert copies (and
+        # don't count the time spent copying).
+        batch = [copy.deepcopy(p) for i in range(min(batch_size,
+                iterations - done)) for p in parsed]
+        start = datetime.now()
+        for p in batch:
+            converter.convert_obj(p, "20131114")
+        total += timer.delta_sec(start)
+        done += batch_size
+    return iterations * len(parsed) / total
+
+def bench_hists(converter, revision, histograms, iterations):
+    start = datetime.now()
+    for i in range(iterations):
+        converter.rewrite_hists(revision, histograms)
+    return iterations / timer.delta_sec(start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark payload conversion.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-c", "--cache-dir", help="Histogram revision cache directory", default="./histogram_cache")
+    parser.add_argument("-s", "--server", help="Server to fetch histogram revisions from", default="hg.mozilla.org")
+    parser.add_argument("--schema", help="Telemetry schema file", default="./telemetry/telemetry_schema.json")
+    parser.add_argument("-n", "--iterations", help="Number of times to convert each payload", type=int, default=20000)
+    args = parser.parse_args()
+
+    with open(args.schema) as schema_file:
+        schema = TelemetrySchema(json.load(schema_file))
+    cache = revision_cache.RevisionCache(args.cache_dir, args.server)
+    test = ConvertTest("test_histograms")
+    revision = test.get_revision()
+    payloads = get_payloads(revision)
+    histograms = test.get_raw_histograms()
+
+    legacy = LegacyConverter(cache, schema)
+    current = Converter(cache, schema)
+    if legacy.rewrite_hists(revision, histograms) != current.rewrite_hists(revision, histograms):
+        print "Converted histograms don't match!"
+        return 1
+
+    print "%-8s %14s %16s" % ("", "Pings/sec", "Histograms/sec")
+    for name, converter in [("before", legacy), ("after", current)]:
+        print "%-8s %14.0f %16.0f" % (name,
+                bench(converter, payloads, args.iterations),
+                bench_hists(converter, revision, histograms,
+                            args.iterations) * len(histograms))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import hashlib
 import sys
 import getopt
 try:
@@ -21,6 +22,7 @@ import persist
 from infoFieldsMap import envFieldMap, adapterFieldMap, appFieldMap
 from datetime import date
 import time
+from telemetry.util.lru import LRUCache
 try:
     import geoip2.database
     from geoip2.errors import AddressNotFoundError
@@ -33,6 +35,114 @@ class BadPayloadError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+class HistogramLayout:
+    """How to convert the values of one histogram into a list of buckets.
+
+    The bucket count and a map from bucket (as it appears in the payload) to
+    bucket index are computed once from the histogram definition, so
+    converting a value is a single pass over its buckets.
+    """
+    SUMMARY_FIELDS = ("sum", "log_sum", "log_sum_squares", "sum_squares_lo",
+                      "sum_squares_hi")
+
+    def __init__(self, histogram=None):
+        self.bucket_count = None
+        self.bucket_index = None
+        self.definition_error = None
+        if histogram is not None:
+            self.name = histogram.name()
+            self.load(HistogramLayout.compile(histogram))
+
+    @staticmethod
+    def compile(histogram):
+        """Return what a layout needs from a Histogram, as
+        (bucket count, bucket ranges, definition error).
+
+        The result can be saved with marshal, see from_compiled.
+        """
+        try:
+            bucket_count = int(histogram.n_buckets())
+        except ValueError:
+            # TODO: what should we do for non-numeric bucket counts?
+            #   - output buckets based on observed keys?
+            #   - skip this histogram
+            return (None, None, None)
+        try:
+            return (bucket_count, list(histogram.ranges()), None)
+        except DefinitionException:
+            return (bucket_count, None, str(sys.exc_info()[1]))
+
+    @staticmethod
+    def from_compiled(name, compiled):
+        layout = HistogramLayout()
+        layout.name = name
+        layout.load(compiled)
+        return layout
+
+    def load(self, compiled):
+        self.bucket_count, ranges, self.definition_error = compiled
+        if ranges is None:
+            return
+        self.bucket_index = {}
+        for index, allowed_range in enumerate(ranges):
+            self.bucket_index[allowed_range] = index
+            # Payloads use strings for bucket names, so index those too.
+            self.bucket_index[str(allowed_range)] = index
+
+    def convert(self, val):
+        if self.bucket_count is None:
+            rewritten = []
+        else:
+            rewritten = [0] * self.bucket_count
+            value_map = val["values"]
+            if self.bucket_index is None:
+                sys.stderr.write("Could not find ranges for histogram: %s: %s\n" % (self.name, self.definition_error))
+            else:
+                try:
+                    self.fill(rewritten, value_map)
+                except ValueError:
+                    # Non-numeric bucket name.
+                    pass
+
+        for k in HistogramLayout.SUMMARY_FIELDS:
+            rewritten.append(val.get(k, -1))
+        return rewritten
+
+    def fill(self, rewritten, value_map):
+        bucket_index = self.bucket_index
+        for bucket, bucket_val in value_map.iteritems():
+            index = bucket_index.get(bucket)
+            if index is None:
+                # Allow for things like " 1" and 1L that int() accepts.
+                try:
+                    index = bucket_index[int(bucket)]
+                except KeyError:
+                    raise BadPayloadError("Found invalid bucket %s.values[%s]" % (self.name, str(bucket)))
+            # Make sure it's a number:
+            if isinstance(bucket_val, (int, long)):
+                rewritten[index] = bucket_val
+            else:
+                raise BadPayloadError("Found non-integer bucket value: %s.values[%s] = '%s'" % (self.name, str(bucket), str(bucket_val)))
+
+
+def compile_definitions(histogram_defs):
+    """Compile a revision's histogram definitions for the Converter.
+
+    Returns a dict of histogram name -> (definition digest, compiled layout,
+    error), where the compiled layout is None (and error says why) if the
+    definition is invalid. See HistogramLayout.compile.
+    """
+    compiled = {}
+    for name, definition in histogram_defs.iteritems():
+        digest = hashlib.sha1(json.dumps(definition, sort_keys=True)).digest()
+        try:
+            layout = HistogramLayout.compile(Histogram(name, definition))
+            compiled[name] = (digest, layout, None)
+        except (Exception, DefinitionException), e:
+            compiled[name] = (digest, None, str(e))
+    return compiled
+
+
 class Converter:
     """A class for converting incoming payloads to a more compact form"""
     VERSION_UNCONVERTED = 1
@@ -44,8 +154,19 @@ class Converter:
     VERSION_UNIFIED_CONVERTED = 5
     GEOIP_COUNTRY_PATH = "/usr/local/var/GeoIP/GeoLite2-Country.mmdb"
 
+    # Maximum number of distinct histogram layouts to keep.
+    LAYOUT_CACHE_SIZE = 20000
+    # Maximum number of revisions to keep name -> layout tables for.
+    REVISION_CACHE_SIZE = 200
+    # Name of the compile_definitions format in the revision cache. Change
+    # it whenever the format changes.
+    COMPILED_FORMAT = "layouts1"
+
     def __init__(self, cache, schema):
-        self._histocache = {}
+        # (histogram name, definition hash) -> HistogramLayout
+        self._layouts = LRUCache(Converter.LAYOUT_CACHE_SIZE)
+        # revision url -> (histogram definitions, {name -> HistogramLayout})
+        self._revisions = LRUCache(Converter.REVISION_CACHE_SIZE)
         self._cache = cache
         self._schema = schema
         if geo_available:
@@ -81,86 +202,98 @@ class Converter:
         return country
 
     def map_value(self, histogram, val):
-        rewritten = []
-        try:
-            bucket_count = int(histogram.n_buckets())
-            #sys.stderr.write("Found %d buckets for %s\n" % (bucket_count, histogram.name()))
-            rewritten = [0] * bucket_count
-            value_map = val["values"]
-            try:
-                try:
-                    # Materialize the ranges (since we're caching Histograms)
-                    allowed_ranges = histogram.allowed_ranges
-                except AttributeError:
-                    histogram.allowed_ranges = histogram.ranges()
-                    allowed_ranges = histogram.allowed_ranges
-
-                try:
-                    # Materialize the range_map too.
-                    range_map = histogram.range_map
-                except AttributeError:
-                    range_map = {}
-                    for index, allowed_range in enumerate(allowed_ranges):
-                        range_map[allowed_range] = index
-                    histogram.range_map = range_map
-
-                for bucket in value_map.keys():
-                    ib = int(bucket)
-                    try:
-                        #sys.stderr.write("Writing %s.values[%s] to buckets[%d] (size %d)\n" % (histogram.name(), bucket, range_map[ib], bucket_count))
-                        bucket_val = value_map[bucket]
-                        # Make sure it's a number:
-                        if isinstance(bucket_val, (int, long)):
-                            rewritten[range_map[ib]] = bucket_val
-                        else:
-                            raise BadPayloadError("Found non-integer bucket value: %s.values[%s] = '%s'" % (histogram.name(), str(bucket), str(bucket_val)))
-                    except KeyError:
-                        raise BadPayloadError("Found invalid bucket %s.values[%s]" % (histogram.name(), str(bucket)))
-            except DefinitionException:
-                sys.stderr.write("Could not find ranges for histogram: %s: %s\n" % (histogram.name(), sys.exc_info()))
-        except ValueError:
-            # TODO: what should we do for non-numeric bucket counts?
-            #   - output buckets based on observed keys?
-            #   - skip this histogram
-            pass
-
-        for k in ("sum", "log_sum", "log_sum_squares", "sum_squares_lo", "sum_squares_hi"):
-            rewritten.append(val.get(k, -1))
-        return rewritten
-
-    # Memoize building the Histogram object from the histogram definition.
-    def histocache(self, revision_url, name, definition):
-        key = "%s.%s" % (name, revision_url)
-        if key not in self._histocache:
-            hist = Histogram(name, definition)
-            self._histocache[key] = hist
-        return self._histocache[key]
+        return HistogramLayout(histogram).convert(val)
+
+    def get_revision_layouts(self, revision_url):
+        """Return (compiled histogram definitions, layouts) for the given
+        revision.
+
+        Layouts are keyed by histogram name as it appears in the payload, and
+        are only looked up the first time that name is seen. Unknown names
+        aren't kept, so the layouts only grow to the names in the definitions
+        (with and without "STARTUP_"), whatever payloads send.
+        """
+        revision = self._revisions.get(revision_url)
+        if revision is None:
+            histogram_defs = self._cache.get_compiled_for_revision(
+                    revision_url, Converter.COMPILED_FORMAT,
+                    compile_definitions)
+            if histogram_defs is None:
+                raise ValueError("Failed to fetch histograms for URL: %s" % revision_url)
+            revision = (histogram_defs, {})
+            self._revisions.put(revision_url, revision)
+        return revision
+
+    def get_layout(self, histogram_defs, key):
+        if key in histogram_defs:
+            real_histogram_name = key
+        elif key.startswith("STARTUP_") and key[8:] in histogram_defs:
+            # chop off leading "STARTUP_"
+            # See http://mxr.mozilla.org/mozilla-central/source/toolkit/components/telemetry/TelemetryPing.jsm
+            #     in the `gatherStartupHistograms` function.
+            real_histogram_name = key[8:]
+        else:
+            return None
+        digest, compiled, error = histogram_defs[real_histogram_name]
+        if compiled is None:
+            raise ValueError("Invalid definition for histogram %s: %s" % (key, error))
+        # Most histograms have the same definition across many revisions, so
+        # share layouts between revisions with identical definitions.
+        layout_key = (key, digest)
+        layout = self._layouts.get(layout_key)
+        if layout is None:
+            layout = HistogramLayout.from_compiled(key, compiled)
+            self._layouts.put(layout_key, layout)
+        return layout
 
     def rewrite_hists(self, revision_url, histograms):
-        histogram_defs = self._cache.get_histograms_for_revision(revision_url)
-        if histogram_defs is None:
-            raise ValueError("Failed to fetch histograms for URL: %s" % revision_url)
+        histogram_defs, layouts = self.get_revision_layouts(revision_url)
         rewritten = dict()
         for key, val in histograms.iteritems():
-            real_histogram_name = key
-            if key in histogram_defs:
-                real_histogram_name = key
-            elif key.startswith("STARTUP_") and key[8:] in histogram_defs:
-                # chop off leading "STARTUP_"
-                # See http://mxr.mozilla.org/mozilla-central/source/toolkit/components/telemetry/TelemetryPing.jsm
-                #     in the `gatherStartupHistograms` function.
-                real_histogram_name = key[8:]
-            else:
-                # TODO: collect these to be returned
-                sys.stderr.write("ERROR: no histogram definition found for %s\n" % key)
+            layout = layouts.get(key)
+            if layout is None:
+                layout = self.get_layout(histogram_defs, key)
+                if layout is None:
+                    # TODO: collect these to be returned
+                    sys.stderr.write("ERROR: no histogram definition found for %s\n" % key)
+                    continue
+                layouts[key] = layout
+            rewritten[self.map_key(histogram_defs, key)] = layout.convert(val)
+        return rewritten
+
+    def prewarm(self, max_revisions=None):
+        """Load revisions from the on-disk histogram cache, and build the
+        layouts for their histograms.
+
+        Meant to be called before forking worker processes, so they all
+        start out with (and share) the compiled definitions and layouts.
+        Returns the number of revisions loaded.
+        """
+        revisions = self._cache.load_disk_cache(max_revisions,
+                Converter.COMPILED_FORMAT, compile_definitions)
+        seen = set()
+        for repo, revision, histogram_defs in revisions:
+            # Revisions with the same definitions share them.
+            if id(histogram_defs) in seen:
                 continue
+            seen.add(id(histogram_defs))
+            for name in histogram_defs:
+                if len(self._layouts) >= Converter.LAYOUT_CACHE_SIZE:
+                    return len(revisions)
+                try:
+                    self.get_layout(histogram_defs, name)
+                except Exception:
+                    # Bad definitions are reported when they're used.
+                    pass
+        return len(revisions)
 
-            histogram_def = histogram_defs[real_histogram_name]
-            histogram = self.histocache(revision_url, key, histogram_def)
-            new_key = self.map_key(histogram_defs, key)
-            new_value = self.map_value(histogram, val)
-            rewritten[new_key] = new_value
-        return rewritten
+    def get_cache_stats(self):
+        """Return counters for the histogram layout cache."""
+        return self._layouts.get_stats()
+
+    def get_revision_cache_stats(self):
+        """Return counters for the histogram definition cache."""
+        return self._cache.get_stats()
 
     def convert_json(self, jsonstr, date, ip=None):
         json_dict = json.loads(jsonstr)
@@ -5,6 +5,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import fcntl
 import os
 import io
 import sys
@@ -14,7 +15,145 @@ except ImportError:
     import json
 import time
 import logging
+import uuid as uuidlib
 import telemetry.util.files as fileutil
+import telemetry.util.compress as compress
+from telemetry.util.lru import LRUCache
+
+
+class OutputFile:
+    """An open, buffered append handle on one output file.
+
+    Output is buffered in whole lines, and each flush is a single write to a
+    file opened with O_APPEND, so other processes can safely append to the
+    same file at the same time. Writes and rotation hold an exclusive flock
+    on the file, so nothing is appended to a file once it has been rotated.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.pending = []
+        self.pending_bytes = 0
+        self.open()
+
+    def open(self):
+        self.fd = os.open(self.filename,
+                          os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        info = os.fstat(self.fd)
+        self.inode = (info.st_dev, info.st_ino)
+        self.size = info.st_size
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+
+    def is_current(self):
+        """Check that `filename` is still the file we have open.
+
+        It won't be if another process has rotated it since we opened it.
+        """
+        try:
+            info = os.stat(self.filename)
+        except OSError:
+            return False
+        return (info.st_dev, info.st_ino) == self.inode
+
+    def lock(self):
+        """Lock the file, first reopening it if it has been rotated.
+
+        Returns False if it had been rotated.
+        """
+        current = True
+        while True:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            if self.is_current():
+                return current
+            # Somebody else rotated it, start a new one.
+            current = False
+            os.close(self.fd)
+            self.open()
+
+    def unlock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = "".join(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        self.lock()
+        try:
+            while data:
+                written = os.write(self.fd, data)
+                data = data[written:]
+            # Other processes may be writing to this file too.
+            self.size = os.fstat(self.fd).st_size
+        finally:
+            self.unlock()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            os.close(self.fd)
+
+
+class CompressedOutputFile:
+    """Compresses the output for one file as it is written.
+
+    Compressed streams can't be shared, so each process writes its own file.
+    While it's being written, the file is named like
+        <filename>.<unique id>.writing
+    and when it is closed it is renamed to
+        <filename>.<unique id>.lzma
+    which is the same name CompressCompletedStep would have given it. `size`
+    is the number of uncompressed bytes written.
+
+    suspend() frees the compressor without finishing the file, and resume()
+    carries on writing to it as another xz stream. Readers decompress the
+    streams one after the other, as one file.
+    """
+    def __init__(self, filename, compression_level=None):
+        self.filename = filename
+        self.compression_level = compression_level
+        base = "%s.%s" % (filename, uuidlib.uuid4().hex)
+        self.final_name = base + StorageLayout.COMPRESSED_SUFFIX
+        self.temp_name = base + StorageLayout.IN_PROGRESS_SUFFIX
+        self.handle = None
+        self.size = 0
+        self.pending = []
+        self.pending_bytes = 0
+        self.open("w")
+
+    def open(self, mode):
+        self.handle = compress.CompressedFile(self.temp_name, mode=mode,
+                compression_type="lzma",
+                compression_level=self.compression_level, open_now=True)
+
+    def suspend(self):
+        self.flush()
+        self.handle.close()
+        self.handle = None
+
+    def resume(self):
+        self.open("a")
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.handle.write("".join(self.pending))
+        self.size += self.pending_bytes
+        self.pending = []
+        self.pending_bytes = 0
+
+    def close(self):
+        if self.handle is not None:
+            self.suspend()
+        os.rename(self.temp_name, self.final_name)
 
 
 class StorageLayout:
@@ -28,15 +167,57 @@ class StorageLayout:
     DECOMPRESSION_ARGS = ["--decompress", "--stdout"]
 
     PENDING_COMPRESSION_SUFFIX = ".compressme"
+    # Compressed output that's still being written.
+    IN_PROGRESS_SUFFIX = ".writing"
+    # Write out buffered output for a file once it gets this big.
+    WRITE_BUFFER_BYTES = 64 * 1024
+    # Each compressed output file holds an lzma encoder (about 10MB at the
+    # default compression level), so keep at most this many of them open.
+    # The others are suspended until they are written to again.
+    MAX_COMPRESSED_OPEN_FILES = 16
+
+    def __init__(self, schema, basedir, max_log_size, max_open_files=0,
+                 compress_output=False, compression_level=1):
+        """If `max_open_files` is greater than zero, keep up to that many
+        output files open and buffer writes to them. In that case, call
+        flush() or close_all() before anyone else reads the output.
 
-    def __init__(self, schema, basedir, max_log_size):
+        If `compress_output` is True, write() compresses its output as it
+        goes, rotating to finished COMPRESSED_SUFFIX files rather than files
+        that are pending compression. This needs `max_open_files` and the
+        in-process lzma module. Each open file uses about 10MB of memory for
+        the compressor, so `max_open_files` is capped at
+        MAX_COMPRESSED_OPEN_FILES. Files that are closed to make room are
+        suspended rather than finished, so each one still grows to
+        `max_log_size` before it is rotated.
+        """
         self._max_log_size = max_log_size
         self._schema = schema
         self._basedir = basedir
+        self._compress_output = compress_output
+        self._compression_level = compression_level
+        self._files = None
+        self._finished = []
+        # filename -> suspended CompressedOutputFile
+        self._suspended = {}
+        if compress_output and \
+                max_open_files > StorageLayout.MAX_COMPRESSED_OPEN_FILES:
+            logging.warn("Keeping at most %d compressed output files open" % (
+                    StorageLayout.MAX_COMPRESSED_OPEN_FILES))
+            max_open_files = StorageLayout.MAX_COMPRESSED_OPEN_FILES
+        if max_open_files > 0:
+            self._files = LRUCache(max_open_files,
+                    on_evict=lambda name, f: self.evict_output(f))
+            self._known_dirs = set()
+        if compress_output:
+            if self._files is None:
+                raise ValueError("Compressing output requires max_open_files")
+            if not compress.has_lzma:
+                raise ValueError("Compressing output requires the lzma module")
 
     def write(self, uuid, obj, dimensions, version=1):
         filename = self._schema.get_filename(self._basedir, dimensions, version)
-        return self.write_filename(uuid, obj, filename)
+        return self.write_filename(uuid, obj, filename, self._compress_output)
 
     def clean_newlines(self, value, tag="value"):
         # Clean any newlines (replace with spaces)
@@ -46,7 +227,7 @@ class StorageLayout:
                 value = value.replace(eol, " ")
         return value
 
-    def write_filename(self, uuid, obj, filename):
+    def write_filename(self, uuid, obj, filename, compress_output=False):
         # Working filename is like
         #   a.b.c.log
         # We want to roll this over (and compress) when it reaches a size limit
@@ -59,6 +240,9 @@ class StorageLayout:
 
         output_line = u"%s\t%s\n" % (uuid, jsonstr)
 
+        if self._files is not None:
+            return self.write_buffered(output_line, filename, compress_output)
+
         dirname = os.path.dirname(filename)
         if dirname != '' and not os.path.exists(dirname):
             fileutil.makedirs_concurrent(dirname)
@@ -75,7 +259,108 @@ class StorageLayout:
         else:
             return filename
 
+    def write_buffered(self, output_line, filename, compress_output=False):
+        output = self._files.get(filename)
+        if output is None:
+            dirname = os.path.dirname(filename)
+            if dirname not in self._known_dirs:
+                if dirname != '' and not os.path.exists(dirname):
+                    fileutil.makedirs_concurrent(dirname)
+                self._known_dirs.add(dirname)
+            if compress_output:
+                output = self._suspended.pop(filename, None)
+                if output is not None:
+                    output.resume()
+                else:
+                    output = CompressedOutputFile(filename,
+                                                  self._compression_level)
+            else:
+                output = OutputFile(filename)
+            self._files.put(filename, output)
+
+        output.write(output_line.encode("utf-8"))
+        if output.pending_bytes >= self.WRITE_BUFFER_BYTES or \
+                output.size + output.pending_bytes >= self._max_log_size:
+            output.flush()
+            if output.size >= self._max_log_size:
+                self._files.pop(filename)
+                if compress_output:
+                    self.close_output(output)
+                    return output.final_name
+                return self.rotate_output(output)
+        return filename
+
+    def flush(self):
+        """Write out all buffered output."""
+        if self._files is not None:
+            for filename, output in self._files.items():
+                output.flush()
+
+    def close_all(self):
+        """Write out all buffered output and close all open files."""
+        if self._files is not None:
+            for filename, output in self._files.items():
+                self.close_output(output)
+            self._files.clear()
+        for filename, output in self._suspended.items():
+            self.close_output(output)
+        self._suspended.clear()
+
+    def evict_output(self, output):
+        if isinstance(output, CompressedOutputFile):
+            output.suspend()
+            self._suspended[output.filename] = output
+        else:
+            self.close_output(output)
+
+    def close_output(self, output):
+        output.close()
+        if isinstance(output, CompressedOutputFile):
+            self._finished.append(output.final_name)
+
+    def pop_finished(self):
+        """Return the compressed files finished since the last call."""
+        finished = self._finished
+        self._finished = []
+        return finished
+
+    def rotate_output(self, output):
+        """Rotate and close an open output file.
+
+        Returns the rotated filename, or the original one if another process
+        rotated the file first.
+        """
+        try:
+            if output.lock():
+                return self.rename_rotated(output.filename)
+            return output.filename
+        finally:
+            # Closing the file releases the lock.
+            os.close(output.fd)
+
     def rotate(self, filename):
+        """Rotate a file that isn't open, holding its flock while it is
+        renamed, so OutputFiles in other processes don't append to it.
+
+        Returns the rotated filename, or the original one if another process
+        rotated the file first.
+        """
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            info = os.fstat(fd)
+            try:
+                current = os.stat(filename)
+            except OSError:
+                return filename
+            if (current.st_dev, current.st_ino) != (info.st_dev, info.st_ino):
+                return filename
+            return self.rename_rotated(filename)
+        finally:
+            # Closing the file releases the lock.
+            os.close(fd)
+
+    def rename_rotated(self, filename):
         logging.debug("Rotating %s" % (filename))
 
         # rename current file
@@ -6,55 +6,423 @@ try:
     import simplejson as json
 except ImportError:
     import json
+import argparse
+import errno
+import fcntl
+import hashlib
 import sys
 import logging
+import marshal
 import os
 import re
+import threading
+import time
 import urllib2
+import uuid
+from collections import OrderedDict
 import telemetry.util.files as fu
+from telemetry.util.lru import LRUCache
+
+class FetchBudget:
+    """The time and retries left for a series of requests to the server."""
+    def __init__(self, seconds, retries):
+        self.deadline = time.time() + seconds
+        self.retries = retries
+
+    def remaining(self):
+        return self.deadline - time.time()
+
+    def use_retry(self, delay):
+        """Use up a retry, if there is one and time to wait `delay` seconds
+        before it. Returns whether to retry."""
+        if self.retries <= 0 or delay >= self.remaining():
+            return False
+        self.retries -= 1
+        return True
 
-# TODO:
-# [ ] Pre-fetch (and cache) all revisions of Histograms.json using something like:
-#      http://hg.mozilla.org/mozilla-central/log/tip/toolkit/components/telemetry/Histograms.json
-#      http://hg.mozilla.org/releases/mozilla-aurora/log/tip/toolkit/components/telemetry/Histograms.json
-#      http://hg.mozilla.org/releases/mozilla-beta/log/tip/toolkit/components/telemetry/Histograms.json
-#      http://hg.mozilla.org/releases/mozilla-release/log/tip/toolkit/components/telemetry/Histograms.json
-#     then link other repository revisions to the relevant Histograms.json revision.
 class RevisionCache:
-    """A class for fetching and caching revisions of a file in mercurial"""
+    """A class for fetching and caching revisions of a file in mercurial
+
+    Each distinct version of Histograms.json is stored once on disk, named by
+    the sha1 of its contents, and parsed at most once in memory. A per-repo
+    index maps revisions to the version that applies to them. prefetch()
+    fills in the whole history of the file for a repo; after that, looking
+    up a new revision only asks the server which change to the file it
+    follows instead of downloading the file again.
+
+    Requests to the server time out after `timeout` seconds, and are retried
+    with exponential backoff. Fetching a revision may take up to
+    `max_fetch_time` seconds and `retries` retries in all, however many
+    requests it needs. Revisions the server doesn't have are remembered (on
+    disk, so other processes see them too) for `not_found_ttl` seconds, and
+    revisions that failed for other reasons for `error_ttl` seconds. Only
+    one process at a time fetches a given revision; the others wait for it
+    (for up to twice `max_fetch_time`) and then use what it saved.
 
-    def __init__(self, cache_dir, server):
+    In memory, up to `max_revisions` revisions per repo and `max_versions`
+    parsed versions of the file are kept. Callers that only need part of
+    the definitions can use get_compiled_for_revision, which keeps a compact
+    form of each version in memory and on disk instead.
+
+    It may be shared by threads. Only the in-memory caches are locked, not
+    requests to the server, which are coalesced by the file lock above.
+    """
+    # Revisions are indexed by their short (12 digit) form, as found in
+    # payloads.
+    SHORT_REVISION_LENGTH = 12
+    # Seconds between checks of a lock held by another process.
+    LOCK_POLL_INTERVAL = 0.05
+
+    def __init__(self, cache_dir, server, timeout=10, retries=2,
+            backoff=1.0, not_found_ttl=3600, error_ttl=60, max_revisions=1000,
+            max_versions=50, max_fetch_time=30):
         self._cache_dir = cache_dir
         self._server = server
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._max_fetch_time = max_fetch_time
+        self._not_found_ttl = not_found_ttl
+        self._error_ttl = error_ttl
+        # (repo, short revision) -> time until which it is known to be missing
+        self._missing = dict()
+        self._max_revisions = max_revisions
+        # repo -> LRUCache of revision -> definitions
         self._repos = dict()
         self._hist_filename = "Histograms.json"
         self._hist_filepath = "toolkit/components/telemetry/" + self._hist_filename
         self._valid_revisions = re.compile('^(http[s]?://[^/]+)/(.+)/rev/([0-9a-f]+)/?$')
+        self._definitions_dir = os.path.join(cache_dir, "definitions")
+        self._index_filename = "revisions.idx"
+        # repo -> {short revision -> content hash}
+        self._indexes = dict()
+        # content hash -> parsed histogram definitions
+        self._parsed = LRUCache(max_versions)
+        # (content hash, format name) -> compiled histogram definitions
+        self._compiled = LRUCache(max_versions)
+        # Where requested revisions came from, for monitoring.
+        self.hits = 0
+        self.disk_loads = 0
+        self.server_loads = 0
+        self.failures = 0
+        self.negative_hits = 0
+        # Guards the in-memory caches and counters.
+        self._lock = threading.RLock()
+
+    def load_disk_cache(self, max_revisions=None, name=None, compile=None):
+        """Load revisions from the disk cache into memory.
+
+        The most recently fetched revisions are loaded first, up to
+        `max_revisions` of them. Returns a list of (repo, revision,
+        histograms) for the revisions that were loaded. If `compile` is
+        given, the compiled form is loaded instead (see
+        get_compiled_for_revision).
+        """
+        found = []
+        for root, dirs, files in os.walk(self._cache_dir):
+            rel = os.path.relpath(root, self._cache_dir)
+            if self._index_filename in files:
+                # Later entries in the index were added more recently.
+                try:
+                    mtime = os.path.getmtime(os.path.join(root,
+                            self._index_filename))
+                except OSError:
+                    continue
+                entries = self.read_index(rel)
+                for i, (revision, digest) in enumerate(entries):
+                    found.append((mtime - (len(entries) - i) * 1e-6, rel,
+                                  revision))
+            if self._hist_filename not in files or os.sep not in rel:
+                continue
+            repo, revision = rel.rsplit(os.sep, 1)
+            try:
+                mtime = os.path.getmtime(os.path.join(root, self._hist_filename))
+            except OSError:
+                continue
+            found.append((mtime, repo, revision))
+        found.sort(reverse=True)
+
+        loaded = []
+        seen = set()
+        for mtime, repo, revision in found:
+            if max_revisions is not None and len(loaded) >= max_revisions:
+                break
+            if (repo, revision) in seen:
+                continue
+            seen.add((repo, revision))
+            if compile is not None:
+                histograms = self.get_compiled(repo, revision, name, compile)
+            else:
+                cached_repo = self.get_repo(repo)
+                if revision in cached_repo:
+                    continue
+                histograms = self.fetch_local(repo, revision)
+                if histograms:
+                    cached_repo.put(revision, histograms)
+            if histograms:
+                loaded.append((repo, revision, histograms))
+        return loaded
+
+    def get_stats(self):
+        # Revisions loaded from disk or the server count as misses.
+        misses = self.disk_loads + self.server_loads + self.failures + \
+                 self.negative_hits
+        return {"hits": self.hits, "misses": misses,
+                "disk_loads": self.disk_loads,
+                "server_loads": self.server_loads,
+                "failures": self.failures,
+                "negative_hits": self.negative_hits}
 
     # TODO:
     #  [ ] deal with 'tip' and other named revisions / tags (fetch from source
     #      with no local cache?)
-    def get_revision(self, repo, revision, parse=True):
-        if repo not in self._repos:
-            self._repos[repo] = dict()
+    def get_repo(self, repo):
+        with self._lock:
+            cached_repo = self._repos.get(repo)
+            if cached_repo is None:
+                cached_repo = self._repos[repo] = LRUCache(self._max_revisions)
+            return cached_repo
 
-        cached_repo = self._repos[repo]
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
 
-        cached_revision = None
-        if revision not in cached_repo:
-            # Fetch it from disk cache
-            cached_revision = self.fetch_disk(repo, revision, parse)
+    def get_revision(self, repo, revision, parse=True):
+        cached_repo = self.get_repo(repo)
+
+        with self._lock:
+            if revision in cached_repo:
+                self.hits += 1
+                return cached_repo.get(revision)
+        # Fetch it from disk cache
+        cached_revision = self.fetch_local(repo, revision, parse)
+        if cached_revision:
+            with self._lock:
+                cached_repo.put(revision, cached_revision)
+                self.disk_loads += 1
+        elif self.is_missing(repo, revision):
+            self.count("negative_hits")
+        else:
+            # Fetch it from the server
+            cached_revision = self.fetch_coalesced(repo, revision, parse)
             if cached_revision:
-                cached_repo[revision] = cached_revision
+                with self._lock:
+                    cached_repo.put(revision, cached_revision)
+                    self.server_loads += 1
             else:
-                # Fetch it from the server
-                cached_revision = self.fetch_server(repo, revision, parse)
-                if cached_revision:
-                    cached_repo[revision] = cached_revision
+                self.count("failures")
+        return cached_revision
+
+    def get_compiled_for_revision(self, revision_url, name, compile):
+        """Return `compile(histogram definitions)` for a revision.
+
+        The result is saved next to the definitions on disk (the compiled
+        form must be marshallable) and shared in memory by all revisions
+        with the same definitions, so Histograms.json is parsed once per
+        version of the file and only the compiled form is kept. `name`
+        identifies the compiled format, and should change along with it.
+        """
+        repo, revision = self.revision_url_to_parts(revision_url)
+        return self.get_compiled(repo, revision, name, compile)
+
+    def get_digest_for_revision(self, revision_url):
+        """Return the SHA1 digest of a revision's histogram definitions, or
+        None if they can't be found. Revisions with the same digest have
+        identical definitions."""
+        repo, revision = self.revision_url_to_parts(revision_url)
+        return self.fetch_digest(repo, revision)[0]
+
+    def fetch_digest(self, repo, revision):
+        """Return (digest, whether the revision came from the server)."""
+        digest = self.get_index(repo).get(self.short_revision(revision))
+        if digest is not None:
+            return digest, False
+        from_server = False
+        # Make sure the revision is on disk and indexed.
+        contents = self.fetch_disk(repo, revision, parse=False)
+        if contents:
+            self.save_to_cache(repo, revision, contents)
+        elif self.is_missing(repo, revision):
+            self.count("negative_hits")
+            return None, False
+        elif self.fetch_coalesced(repo, revision, parse=False) is None:
+            self.count("failures")
+            return None, False
         else:
-            cached_revision = cached_repo[revision]
+            from_server = True
+        digest = self.get_index(repo).get(self.short_revision(revision))
+        if digest is None:
+            self.count("failures")
+        return digest, from_server
+
+    def get_compiled(self, repo, revision, name, compile):
+        digest, from_server = self.fetch_digest(repo, revision)
+        if digest is None:
+            return None
+
+        with self._lock:
+            compiled = self._compiled.get((digest, name))
+            if compiled is not None:
+                self.hits += 1
+                return compiled
+        compiled = self.load_compiled(digest, name, compile)
+        if compiled is None:
+            self.count("failures")
+            return None
+        with self._lock:
+            if from_server:
+                self.server_loads += 1
+            else:
+                self.disk_loads += 1
+            self._compiled.put((digest, name), compiled)
+        return compiled
+
+    def load_compiled(self, digest, name, compile):
+        filename = os.path.join(self._definitions_dir,
+                "%s.%s.marshal" % (digest, name))
+        try:
+            with open(filename, "rb") as f:
+                return marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        contents = self.load_definitions(digest, False)
+        if contents is None:
+            return None
+        # Keep the order of the file, in case the compiled form depends on it.
+        compiled = compile(json.loads(contents, object_pairs_hook=OrderedDict))
+        tmp_name = "%s.%s.tmp" % (filename, uuid.uuid4().hex)
+        try:
+            with open(tmp_name, "wb") as fout:
+                marshal.dump(compiled, fout)
+            os.rename(tmp_name, filename)
+        except (IOError, OSError), e:
+            logging.info("failed to save %s: %s\n" % (filename, e))
+        return compiled
+
+    def fetch_local(self, repo, revision, parse=True):
+        cached_revision = self.fetch_indexed(repo, revision, parse)
+        if cached_revision is None:
+            cached_revision = self.fetch_disk(repo, revision, parse)
         return cached_revision
 
+    def fetch_coalesced(self, repo, revision, parse=True):
+        """Fetch a revision from the server, unless another process is
+        already doing so, in which case wait for it and use its result."""
+        lock_filename = os.path.join(self._cache_dir, repo, "locks",
+                self.short_revision(revision) + ".lock")
+        fu.makedirs_concurrent(os.path.dirname(lock_filename))
+        fd = os.open(lock_filename, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            if not self.lock_file(fd, 2 * self._max_fetch_time):
+                logging.info("timed out waiting for %s revision %s\n" % (repo, revision))
+                return None
+            # Somebody else may have fetched it while we waited.
+            if self.get_index(repo, reload=True).get(self.short_revision(revision)):
+                return self.fetch_local(repo, revision, parse)
+            with self._lock:
+                self._missing.pop((repo, self.short_revision(revision)), None)
+            if self.is_missing(repo, revision):
+                return None
+            # Both ways of fetching share one budget, which bounds how long
+            # we hold the lock.
+            budget = FetchBudget(self._max_fetch_time, self._retries)
+            cached_revision = self.resolve_server(repo, revision, parse, budget)
+            if cached_revision is None:
+                cached_revision = self.fetch_server(repo, revision, parse,
+                                                    budget)
+            if cached_revision is not None:
+                # Anyone still waiting has the file open, and will find the
+                # revision in the index.
+                try:
+                    os.remove(lock_filename)
+                except OSError:
+                    pass
+            return cached_revision
+        finally:
+            os.close(fd)
+
+    def lock_file(self, fd, timeout):
+        """Lock `fd`, waiting up to `timeout` seconds. Returns whether it
+        was locked."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.time() >= deadline:
+                return False
+            time.sleep(self.LOCK_POLL_INTERVAL)
+
+    def get_missing_filename(self, repo, revision):
+        return os.path.join(self._cache_dir, repo, "missing",
+                self.short_revision(revision))
+
+    def is_missing(self, repo, revision):
+        """Check if a recent attempt to fetch `revision` failed."""
+        key = (repo, self.short_revision(revision))
+        with self._lock:
+            expires = self._missing.get(key)
+        if expires is None:
+            try:
+                with open(self.get_missing_filename(repo, revision)) as f:
+                    expires = float(f.read())
+            except (IOError, ValueError):
+                expires = 0
+            with self._lock:
+                self._missing[key] = expires
+        if expires > time.time():
+            return True
+        if expires:
+            # It has expired, try again.
+            with self._lock:
+                self._missing[key] = 0
+            try:
+                os.remove(self.get_missing_filename(repo, revision))
+            except OSError:
+                pass
+        return False
+
+    def set_missing(self, repo, revision, ttl):
+        expires = time.time() + ttl
+        with self._lock:
+            self._missing[(repo, self.short_revision(revision))] = expires
+        filename = self.get_missing_filename(repo, revision)
+        try:
+            fu.makedirs_concurrent(os.path.dirname(filename))
+            with open(filename, "w") as fout:
+                fout.write(str(expires))
+        except (IOError, OSError):
+            logging.info("failed to save missing revision %s %s\n" % (repo, revision))
+
+    def open_url(self, url, budget=None):
+        """Open `url`, retrying timeouts and server errors with backoff.
+
+        Client errors (like 404) are raised right away. Retries and time are
+        taken from `budget`, which may be shared with other requests.
+        """
+        if budget is None:
+            budget = FetchBudget(self._max_fetch_time, self._retries)
+        attempt = 0
+        while True:
+            remaining = budget.remaining()
+            if remaining <= 0:
+                raise IOError("ran out of time fetching %s" % url)
+            delay = self._backoff * (2 ** attempt)
+            try:
+                return urllib2.urlopen(url, timeout=min(self._timeout, remaining))
+            except urllib2.HTTPError, e:
+                if e.code < 500 or not budget.use_retry(delay):
+                    raise
+            except IOError, e:
+                # Includes URLError and socket errors (like timeouts).
+                if not budget.use_retry(delay):
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
     # Returns (repository name, revision)
     def revision_url_to_parts(self, revision_url):
         m = self._valid_revisions.match(revision_url)
@@ -76,14 +444,112 @@ class RevisionCache:
         repo, revision = self.revision_url_to_parts(revision_url)
         return self.get_revision(repo, revision, parse)
 
+    def short_revision(self, revision):
+        return revision[0:RevisionCache.SHORT_REVISION_LENGTH]
+
+    def get_index_filename(self, repo):
+        return os.path.join(self._cache_dir, repo, self._index_filename)
+
+    def read_index(self, repo):
+        """Return the (revision, content hash) entries in a repo's index."""
+        entries = []
+        try:
+            with open(self.get_index_filename(repo)) as index:
+                for line in index:
+                    parts = line.split()
+                    # Skip partially written lines.
+                    if len(parts) == 2 and len(parts[1]) == 40:
+                        entries.append((parts[0], parts[1]))
+        except IOError:
+            pass
+        return entries
+
+    def get_index(self, repo, reload=False):
+        with self._lock:
+            index = self._indexes.get(repo)
+        if index is None or reload:
+            # Read it without the lock, and replace it all at once.
+            index = dict(self.read_index(repo))
+            with self._lock:
+                self._indexes[repo] = index
+        return index
+
+    def add_to_index(self, repo, revision, digest):
+        revision = self.short_revision(revision)
+        index = self.get_index(repo)
+        with self._lock:
+            if index.get(revision) == digest:
+                return
+            index[revision] = digest
+        filename = self.get_index_filename(repo)
+        fu.makedirs_concurrent(os.path.dirname(filename))
+        # Other processes may be adding to the index too, so write each entry
+        # with a single append.
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, "%s %s\n" % (revision, digest))
+        finally:
+            os.close(fd)
+
+    def get_definitions_filename(self, digest):
+        return os.path.join(self._definitions_dir, digest + ".json")
+
+    def store_definitions(self, contents):
+        """Save one version of Histograms.json, and return its hash."""
+        digest = hashlib.sha1(contents).hexdigest()
+        filename = self.get_definitions_filename(digest)
+        if not os.path.exists(filename):
+            fu.makedirs_concurrent(self._definitions_dir)
+            # Write it under a temporary name so that readers never see a
+            # partial file.
+            tmp_name = "%s.%s.tmp" % (filename, uuid.uuid4().hex)
+            with open(tmp_name, "w") as fout:
+                fout.write(contents)
+            os.rename(tmp_name, filename)
+        return digest
+
+    def parse_definitions(self, contents, digest=None):
+        # Many revisions share the same definitions, so only parse (and
+        # keep) each version once.
+        if digest is None:
+            digest = hashlib.sha1(contents).hexdigest()
+        with self._lock:
+            histograms = self._parsed.get(digest)
+        if histograms is None:
+            histograms = json.loads(contents)
+            # TODO: validate the resulting obj.
+            with self._lock:
+                self._parsed.put(digest, histograms)
+        return histograms
+
+    def load_definitions(self, digest, parse=True):
+        if parse:
+            with self._lock:
+                histograms = self._parsed.get(digest)
+            if histograms is not None:
+                return histograms
+        try:
+            with open(self.get_definitions_filename(digest)) as f:
+                contents = f.read()
+        except IOError:
+            return None
+        if parse:
+            return self.parse_definitions(contents, digest)
+        return contents
+
+    def fetch_indexed(self, repo, revision, parse=True):
+        digest = self.get_index(repo).get(self.short_revision(revision))
+        if digest is None:
+            return None
+        return self.load_definitions(digest, parse)
+
     def fetch_disk(self, repo, revision, parse=True):
         filename = os.path.join(self._cache_dir, repo, revision, self._hist_filename)
         histograms = None
         try:
             f = open(filename, "r")
             if parse:
-                histograms = json.load(f)
-                # TODO: validate the resulting obj.
+                histograms = self.parse_definitions(f.read())
             else:
                 histograms = f.read()
         except:
@@ -92,35 +558,111 @@ class RevisionCache:
             pass
         return histograms
 
-    def fetch_server(self, repo, revision, parse=True):
+    def fetch_raw(self, repo, revision, budget=None):
         url = '/'.join(('http:/', self._server, repo, 'raw-file', revision, self._hist_filepath))
+        response = self.open_url(url, budget)
+        histograms_json = response.read()
+        # Bug 920169 - replace calculated values/constants with their
+        #              actual values:
+        histograms_json = histograms_json.replace('"JS::gcreason::NUM_TELEMETRY_REASONS"', "101")
+        histograms_json = histograms_json.replace('"mozilla::StartupTimeline::MAX_EVENT_ID"', "12")
+        histograms_json = histograms_json.replace('"80 + 1"', "81")
+        return histograms_json
+
+    def fetch_changes(self, repo, revision, count, budget=None):
+        """Return the nodes of the last `count` changes to Histograms.json
+        at or before `revision`, newest first."""
+        url = '/'.join(('http:/', self._server, repo, 'json-filelog', revision,
+                        self._hist_filepath)) + "?revcount=%d" % count
+        response = self.open_url(url, budget)
+        return [e["node"] for e in json.load(response)["entries"]]
+
+    def fetch_server(self, repo, revision, parse=True, budget=None):
         histograms = None
         try:
-            response = urllib2.urlopen(url)
-            histograms_json = response.read()
-            # Bug 920169 - replace calculated values/constants with their
-            #              actual values:
-            histograms_json = histograms_json.replace('"JS::gcreason::NUM_TELEMETRY_REASONS"', "101")
-            histograms_json = histograms_json.replace('"mozilla::StartupTimeline::MAX_EVENT_ID"', "12")
-            histograms_json = histograms_json.replace('"80 + 1"', "81")
+            histograms_json = self.fetch_raw(repo, revision, budget)
             if parse:
-                histograms = json.loads(histograms_json)
-                # TODO: validate the resulting obj.
+                histograms = self.parse_definitions(histograms_json)
             else:
                 histograms = histograms_json
             self.save_to_cache(repo, revision, histograms_json)
+        except urllib2.HTTPError, e:
+            logging.info("failed to load %s revision %s from server: %s\n" % (repo, revision, e))
+            if e.code == 404:
+                self.set_missing(repo, revision, self._not_found_ttl)
+            else:
+                self.set_missing(repo, revision, self._error_ttl)
         except:
             # TODO: better error handling
-            # TODO: cache 404s so we don't keep trying them
-            logging.info("failed to load '%s' from server\n" % url)
+            logging.info("failed to load %s revision %s from server\n" % (repo, revision))
+            self.set_missing(repo, revision, self._error_ttl)
         return histograms
 
+    def resolve_server(self, repo, revision, parse=True, budget=None):
+        """Find the version of Histograms.json that applies to `revision`
+        by asking the server which change to the file it follows.
+
+        Only downloads the file if that change hasn't been fetched yet.
+        Returns None if the server can't tell us.
+        """
+        try:
+            changes = self.fetch_changes(repo, revision, 1, budget)
+            if not changes:
+                return None
+            node = changes[0]
+            digest = self.get_index(repo).get(self.short_revision(node))
+            if digest is None or self.load_definitions(digest, False) is None:
+                digest = self.store_definitions(self.fetch_raw(repo, node,
+                                                               budget))
+                self.add_to_index(repo, node, digest)
+            self.add_to_index(repo, revision, digest)
+            return self.load_definitions(digest, parse)
+        except:
+            logging.info("failed to resolve %s revision %s on server\n" % (repo, revision))
+        return None
+
+    def prefetch(self, repo, max_changes=100000):
+        """Fetch every version of Histograms.json in a repo's history.
+
+        Returns the number of versions that weren't already cached.
+        """
+        index = self.get_index(repo)
+        fetched = 0
+        for node in self.fetch_changes(repo, "tip", max_changes):
+            if self.short_revision(node) in index:
+                continue
+            digest = self.store_definitions(self.fetch_raw(repo, node))
+            self.add_to_index(repo, node, digest)
+            fetched += 1
+        return fetched
+
     def save_to_cache(self, repo, revision, contents):
-        filename = os.path.join(self._cache_dir, repo, revision, "Histograms.json")
+        digest = self.store_definitions(contents)
+        self.add_to_index(repo, revision, digest)
+        # Keep the per-revision layout too, as a link to the shared copy.
+        filename = os.path.join(self._cache_dir, repo, revision, self._hist_filename)
+        if os.path.exists(filename):
+            return
+        fu.makedirs_concurrent(os.path.dirname(filename))
         try:
+            os.link(self.get_definitions_filename(digest), filename)
+        except OSError:
             fout = open(filename, 'w')
-        except IOError:
-            fu.makedirs_concurrent(os.path.dirname(filename))
-            fout = open(filename, 'w')
-        fout.write(contents)
-        fout.close()
+            fout.write(contents)
+            fout.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch the full history of Histograms.json for some repositories", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-c", "--cache-dir", help="Histogram revision cache directory", default="./histogram_cache")
+    parser.add_argument("-s", "--server", help="Server to fetch histogram revisions from", default="hg.mozilla.org")
+    parser.add_argument("repos", nargs="+", help="Repositories to fetch, like 'mozilla-central' or 'releases/mozilla-beta'")
+    args = parser.parse_args()
+
+    cache = RevisionCache(args.cache_dir, args.server)
+    for repo in args.repos:
+        print "Fetched %d new versions for %s" % (cache.prefetch(repo), repo)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
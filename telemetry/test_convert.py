@@ -1,3 +1,5 @@
+# encoding: utf-8
+
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
@@ -529,8 +531,11 @@ class ConvertTest(unittest.TestCase):
         histograms[bogus_name] = histograms["STARTUP_DNS_LOOKUP_TIME"]
         revision = self.get_revision()
         rewritten = ConvertTest.converter.rewrite_hists(revision, histograms)
-        # The bogus histogram should be skipped.
+        # The bogus histogram should be skipped, and not remembered.
         self.assertNotIn(bogus_name, rewritten)
+        histogram_defs, layouts = \
+                ConvertTest.converter.get_revision_layouts(revision)
+        self.assertNotIn(bogus_name, layouts)
 
         # But everything else should have been translated properly.
         expected_converted_histograms = self.get_converted_histograms()
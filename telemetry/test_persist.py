@@ -4,10 +4,13 @@
 
 import os
 import shutil
+import threading
+import time
 import unittest
-from telemetry.persist import StorageLayout
+from telemetry.persist import OutputFile, StorageLayout
 from telemetry.telemetry_schema import TelemetrySchema
 import telemetry.util.files as fileutil
+import telemetry.util.compress as compress
 
 class TestPersist(unittest.TestCase):
     def setUp(self):
@@ -99,5 +102,128 @@ class TestPersist(unittest.TestCase):
         self.assertTrue(rolled.startswith(test_file))
         self.assertTrue(rolled.endswith(StorageLayout.PENDING_COMPRESSION_SUFFIX))
 
+    def test_write_buffered(self):
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000, 2)
+        test_files = [os.path.join(self.get_test_dir(), "sub", "test%d.log" % i)
+                      for i in range(3)]
+        for test_file in test_files:
+            storage.write_filename("foo", '{"bar":"baz"}', test_file)
+        # Opening the third file closed (and wrote out) the first.
+        self.assertEqual("0ea91df239ea79ed2ebab34b46d455fc",
+                         fileutil.md5file(test_files[0])[0])
+        storage.close_all()
+        for test_file in test_files:
+            self.assertEqual("0ea91df239ea79ed2ebab34b46d455fc",
+                             fileutil.md5file(test_file)[0])
+
+    def test_rotate_buffered(self):
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000, 10)
+        test_file = os.path.join(self.get_test_dir(), "test.log")
+        key = "01234567890123456789012345678901234567890123456789"
+        value = '{"some filler stuff here":"fffffffffffffffffff"}'
+        for i in range(99):
+            result = storage.write_filename(key, value, test_file)
+            self.assertEquals(result, test_file)
+
+        rolled = storage.write_filename(key, value, test_file)
+        self.assertNotEqual(rolled, test_file)
+        self.assertTrue(rolled.endswith(StorageLayout.PENDING_COMPRESSION_SUFFIX))
+        self.assertEqual(10000, os.path.getsize(rolled))
+
+    def test_rotated_elsewhere(self):
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000, 10)
+        test_file = os.path.join(self.get_test_dir(), "test.log")
+        storage.write_filename("foo", '{"bar":"baz"}', test_file)
+        storage.flush()
+        # Another process rotates the file while we have it open.
+        rotated = self.storage.rotate(test_file)
+        storage.write_filename("foo", '{"bar":"baz"}', test_file)
+        storage.close_all()
+        self.assertEqual("0ea91df239ea79ed2ebab34b46d455fc",
+                         fileutil.md5file(rotated)[0])
+        self.assertEqual("0ea91df239ea79ed2ebab34b46d455fc",
+                         fileutil.md5file(test_file)[0])
+
+    def test_rotate_locked(self):
+        test_file = os.path.join(self.get_test_dir(), "test.log")
+        self.storage.write_filename("foo", '{"bar":"baz"}', test_file)
+        # Another process is appending to the file.
+        output = OutputFile(test_file)
+        output.lock()
+        rotated = []
+        rotator = threading.Thread(
+                target=lambda: rotated.append(self.storage.rotate(test_file)))
+        rotator.start()
+        time.sleep(0.1)
+        self.assertTrue(os.path.exists(test_file))
+        self.assertEqual([], rotated)
+        output.unlock()
+        rotator.join()
+        output.close()
+        self.assertNotEqual(test_file, rotated[0])
+        self.assertFalse(os.path.exists(test_file))
+        self.assertEqual("0ea91df239ea79ed2ebab34b46d455fc",
+                         fileutil.md5file(rotated[0])[0])
+
+    @unittest.skipUnless(compress.has_lzma, "needs the lzma module")
+    def test_compress_output(self):
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000, 10,
+                                compress_output=True)
+        dims = ["r1", "a1", "c1", "v1", "b1", "20130102"]
+        test_file = self.schema.get_filename(self.get_test_dir(), dims)
+        key = "01234567890123456789012345678901234567890123456789"
+        value = '{"some filler stuff here":"fffffffffffffffffff"}'
+        for i in range(99):
+            self.assertEqual(test_file, storage.write(key, value, dims))
+        rolled = storage.write(key, value, dims)
+        self.assertTrue(rolled.startswith(test_file + "."))
+        self.assertTrue(rolled.endswith(StorageLayout.COMPRESSED_SUFFIX))
+        storage.write(key, value, dims)
+        storage.close_all()
+
+        outputs = sorted(os.listdir(os.path.dirname(test_file)))
+        self.assertEqual(2, len(outputs))
+        lines = []
+        for f in outputs:
+            self.assertTrue(f.endswith(StorageLayout.COMPRESSED_SUFFIX))
+            c = compress.CompressedFile(os.path.join(os.path.dirname(test_file), f))
+            lines.extend(c)
+            c.close()
+        self.assertEqual(101, len(lines))
+        self.assertEqual("%s\t%s\n" % (key, value), lines[0])
+
+        # Each open file holds a compressor, so don't keep too many open.
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000, 256,
+                                compress_output=True)
+        self.assertEqual(StorageLayout.MAX_COMPRESSED_OPEN_FILES,
+                         storage._files.max_size)
+
+    @unittest.skipUnless(compress.has_lzma, "needs the lzma module")
+    def test_compress_output_evicted(self):
+        # Files evicted from the open set are resumed, not finished early.
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000, 2,
+                                compress_output=True)
+        versions = ["v1", "v2", "v3", "v4"]
+        for i in range(40):
+            dims = ["r1", "a1", "c1", versions[i % 4], "b1", "20130102"]
+            storage.write("key%d" % i, "value", dims)
+        storage.close_all()
+        self.assertEqual(4, len(storage.pop_finished()))
+
+        for version in versions:
+            dims = ["r1", "a1", "c1", version, "b1", "20130102"]
+            test_file = self.schema.get_filename(self.get_test_dir(), dims)
+            outputs = [f for f in os.listdir(os.path.dirname(test_file))
+                       if f.startswith(os.path.basename(test_file) + ".")]
+            self.assertEqual(1, len(outputs))
+            self.assertTrue(outputs[0].endswith(StorageLayout.COMPRESSED_SUFFIX))
+            c = compress.CompressedFile(os.path.join(os.path.dirname(test_file),
+                                                     outputs[0]))
+            lines = list(c)
+            c.close()
+            self.assertEqual(10, len(lines))
+            self.assertEqual("key%d\tvalue\n" % versions.index(version),
+                             lines[0])
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,11 +2,45 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import fcntl
 import os
 import revision_cache
 import shutil
+import threading
+import time
 import unittest
 import json
+import BaseHTTPServer
+import SocketServer
+
+class FakeHgHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves Histograms.json for any revision, after `delays` (one per
+    request, in seconds) run out. Only raw-file requests are answered."""
+    requests = []
+    delays = []
+    status = 200
+
+    def do_GET(self):
+        FakeHgHandler.requests.append(self.path)
+        if FakeHgHandler.delays:
+            time.sleep(FakeHgHandler.delays.pop(0))
+        if "/raw-file/" not in self.path or FakeHgHandler.status != 200:
+            self.send_response(404 if "/raw-file/" not in self.path else FakeHgHandler.status)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('{"A11Y_INSTANTIATED_FLAG": {"kind": "flag"}}')
+
+    def log_message(self, *args):
+        pass
+
+class FakeHgServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out have hung up.
+        pass
 
 class TestRevisionCache(unittest.TestCase):
     def setUp(self):
@@ -122,5 +156,209 @@ class TestRevisionCache(unittest.TestCase):
         parsed = json.loads(revision)
         self.assertIn("A11Y_INSTANTIATED_FLAG", parsed)
 
+    def test_load_disk_cache(self):
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), 'hg.mozilla.org')
+        os.makedirs(os.path.join(self.get_test_dir(), 'mozilla-central', 'aaa'))
+        os.makedirs(os.path.join(self.get_test_dir(), 'releases/mozilla-beta', 'bbb'))
+        rcache.save_to_cache('mozilla-central', 'aaa', '{"A": {"kind": "flag"}}')
+        rcache.save_to_cache('releases/mozilla-beta', 'bbb', '{"B": {"kind": "flag"}}')
+        os.utime(os.path.join(self.get_test_dir(), 'mozilla-central', 'aaa',
+                 'Histograms.json'), (1, 1))
+
+        # Most recent first.
+        loaded = rcache.load_disk_cache(1)
+        self.assertEqual([('releases/mozilla-beta', 'bbb', {"B": {"kind": "flag"}})], loaded)
+        loaded = rcache.load_disk_cache()
+        self.assertEqual([('mozilla-central', 'aaa', {"A": {"kind": "flag"}})], loaded)
+
+        # Loaded revisions are served from memory.
+        self.assertEqual({"A": {"kind": "flag"}},
+                         rcache.get_revision('mozilla-central', 'aaa'))
+        stats = rcache.get_stats()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(0, stats["misses"])
+
+    def test_shared_definitions(self):
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), 'hg.mozilla.org')
+        contents = '{"A": {"kind": "flag"}}'
+        rcache.save_to_cache('mozilla-central', 'aaaaaaaaaaaa', contents)
+        rcache.save_to_cache('mozilla-central', 'bbbbbbbbbbbbbbbb', contents)
+        rcache.save_to_cache('releases/mozilla-beta', 'cccccccccccc', '{"B": {}}')
+        self.assertEqual(2, len(os.listdir(os.path.join(self.get_test_dir(), 'definitions'))))
+
+        # A fresh cache finds them through the index, and parses each
+        # version once.
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), 'hg.mozilla.org')
+        a = rcache.get_revision('mozilla-central', 'aaaaaaaaaaaa')
+        b = rcache.get_revision('mozilla-central', 'bbbbbbbbbbbb')
+        self.assertEqual({"A": {"kind": "flag"}}, a)
+        self.assertIs(a, b)
+        self.assertEqual(contents, rcache.get_revision('mozilla-central',
+                         'aaaaaaaaaaaa1234', parse=False))
+        self.assertEqual({"B": {}}, rcache.get_revision('releases/mozilla-beta', 'cccccccccccc'))
+        self.assertEqual(0, rcache.get_stats()["server_loads"])
+
+    def test_compiled(self):
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), 'hg.mozilla.org')
+        rcache.save_to_cache('mozilla-central', 'aaaaaaaaaaaa', '{"A": {"kind": "flag"}}')
+        rcache.save_to_cache('mozilla-central', 'bbbbbbbbbbbb', '{"A": {"kind": "flag"}}')
+        calls = []
+        def compile(histograms):
+            calls.append(histograms)
+            return sorted(histograms.keys())
+        url = 'http://hg.mozilla.org/mozilla-central/rev/'
+        a = rcache.get_compiled_for_revision(url + 'aaaaaaaaaaaa', 'test', compile)
+        b = rcache.get_compiled_for_revision(url + 'bbbbbbbbbbbb', 'test', compile)
+        self.assertEqual(["A"], a)
+        self.assertIs(a, b)
+        self.assertEqual(1, len(calls))
+
+        # Other processes load the compiled form from disk.
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), 'hg.mozilla.org')
+        self.assertEqual(["A"], rcache.get_compiled_for_revision(
+                url + 'bbbbbbbbbbbb', 'test', compile))
+        self.assertEqual(1, len(calls))
+
+    def test_digest(self):
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), 'hg.mozilla.org')
+        rcache.save_to_cache('mozilla-central', 'aaaaaaaaaaaa', '{"A": {"kind": "flag"}}')
+        rcache.save_to_cache('mozilla-central', 'bbbbbbbbbbbb', '{"A": {"kind": "flag"}}')
+        rcache.save_to_cache('mozilla-central', 'cccccccccccc', '{"C": {"kind": "flag"}}')
+        url = 'http://hg.mozilla.org/mozilla-central/rev/'
+        a = rcache.get_digest_for_revision(url + 'aaaaaaaaaaaa')
+        self.assertEqual(40, len(a))
+        self.assertEqual(a, rcache.get_digest_for_revision(url + 'bbbbbbbbbbbb'))
+        self.assertNotEqual(a, rcache.get_digest_for_revision(url + 'cccccccccccc'))
+
+    def test_memory_bound(self):
+        rcache = revision_cache.RevisionCache(self.get_test_dir(),
+                'hg.mozilla.org', max_revisions=2)
+        for rev in ['a', 'b', 'c']:
+            rcache.save_to_cache('mozilla-central', rev * 12, '{"%s": {}}' % rev)
+            rcache.get_revision('mozilla-central', rev * 12)
+        self.assertEqual(2, len(rcache._repos['mozilla-central']))
+        self.assertNotIn('a' * 12, rcache._repos['mozilla-central'])
+
+    def start_server(self, status=200, delays=[]):
+        FakeHgHandler.requests = []
+        FakeHgHandler.status = status
+        FakeHgHandler.delays = list(delays)
+        server = FakeHgServer(("localhost", 0), FakeHgHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        return "localhost:%d" % server.server_address[1]
+
+    def raw_requests(self):
+        return [r for r in FakeHgHandler.requests if "/raw-file/" in r]
+
+    def test_not_found(self):
+        server = self.start_server(status=404)
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), server,
+                not_found_ttl=1)
+        self.assertIsNone(rcache.get_revision('mozilla-central', 'aaaaaaaaaaaa'))
+        self.assertEqual(1, len(self.raw_requests()))
+        # Not asked again, by this process or another.
+        self.assertIsNone(rcache.get_revision('mozilla-central', 'aaaaaaaaaaaa'))
+        other = revision_cache.RevisionCache(self.get_test_dir(), server)
+        self.assertIsNone(other.get_revision('mozilla-central', 'aaaaaaaaaaaa'))
+        self.assertEqual(1, len(self.raw_requests()))
+        self.assertEqual(1, rcache.get_stats()["negative_hits"])
+
+        # Until it expires.
+        time.sleep(1.1)
+        FakeHgHandler.status = 200
+        self.assertIsNotNone(rcache.get_revision('mozilla-central', 'aaaaaaaaaaaa'))
+
+    def test_timeout(self):
+        # The first attempt times out, the retry works.
+        server = self.start_server(delays=[0, 1.0])
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), server,
+                timeout=0.3, backoff=0.01)
+        self.assertIn("A11Y_INSTANTIATED_FLAG",
+                      rcache.get_revision('mozilla-central', 'aaaaaaaaaaaa'))
+        self.assertEqual(2, len(self.raw_requests()))
+
+        # Errors are remembered too, but not for as long.
+        server = self.start_server(status=500)
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), server,
+                retries=1, backoff=0.01, error_ttl=1)
+        self.assertIsNone(rcache.get_revision('mozilla-central', 'bbbbbbbbbbbb'))
+        self.assertEqual(2, len(self.raw_requests()))
+        self.assertTrue(rcache.is_missing('mozilla-central', 'bbbbbbbbbbbb'))
+        self.assertIsNone(rcache.get_revision('mozilla-central', 'bbbbbbbbbbbb'))
+        other = revision_cache.RevisionCache(self.get_test_dir(), server)
+        self.assertTrue(other.is_missing('mozilla-central', 'bbbbbbbbbbbb'))
+        self.assertEqual(2, len(self.raw_requests()))
+        time.sleep(1.1)
+        self.assertFalse(rcache.is_missing('mozilla-central', 'bbbbbbbbbbbb'))
+        self.assertIsNone(rcache.get_revision('mozilla-central', 'bbbbbbbbbbbb'))
+        self.assertEqual(4, len(self.raw_requests()))
+
+    def test_fetch_time(self):
+        # Every request times out. Retries stop when the time runs out,
+        # rather than after `retries` of them.
+        server = self.start_server(delays=[1.0] * 20)
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), server,
+                timeout=0.3, retries=10, backoff=0.01, max_fetch_time=1)
+        start = time.time()
+        self.assertIsNone(rcache.get_revision('mozilla-central', 'aaaaaaaaaaaa'))
+        self.assertLess(time.time() - start, 1.5)
+        self.assertLess(len(FakeHgHandler.requests), 6)
+
+        # Somebody else holding the lock for too long makes us give up.
+        lock_filename = os.path.join(self.get_test_dir(), 'mozilla-central',
+                'locks', 'bbbbbbbbbbbb.lock')
+        with open(lock_filename, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            rcache = revision_cache.RevisionCache(self.get_test_dir(), server,
+                    max_fetch_time=0.2)
+            requests = len(FakeHgHandler.requests)
+            start = time.time()
+            self.assertIsNone(rcache.get_revision('mozilla-central', 'bbbbbbbbbbbb'))
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(requests, len(FakeHgHandler.requests))
+        # Nor does it count as an error.
+        self.assertFalse(rcache.is_missing('mozilla-central', 'bbbbbbbbbbbb'))
+
+    def test_coalesced(self):
+        server = self.start_server(delays=[0, 0.5])
+        results = []
+        def fetch():
+            rcache = revision_cache.RevisionCache(self.get_test_dir(), server)
+            results.append(rcache.get_revision('mozilla-central', 'aaaaaaaaaaaa'))
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(4, len(results))
+        for r in results:
+            self.assertIn("A11Y_INSTANTIATED_FLAG", r)
+        self.assertEqual(1, len(self.raw_requests()))
+
+    def test_threads(self):
+        # Threads sharing a cache fetch different revisions at the same time,
+        # and the same revision once.
+        server = self.start_server(delays=[0.5] * 4)
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), server)
+        results = []
+        def fetch(revision):
+            results.append(rcache.get_revision('mozilla-central', revision))
+        threads = [threading.Thread(target=fetch, args=(r * 12,))
+                   for r in ['a', 'b'] * 4]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Each fetch takes 1s, so they overlapped.
+        self.assertLess(time.time() - start, 1.8)
+        self.assertEqual(8, len(results))
+        for r in results:
+            self.assertIn("A11Y_INSTANTIATED_FLAG", r)
+        self.assertEqual(2, len(self.raw_requests()))
+
 if __name__ == "__main__":
     unittest.main()
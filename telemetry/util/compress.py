@@ -8,7 +8,9 @@
 import gzip
 import os
 import sys
+import zlib
 from subprocess import Popen, PIPE
+from telemetry.util.files import GZIP_MAGIC
 try:
     import lzma
     has_lzma = True
@@ -18,6 +20,16 @@ except ImportError:
         has_lzma = True
     except ImportError:
         has_lzma = False
+try:
+    import snappy
+    has_snappy = True
+except ImportError:
+    has_snappy = False
+try:
+    from lz4 import block as lz4_block
+    has_lz4 = True
+except ImportError:
+    has_lz4 = False
 
 class CompressedFile():
     SEARCH_PATH = ['/usr/bin', '/usr/local/bin']
@@ -50,7 +62,7 @@ class CompressedFile():
         else:
             self.can_read = False
 
-        if self.mode.startswith("w"):
+        if self.mode.startswith("w") or self.mode.startswith("a"):
             self.can_write = True
         else:
             self.can_write = False
@@ -86,15 +98,15 @@ class CompressedFile():
 
                     # Use stdout from the child process as the readable handle.
                     self.handle = self.child_process.stdout
-                elif self.mode == 'w':
+                elif self.mode == 'w' or self.mode == 'a':
                     # By default, use "-0" compression preset for best speed.
                     level = 0
                     if self.compression_level is not None:
                         level = self.compression_level
                     compress_cmd = [self.get_executable(), "-{}".format(level)]
 
-                    # Open the actual file.
-                    self.raw_handle = open(self.filename, "wb")
+                    # Open the actual file. Appending adds another stream.
+                    self.raw_handle = open(self.filename, self.mode + "b")
 
                     # Popen the compress command, redirecting output to our
                     # file handle.
@@ -173,3 +185,141 @@ class CompressedFile():
         last_dot = filename.rfind(".")
         compression_type = filename[last_dot + 1:]
         return compression_type
+
+
+class CompressedStream():
+    """Iterate the lines of compressed data arriving as a series of chunks.
+
+    `chunks` is any iterable of compressed byte strings (for example, the
+    contents of an S3 key as it is being downloaded). The data is decompressed
+    in-process as it arrives, so nothing needs to be written to disk first.
+    """
+    def __init__(self, chunks, compression_type, name=None):
+        self.source = chunks
+        self.chunks = iter(chunks)
+        self.compression_type = compression_type
+        self.filename = name
+        self.line_num = 0
+        self._pending = []
+        self._lines = iter([])
+        if compression_type == 'lzma' or compression_type == 'xz':
+            if not has_lzma:
+                raise RuntimeError("Streaming decompression of '{}' data " \
+                                   "requires the lzma module".format(
+                                        compression_type))
+        elif compression_type != 'gz':
+            raise ValueError("Unknown compression type:" \
+                             " '{}'".format(compression_type))
+        self.decompressor = self.new_decompressor()
+
+    def new_decompressor(self):
+        if self.compression_type == 'gz':
+            # 16 + MAX_WBITS tells zlib to expect a gzip header.
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # FORMAT_AUTO handles both the .xz and legacy .lzma containers.
+        return lzma.LZMADecompressor()
+
+    def close(self):
+        close = getattr(self.source, "close", None)
+        if callable(close):
+            close()
+
+    def __iter__(self):
+        return self
+
+    def _fill(self):
+        # Decompress chunks until we have at least one complete line (or we
+        # run out of input).
+        while True:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                tail = "".join(self._pending)
+                self._pending = []
+                if tail == '':
+                    return False
+                self._lines = iter([tail])
+                return True
+            data = self.decompress(chunk)
+            if data == '':
+                continue
+            eol = data.rfind("\n")
+            if eol < 0:
+                self._pending.append(data)
+                continue
+            self._pending.append(data[0:eol + 1])
+            lines = "".join(self._pending).splitlines(True)
+            self._pending = [data[eol + 1:]]
+            self._lines = iter(lines)
+            return True
+
+    def decompress(self, chunk):
+        if getattr(self.decompressor, "eof", False):
+            # The last xz stream ended right at the end of the last chunk.
+            self.decompressor = self.new_decompressor()
+        data = self.decompressor.decompress(chunk)
+        # A file may hold several gzip members or xz streams, one after the
+        # other. Each decompressor stops at the end of its own, leaving the
+        # rest.
+        parts = [data]
+        while self.decompressor.unused_data:
+            rest = self.decompressor.unused_data
+            if self.compression_type == 'gz' and \
+                    not GZIP_MAGIC.startswith(rest[0:2]):
+                raise IOError("Not a gzipped file")
+            self.decompressor = self.new_decompressor()
+            parts.append(self.decompressor.decompress(rest))
+        return "".join(parts)
+
+    def next(self):
+        while True:
+            try:
+                line = next(self._lines)
+                self.line_num += 1
+                return line
+            except StopIteration:
+                if not self._fill():
+                    raise StopIteration
+
+
+# Codecs for compressing self-contained blocks of data in memory. These are
+# meant for data that is written and read back by the same job, so they favour
+# speed over size.
+BLOCK_CODECS = ["none", "zlib", "lzma", "snappy", "lz4"]
+
+def block_codec_available(codec):
+    if codec not in BLOCK_CODECS:
+        raise ValueError("Unknown block codec: '{}'".format(codec))
+    if codec == 'lzma':
+        return has_lzma
+    if codec == 'snappy':
+        return has_snappy
+    if codec == 'lz4':
+        return has_lz4
+    return True
+
+def compress_block(data, codec):
+    if codec == 'none':
+        return data
+    if codec == 'zlib':
+        return zlib.compress(data, 1)
+    if not block_codec_available(codec):
+        raise RuntimeError("Block codec '{}' is not available".format(codec))
+    if codec == 'lzma':
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=0)
+    if codec == 'snappy':
+        return snappy.compress(data)
+    return lz4_block.compress(data)
+
+def decompress_block(data, codec):
+    if codec == 'none':
+        return data
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if not block_codec_available(codec):
+        raise RuntimeError("Block codec '{}' is not available".format(codec))
+    if codec == 'lzma':
+        return lzma.decompress(data)
+    if codec == 'snappy':
+        return snappy.decompress(data)
+    return lz4_block.decompress(data)
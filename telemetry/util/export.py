@@ -46,7 +46,7 @@ class Exporter:
             self.q_incoming = conn.get_queue(self.queue)
             if self.q_incoming is None:
                 raise ValueError("Failed to get queue " + self.queue)
-        self.s3loader = s3util.Loader(self.data_dir, self.bucket, self.aws_key, self.aws_secret_key)
+        self.s3loader = s3util.Loader(self.data_dir, self.bucket, self.aws_key, self.aws_secret_key, on_transfer=self.report_transfer)
 
         # Make sure the target S3 bucket exists.
         s3conn = S3Connection(self.aws_key, self.aws_secret_key)
@@ -78,6 +78,11 @@ class Exporter:
                 print "Failed to enqueue:", filename, "Error:", e
         return success
 
+    def report_transfer(self, local, remote, size, sec):
+        mb = float(size) / 1024.0 / 1024.0
+        print "Uploaded %s: %.2fMB in %.2fs (%.2fMB/s)" % (remote, mb, sec,
+                s3util.mb_per_sec(size, sec))
+
     def strip_data_dir(self, data_dir, full_file):
         if full_file.startswith(data_dir):
             chopped = full_file[len(data_dir):]
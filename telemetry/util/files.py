@@ -6,11 +6,11 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import hashlib
+import mmap
 import struct
-import gzip
-import StringIO as StringIO
 import os
 import errno
+import zlib
 
 
 class UnpackedRecord():
@@ -78,67 +78,171 @@ def detect_file_version(filename, simple_detection=False):
     # We could not determine the file version automatically :(
     raise ValueError("Could not detect file version in: '{}'".format(filename))
 
-def unpack(filename, raw=False, verbose=False, file_version=None, strict=False):
+RECORD_SEPARATOR = chr(0x1e)
+GZIP_MAGIC = "\x1f\x8b"
+
+# The rest of the preamble, after the separator. The "<" is to force it to
+# read as Little-endian to match the way it's written. This is the "native"
+# way in linux too, but might as well make sure we read it back the same way.
+RECORD_PREAMBLE = {
+    "v1": struct.Struct("<HIQ"),  # len_path, len_data, timestamp
+    "v2": struct.Struct("<BHIQ")  # len_ip, len_path, len_data, timestamp
+}
+
+def gunzip(data):
+    """Decompress gzipped `data`, which may contain several gzip members."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    result = decompressor.decompress(data)
+    rest = decompressor.unused_data
+    if rest:
+        if not rest.startswith(GZIP_MAGIC):
+            raise IOError("Not a gzipped file")
+        return result + gunzip(rest)
+    # The last 4 bytes of a complete gzip member are the size of the
+    # uncompressed data. If they don't match, the data was truncated or
+    # corrupt, so decompress it again in a way that reports the problem.
+    if data[-4:] != struct.pack("<I", len(result) & 0xffffffff):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return result
+
+def records_valid_at(buf, pos, size, file_version, check_records=3):
+    """Check whether `buf` (of length `size`) has a record starting at `pos`.
+
+    Like detect_file_version, we parse a few records in a row and make sure
+    each one ends exactly where the next separator (or the end of the data)
+    is. It's very unlikely for that to happen by chance.
+    """
+    preamble = RECORD_PREAMBLE[file_version]
+    for i in range(check_records):
+        if pos == size:
+            return i > 0
+        if buf[pos] != RECORD_SEPARATOR or pos + 1 + preamble.size > size:
+            return False
+        if file_version == "v1":
+            len_path, len_data, timestamp = preamble.unpack_from(buf, pos + 1)
+            len_ip = 0
+        else:
+            len_ip, len_path, len_data, timestamp = preamble.unpack_from(buf, pos + 1)
+        pos += 1 + preamble.size + len_ip + len_path + len_data
+        if pos > size:
+            return False
+    return True
+
+def split_file(filename, file_version, parts, min_size=0):
+    """Split a raw log into at most `parts` ranges of about the same size.
+
+    Returns a list of (start, end) byte offsets. Each range starts on a
+    record boundary (other than the first, which starts at the beginning of
+    the file) and can be passed to unpack() independently of the others.
+    Ranges will be at least `min_size` bytes, apart from the last.
+    """
+    if file_version not in RECORD_PREAMBLE:
+        raise ValueError("Unrecognized file version: {}".format(file_version))
+    size = os.path.getsize(filename)
+    step = max(size / max(parts, 1), min_size, 1)
+    if size <= step:
+        return [(0, size)]
+    boundaries = [0]
+    with open(filename, "rb") as fin:
+        buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = step
+        while pos < size:
+            pos = buf.find(RECORD_SEPARATOR, pos)
+            if pos < 0:
+                break
+            if records_valid_at(buf, pos, size, file_version):
+                if pos > boundaries[-1]:
+                    boundaries.append(pos)
+                pos += step
+            else:
+                pos += 1
+    finally:
+        buf.close()
+    boundaries.append(size)
+    return [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+
+def unpack(filename, raw=False, verbose=False, file_version=None, strict=False,
+           start=0, end=None):
+    """Yield an UnpackedRecord for each record in a raw log file.
+
+    If `start` and/or `end` are given, only records whose separator falls in
+    that byte range of the file are read. Use split_file() to find ranges
+    that begin on record boundaries.
+    """
     if file_version is None:
         file_version = detect_file_version(filename)
-    fin = open(filename, "rb")
+    if file_version not in RECORD_PREAMBLE:
+        raise ValueError("Unrecognized file version: {}".format(file_version))
+    preamble = RECORD_PREAMBLE[file_version]
     record_count = 0
     bad_records = 0
     bytes_skipped = 0
     total_bytes_skipped = 0
-    while True:
-        # Read 1 byte record separator (and keep reading until we get one)
-        separator = fin.read(1)
-        if separator == '':
-            break
-        if ord(separator[0]) != 0x1e:
-            if strict:
-                raise ValueError("Unexpected character at the start " \
-                                 "of record #{}: {}".format(record_count, ord(separator[0])))
-            bytes_skipped += 1
-            continue
-        # We got our record separator as expected.
-        if bytes_skipped > 0:
-            if verbose:
-                print "Skipped", bytes_skipped, "bytes after record", record_count, "to find a valid separator"
-            total_bytes_skipped += bytes_skipped
-            bytes_skipped = 0
-
-        # Read the rest of the preamble (after the 1 we already read)
-        preamble_length = RECORD_PREAMBLE_LENGTH[file_version] - 1
-        lengths = fin.read(preamble_length)
-        if lengths == '':
-            break
-        record_count += 1
-        # The "<" is to force it to read as Little-endian to match the way it's
-        # written. This is the "native" way in linux too, but might as well make
-        # sure we read it back the same way.
-        if file_version == "v1":
-            len_path, len_data, timestamp = struct.unpack("<HIQ", lengths)
-            len_ip = 0
-            client_ip = None
-        elif file_version == "v2":
-            len_ip, len_path, len_data, timestamp = struct.unpack("<BHIQ", lengths)
-            client_ip = fin.read(len_ip)
-        else:
-            raise ValueError("Unrecognized file version: {}".format(file_version))
-        path = fin.read(len_path)
-        data = fin.read(len_data)
-        error = None
-        if not raw:
-            if len(data) > 1 and ord(data[0]) == 0x1f and ord(data[1]) == 0x8b:
+    with open(filename, "rb") as fin:
+        size = os.fstat(fin.fileno()).st_size
+        # Map the whole file, so that we can search it for separators and
+        # decode preambles in place rather than reading a piece at a time.
+        buf = None
+        if size > 0:
+            buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    if end is None or end > size:
+        end = size
+    pos = start
+    try:
+        while pos < end:
+            if buf[pos] != RECORD_SEPARATOR:
+                if strict:
+                    raise ValueError("Unexpected character at the start " \
+                                     "of record #{}: {}".format(record_count, ord(buf[pos])))
+                # Skip ahead to the next record separator
+                next_pos = buf.find(RECORD_SEPARATOR, pos, end)
+                if next_pos < 0:
+                    next_pos = end
+                bytes_skipped += next_pos - pos
+                pos = next_pos
+                continue
+            # We got our record separator as expected.
+            if bytes_skipped > 0:
+                if verbose:
+                    print "Skipped", bytes_skipped, "bytes after record", record_count, "to find a valid separator"
+                total_bytes_skipped += bytes_skipped
+                bytes_skipped = 0
+
+            pos += 1
+            if pos >= size:
+                break
+            record_count += 1
+            if size - pos < preamble.size:
+                # Truncated preamble, this raises struct.error.
+                preamble.unpack(buf[pos:size])
+            if file_version == "v1":
+                len_path, len_data, timestamp = preamble.unpack_from(buf, pos)
+                pos += preamble.size
+                len_ip = 0
+                client_ip = None
+            else:
+                len_ip, len_path, len_data, timestamp = preamble.unpack_from(buf, pos)
+                pos += preamble.size
+                client_ip = buf[pos:pos + len_ip]
+                pos += len_ip
+            path = buf[pos:pos + len_path]
+            pos += len_path
+            data = buf[pos:pos + len_data]
+            pos += len_data
+            error = None
+            if not raw and data.startswith(GZIP_MAGIC):
                 # Data is gzipped, uncompress it:
                 try:
-                    reader = StringIO.StringIO(data)
-                    gunzipper = gzip.GzipFile(fileobj=reader, mode="r")
-                    data = gunzipper.read()
-                    gunzipper.close()
-                    reader.close()
+                    data = gunzip(data)
                 except Exception, e:
                     # Probably wasn't gzipped, pass along the error.
                     bad_records += 1
                     error = e
-        yield UnpackedRecord(len_ip, len_path, len_data, timestamp, client_ip, path, data, error)
+            yield UnpackedRecord(len_ip, len_path, len_data, timestamp, client_ip, path, data, error)
+    finally:
+        if buf is not None:
+            buf.close()
 
     if bytes_skipped > 0:
         if verbose:
@@ -146,7 +250,6 @@ def unpack(filename, raw=False, verbose=False, file_version=None, strict=False):
         total_bytes_skipped += bytes_skipped
     if verbose:
         print "Processed", record_count, "records, with", bad_records, "bad records, and skipped", total_bytes_skipped, "bytes of corruption"
-    fin.close()
 
 def makedirs_concurrent(target_dir):
     try:
@@ -6,9 +6,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import message_pb2  # generated from https://github.com/mozilla-services/heka (message/message.proto)
-import boto
 import snappy
-import struct
 import gzip
 
 from cStringIO import StringIO
@@ -16,143 +14,162 @@ from google.protobuf.message import DecodeError
 
 
 _record_separator = 0x1e
+_unit_separator = 0x1f
 
 
-class BacktrackableFile:
-    def __init__(self, stream):
-        self._stream = stream
-        self._buffer = StringIO()
-
-    def read(self, size):
-        buffer_data = self._buffer.read(size)
-        to_read = size - len(buffer_data)
+class UnpackedRecord(object):
+    def __init__(self, raw, header, message=None, error=None, frame=None):
+        self._raw = raw
+        self._frame = frame
+        self.header = header
+        self.message = message
+        self.error = error
 
-        if to_read == 0:
-            return buffer_data
+    # Most callers never look at the raw bytes of the record, so when we're
+    # given a view of them (`frame`) only copy them out on request.
+    @property
+    def raw(self):
+        if self._raw is None and self._frame is not None:
+            self._raw = str(self._frame)
+            self._frame = None
+        return self._raw
 
-        stream_data = self._stream.read(to_read)
-        self._buffer.write(stream_data)
 
-        return buffer_data + stream_data
+class RecordReader:
+    """Read framed Heka records from a stream, a large chunk at a time.
 
-    def close(self):
-        self._buffer.close()
-        if type(self._stream) == boto.s3.key.Key:
-            if self._stream.resp:  # Hack! Connections are kept around otherwise!
-                self._stream.resp.close()
+    Rather than reading each part of a record separately, we read big chunks
+    of the stream, find record separators using str.find, and parse the
+    header and message straight out of the buffer without copying them.
+    `chunk_size` defaults to CHUNK_SIZE.
+    """
+    CHUNK_SIZE = 1024 * 1024
+    SEPARATOR = chr(_record_separator)
 
-            self._stream.close(True)
-        else:
-            self._stream.close()
+    def __init__(self, stream, chunk_size=None):
+        self._stream = stream
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+        self._record_start = 0
+        self._eof = False
+
+    # Make sure there are at least `size` unread bytes in the buffer. Returns
+    # False if the stream ends first.
+    def _fill(self, size):
+        while len(self._buffer) - self._pos < size:
+            if self._eof:
+                return False
+            chunk = self._stream.read(max(self._chunk_size, size))
+            if chunk == '':
+                self._eof = True
+                return False
+            self._buffer = self._buffer[self._pos:] + chunk
+            self._record_start -= self._pos
+            self._pos = 0
+        return True
+
+    # Skip ahead to the next record separator.
+    # Returns (bytes_skipped=int, eof_reached=bool)
+    def _find_separator(self):
+        skipped = 0
+        while True:
+            index = self._buffer.find(self.SEPARATOR, self._pos)
+            if index >= 0:
+                skipped += index - self._pos
+                self._pos = index
+                return skipped, False
+            skipped += len(self._buffer) - self._pos
+            self._pos = len(self._buffer)
+            if not self._fill(1):
+                return skipped, True
+
+    # Consume whatever is left of a truncated record.
+    def _skip_rest(self):
+        remaining = len(self._buffer) - self._pos
+        self._pos = len(self._buffer)
+        return remaining
 
     def backtrack(self):
-        buffer = self._buffer.getvalue()
-        index = buffer.find(chr(_record_separator), 1)
-
-        self._buffer = StringIO()
-        if index >= 0:
-            self._buffer.write(buffer[index:])
-            self._buffer.seek(0)
-
-
-class UnpackedRecord():
-    def __init__(self, raw, header, message=None, error=None):
-        self.raw = raw
-        self.header = header
-        self.message = message
-        self.error = error
-
-
-# Returns (bytes_skipped=int, eof_reached=bool)
-def read_until_next(fin, separator=_record_separator):
-    bytes_skipped = 0
-    while True:
-        c = fin.read(1)
-        if c == '':
-            return (bytes_skipped, True)
-        elif ord(c) != separator:
-            bytes_skipped += 1
-        else:
-            break
-    return (bytes_skipped, False)
-
+        """Resume looking for a record just after the start of the last one."""
+        self._pos = self._record_start + 1
+
+    def read_record(self, raw=False, verbose=False, strict=False, try_snappy=True):
+        """Return (record, bytes_read). record is None at the end of stream."""
+        # Records are usually back to back, so check that before searching.
+        skipped = 0
+        if self._pos >= len(self._buffer) or \
+                self._buffer[self._pos] != self.SEPARATOR:
+            skipped, eof = self._find_separator()
+            if eof:
+                return None, skipped
+
+        if skipped > 0:
+            if strict:
+                raise ValueError("Unexpected character(s) at the start of record")
+            if verbose:
+                print "Skipped", skipped, "bytes to find a valid separator"
+
+        self._record_start = self._pos
+        # Only call _fill() when we know we need more data.
+        if len(self._buffer) - self._pos < 2 and not self._fill(2):
+            return None, skipped + self._skip_rest()
+        header_length = ord(self._buffer[self._pos + 1])
+
+        # separator, header length, header, unit separator
+        preamble_length = header_length + 3
+        if len(self._buffer) - self._pos < preamble_length and \
+                not self._fill(preamble_length):
+            return None, skipped + self._skip_rest()
+        start = self._pos
+        header = message_pb2.Header()
+        header.ParseFromString(buffer(self._buffer, start + 2, header_length))
+
+        unit_separator = self._buffer[start + preamble_length - 1]
+        if ord(unit_separator) != _unit_separator:
+            self._pos = start + preamble_length
+            error_msg = "Unexpected unit separator character in record " \
+                    "at offset {}: {}".format(start + preamble_length - 1,
+                    ord(unit_separator))
+            if strict:
+                raise ValueError(error_msg)
+            return UnpackedRecord(None, header, error=error_msg,
+                    frame=buffer(self._buffer, start, preamble_length)), \
+                    skipped + preamble_length
+
+        record_length = preamble_length + header.message_length
+        if len(self._buffer) - self._pos < record_length and \
+                not self._fill(record_length):
+            return None, skipped + self._skip_rest()
+        start = self._pos
+        self._pos = start + record_length
+        frame = buffer(self._buffer, start, record_length)
+
+        message = None
+        if not raw:
+            message_raw = buffer(self._buffer, start + preamble_length,
+                                 header.message_length)
+            message = message_pb2.Message()
+            parsed_ok = False
+            if try_snappy:
+                try:
+                    message.ParseFromString(snappy.decompress(message_raw))
+                    parsed_ok = True
+                except:
+                    # Wasn't snappy-compressed
+                    pass
+            if not parsed_ok:
+                # Either we didn't want to attempt snappy, or the
+                # data was not snappy-encoded (or it was just bad).
+                message.ParseFromString(message_raw)
+
+        return UnpackedRecord(None, header, message, frame=frame), \
+                skipped + record_length
 
-# Stream Framing:
-#  https://hekad.readthedocs.org/en/latest/message/index.html
-def read_one_record(input_stream, raw=False, verbose=False, strict=False, try_snappy=True):
-    # Read 1 byte record separator (and keep reading until we get one)
-    total_bytes = 0
-    skipped, eof = read_until_next(input_stream, 0x1e)
-    total_bytes += skipped
-    if eof:
-        return None, total_bytes
-    else:
-        # we've read one separator (plus anything we skipped)
-        total_bytes += 1
-
-    if skipped > 0:
-        if strict:
-            raise ValueError("Unexpected character(s) at the start of record")
-        if verbose:
-            print "Skipped", skipped, "bytes to find a valid separator"
-
-    raw_record = struct.pack("<B", 0x1e)
-
-    # Read the header length
-    header_length_raw = input_stream.read(1)
-    if header_length_raw == '':
-        return None, total_bytes
-
-    total_bytes += 1
-    raw_record += header_length_raw
-
-    # The "<" is to force it to read as Little-endian to match the way it's
-    # written. This is the "native" way in linux too, but might as well make
-    # sure we read it back the same way.
-    (header_length,) = struct.unpack('<B', header_length_raw)
-
-    header_raw = input_stream.read(header_length)
-    if header_raw == '':
-        return None, total_bytes
-    total_bytes += header_length
-    raw_record += header_raw
-
-    header = message_pb2.Header()
-    header.ParseFromString(header_raw)
-    unit_separator = input_stream.read(1)
-    total_bytes += 1
-    if ord(unit_separator[0]) != 0x1f:
-        error_msg = "Unexpected unit separator character in record #{} " \
-                "at offset {}: {}".format(record_count, total_bytes,
-                ord(unit_separator[0]))
-        if strict:
-            raise ValueError(error_msg)
-        return UnpackedRecord(raw_record, header, error=error_msg), total_bytes
-    raw_record += unit_separator
-
-    #print "message length:", header.message_length
-    message_raw = input_stream.read(header.message_length)
-
-    total_bytes += header.message_length
-    raw_record += message_raw
-
-    message = None
-    if not raw:
-        message = message_pb2.Message()
-        parsed_ok = False
-        if try_snappy:
-            try:
-                message.ParseFromString(snappy.decompress(message_raw))
-                parsed_ok = True
-            except:
-                # Wasn't snappy-compressed
-                pass
-        if not parsed_ok:
-            # Either we didn't want to attempt snappy, or the
-            # data was not snappy-encoded (or it was just bad).
-            message.ParseFromString(message_raw)
-
-    return UnpackedRecord(raw_record, header, message), total_bytes
+    def close(self):
+        self._stream.close()
 
 
 def unpack_file(filename, **kwargs):
@@ -168,15 +185,16 @@ def unpack_string(string, **kwargs):
     return unpack(StringIO(string), **kwargs)
 
 
-def unpack(fin, raw=False, verbose=False, strict=False, backtrack=False, try_snappy=True):
+def unpack(fin, raw=False, verbose=False, strict=False, backtrack=False, try_snappy=True, chunk_size=None):
     record_count = 0
     bad_records = 0
     total_bytes = 0
+    reader = RecordReader(fin, chunk_size)
 
     while True:
         r = None
         try:
-            r, bytes = read_one_record(fin, raw, verbose, strict, try_snappy)
+            r, bytes = reader.read_record(raw, verbose, strict, try_snappy)
         except Exception as e:
             if strict:
                 fin.close()
@@ -185,7 +203,7 @@ def unpack(fin, raw=False, verbose=False, strict=False, backtrack=False, try_sna
                 print e
 
             if backtrack and type(e) == DecodeError:
-                fin.backtrack()
+                reader.backtrack()
                 continue
 
         if r is None:
@@ -7,24 +7,112 @@
 
 import simplejson as json
 
-def parse_heka_record(record):
-    result = json.loads(record.message.payload)
-    result["meta"] = {
+class Projection:
+    """The parts of a Heka message that a job actually needs.
+
+    `paths` is a list of dotted paths into the parsed message, such as
+    "payload.slowSQL" or "application.channel". Only the top-level sections
+    of the JSON payload named by a path are kept, and only the message fields
+    whose names overlap a path are decoded. The "meta" section is always
+    present, and so are the sections that contain a path (like "payload"),
+    even when the message has nothing in them.
+    """
+    def __init__(self, paths):
+        self.paths = [tuple(p.split(".")) for p in paths if p != "meta"]
+        self.sections = set([p[0] for p in self.paths])
+        # Outermost first.
+        self.parents = sorted(set([p[0:i] for p in self.paths
+                                   for i in range(1, len(p))]), key=len)
+        # Field name -> split name if the field is needed, None otherwise.
+        self._fields = {}
+
+    def field_keys(self, name):
+        try:
+            return self._fields[name]
+        except KeyError:
+            keys = name.split('.')
+            if len(keys) > 1 and not self.wants(keys):
+                self._fields[name] = None
+            else:
+                self._fields[name] = keys
+            return self._fields[name]
+
+    def wants(self, keys):
+        """Return True if `keys` is a prefix of a path, or vice versa."""
+        for path in self.paths:
+            n = min(len(path), len(keys))
+            if tuple(keys[0:n]) == path[0:n]:
+                return True
+        return False
+
+    def covered(self, field_keys):
+        """Return True if every path lives within one of `field_keys`."""
+        for path in self.paths:
+            for keys in field_keys:
+                if len(keys) <= len(path) and tuple(keys) == path[0:len(keys)]:
+                    break
+            else:
+                return False
+        return True
+
+
+def parse_heka_record(record, fields=None):
+    """Convert a Heka record into a dict.
+
+    If `fields` (a list of dotted paths or a Projection) is given, only the
+    parts of the message covered by those paths are decoded, and the JSON
+    payload is skipped entirely if the message fields provide all of them.
+    Otherwise every section is included, and sections that come from message
+    fields are only decoded when they are first used.
+    """
+    if fields is not None and not isinstance(fields, Projection):
+        fields = Projection(fields)
+
+    meta = {
         # TODO: uuid, logger, severity, env_version, pid
         "Timestamp": record.message.timestamp,
         "Type":      record.message.type,
         "Hostname":  record.message.hostname,
     }
 
+    if fields is None:
+        result = json.loads(record.message.payload)
+        for field in record.message.fields:
+            name = field.name.split('.')
+            value = _get_field_value(field)
+            if len(name) == 1:  # Treat top-level meta fields as strings
+                meta[name[0]] = value
+            else:
+                _add_field(result, name, _lazyjson(value))
+        result["meta"] = meta
+        return result
+
+    wanted = []
     for field in record.message.fields:
-        name = field.name.split('.')
-        value = _get_field_value(field)
-
-	if len(name) == 1:  # Treat top-level meta fields as strings
-	    result["meta"][name[0]] = value
-	else:
-	    _add_field(result, name, value)
-
+        name = fields.field_keys(field.name)
+        if name is None:
+            continue
+        if len(name) == 1:
+            meta[name[0]] = _get_field_value(field)
+        else:
+            wanted.append((name, field))
+
+    result = {}
+    if not fields.covered([name for name, field in wanted]):
+        payload = json.loads(record.message.payload)
+        for section in fields.sections:
+            if section in payload:
+                result[section] = payload[section]
+    for name, field in wanted:
+        _add_field(result, list(name), _json_value(_get_field_value(field)))
+    # Without a projection, these come from fields we didn't decode.
+    for parent in fields.parents:
+        container = result
+        for key in parent:
+            if not isinstance(container, dict):
+                break
+            container = container.setdefault(key, {})
+    result["meta"] = meta
     return result
 
 def _get_field_value(field):
@@ -45,7 +133,7 @@ def _get_field_value(field):
 
 def _add_field(container, keys, value):
     if len(keys) == 1:
-        container[keys[0]] = _lazyjson(value)
+        container[keys[0]] = value
         return
 
     key = keys.pop(0)
@@ -53,38 +141,94 @@ def _add_field(container, keys, value):
     _add_field(container[key], keys, value)
 
 
+def _scalar(content):
+    try:
+        return float(content) if '.' in content or 'e' in content.lower() else int(content)
+    except:
+        return content
+
+def _json_value(content):
+    if not isinstance(content, basestring):
+        raise ValueError("Argument must be a string.")
+    if content.startswith("{") or content.startswith("["):
+        return json.loads(content)
+    return _scalar(content)
+
 def _lazyjson(content):
     if not isinstance(content, basestring):
         raise ValueError("Argument must be a string.")
 
     if content.startswith("{"):
-        default = {}
+        return _LazyDict(content)
     elif content.startswith("["):
-        default = []
-    else:
-        try:
-            return float(content) if '.' in content or 'e' in content.lower() else int(content)
-        except:
-            return content
+        return _LazyList(content)
+    return _scalar(content)
+
+
+# Methods that must not trigger decoding.
+_NOT_LAZY = set(["__doc__", "__new__", "__init__", "__getattribute__",
+                 "__setattr__", "__delattr__", "__hash__", "__reduce__",
+                 "__reduce_ex__", "__sizeof__", "fromkeys"])
+
+def _make_lazy(cls, base):
+    """Make every method of `cls` decode the instance's JSON before use.
+
+    The methods are wrapped once here, and each instance keeps its own JSON
+    string, so creating a lazy value is cheap. Once decoded, the contents
+    live in the underlying dict or list, so code that bypasses the methods
+    (like C extensions) sees them too. Before that, such code sees an empty
+    container.
+    """
+    def wrap(method):
+        def _wrap(self, *args, **kwargs):
+            if self._content is not None:
+                self._load()
+            for arg in args:
+                # Comparisons need the other side decoded too.
+                if isinstance(arg, _LAZY_TYPES) and arg._content is not None:
+                    arg._load()
+            return method(self, *args, **kwargs)
+        return _wrap
 
-    class WrapperType(type(default)):
-        pass
+    for name, method in base.__dict__.iteritems():
+        if name not in _NOT_LAZY and callable(method):
+            setattr(cls, name, wrap(method))
+    return cls
 
-    def wrap(method_name):
-        def _wrap(*args, **kwargs):
-            if not hasattr(WrapperType, '__cache__'):
-                setattr(WrapperType, '__cache__', json.loads(content))
+class _LazyDict(dict):
+    __slots__ = ["_content"]
 
-            cached = WrapperType.__cache__
-            method = getattr(cached, method_name)
-            return method(*args[1:], **kwargs)
+    def __init__(self, content):
+        dict.__init__(self)
+        self._content = content
 
-        return _wrap
+    def _load(self):
+        content = self._content
+        self._content = None
+        dict.update(self, json.loads(content))
 
-    wrapper = WrapperType(default)
-    for k, v in type(default).__dict__.iteritems():
-        if k == "__doc__":
-            continue
-        else:
-            setattr(WrapperType, k, wrap(k))
-    return wrapper
+    def __reduce_ex__(self, protocol):
+        if self._content is not None:
+            self._load()
+        return (dict, (dict.items(self),))
+
+class _LazyList(list):
+    __slots__ = ["_content"]
+
+    def __init__(self, content):
+        list.__init__(self)
+        self._content = content
+
+    def _load(self):
+        content = self._content
+        self._content = None
+        list.extend(self, json.loads(content))
+
+    def __reduce_ex__(self, protocol):
+        if self._content is not None:
+            self._load()
+        return (list, (list(list.__iter__(self)),))
+
+_LAZY_TYPES = (_LazyDict, _LazyList)
+_make_lazy(_LazyDict, dict)
+_make_lazy(_LazyList, list)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """A dict-like cache that holds at most `max_size` items.
+
+    When it is full, adding an item evicts the least recently used one, and
+    calls `on_evict(key, value)` if given. Keeps counts of hits, misses and
+    evictions for monitoring.
+    """
+    def __init__(self, max_size, on_evict=None):
+        if max_size <= 0:
+            raise ValueError("Cache size must be greater than zero")
+        self.max_size = max_size
+        self._on_evict = on_evict
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # Move it to the most recently used end.
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self._items:
+            del self._items[key]
+        elif len(self._items) >= self.max_size:
+            old_key, old_value = self._items.popitem(last=False)
+            self.evictions += 1
+            if self._on_evict is not None:
+                self._on_evict(old_key, old_value)
+        self._items[key] = value
+
+    def pop(self, key, default=None):
+        return self._items.pop(key, default)
+
+    def items(self):
+        return self._items.items()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        self._items.clear()
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "size": len(self._items)}
@@ -5,17 +5,473 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import multiprocessing
+import hashlib
+import Queue
 import os
+import simplejson as json
 import sys
+import threading
+from datetime import datetime
 from traceback import print_exc
 import telemetry.util.files as fu
+import telemetry.util.timer as timer
 from boto.exception import S3ResponseError
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
+from boto.utils import compute_md5
+
+class TransferManager:
+    """Transfers files to and from one bucket, reusing S3 connections.
+
+    Each thread that uses a TransferManager gets its own connection, which it
+    keeps for later transfers. Files of at least `multipart_threshold` bytes
+    are transferred in parts of `part_size` bytes, `part_threads` parts at a
+    time. The MD5 of every upload (and every part) is checked against the
+    ETag that S3 returns for it, and every download is checked against the
+    key's ETag. `connection_args` are passed on to S3Connection, to use a
+    different endpoint, say.
+    """
+    MULTIPART_THRESHOLD = 32 * 1024 * 1024
+    # S3 requires parts (other than the last one) to be at least 5MB.
+    PART_SIZE = 16 * 1024 * 1024
+    PART_THREADS = 4
+    RETRIES = 3
+
+    def __init__(self, bucket_name, aws_key=None, aws_secret_key=None,
+                 multipart_threshold=MULTIPART_THRESHOLD, part_size=PART_SIZE,
+                 part_threads=PART_THREADS, connection_args=None):
+        self.bucket_name = bucket_name
+        self.aws_key = aws_key
+        self.aws_secret_key = aws_secret_key
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.part_threads = part_threads
+        self.connection_args = connection_args or {}
+        self._local = threading.local()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    @classmethod
+    def for_bucket(cls, bucket, **kwargs):
+        """Create a TransferManager that uses `bucket` in this thread."""
+        conn = bucket.connection
+        manager = cls(bucket.name, conn.aws_access_key_id,
+                      conn.aws_secret_access_key, **kwargs)
+        manager._local.bucket = bucket
+        return manager
+
+    def get_bucket(self):
+        bucket = getattr(self._local, "bucket", None)
+        if bucket is None:
+            conn = S3Connection(self.aws_key, self.aws_secret_key,
+                                **self.connection_args)
+            bucket = conn.get_bucket(self.bucket_name, validate=False)
+            self._local.bucket = bucket
+        return bucket
+
+    def get_part_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.part_threads)
+            return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def upload(self, local_filename, remote_key, only_new=False):
+        """Upload a file, returning (error, bytes, seconds).
+
+        `error` is None if the upload succeeded. If `only_new` is True and
+        the key already exists, it is left alone and no bytes are
+        transferred. That counts as success if the existing key matches the
+        file.
+        """
+        start = datetime.now()
+        size = 0
+        success = False
+        err = None
+        for retry in range(1, self.RETRIES + 1):
+            try:
+                if only_new:
+                    existing = self.get_bucket().get_key(remote_key)
+                    if existing is not None:
+                        if not etag_matches(local_filename, existing.etag):
+                            err = "'%s' already exists with different " \
+                                  "contents than '%s'" % (remote_key,
+                                                          local_filename)
+                        success = err is None
+                        break
+                size = os.path.getsize(local_filename)
+                if size >= self.multipart_threshold:
+                    self.upload_multipart(local_filename, remote_key, size)
+                else:
+                    self.upload_single(local_filename, remote_key)
+                success = True
+                break
+            except S3ResponseError, e:
+                print >> sys.stderr, "S3 Error on attempt #%i:" % retry, e.status, e.reason
+            except:
+                print >> sys.stderr, "Error on attempt #%i:" % retry
+                print_exc(file = sys.stderr)
+        if not success:
+            if err is None:
+                err = "Failed to upload '%s' as '%s'" % (local_filename,
+                                                         remote_key)
+            print >> sys.stderr, err
+        return err, size, timer.delta_sec(start)
+
+    def upload_single(self, local_filename, remote_key):
+        k = Key(self.get_bucket())
+        k.key = remote_key
+        with open(local_filename, "rb") as fp:
+            md5 = compute_md5(fp)
+            k.set_contents_from_file(fp, md5=md5)
+        check_etag(k.etag, md5[0], remote_key)
+
+    def upload_multipart(self, local_filename, remote_key, size):
+        mp = self.get_bucket().initiate_multipart_upload(remote_key)
+        parts = []
+        for num, offset in enumerate(range(0, size, self.part_size)):
+            parts.append((mp.id, remote_key, local_filename, num + 1, offset,
+                          min(self.part_size, size - offset)))
+        try:
+            digests = self.get_part_pool().map(self.upload_part, parts)
+            # We know every part's ETag already, so there's no need to have
+            # MultiPartUpload list them again.
+            xml = ["<CompleteMultipartUpload>"]
+            for num, digest in enumerate(digests):
+                xml.append('<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag>'
+                           '</Part>' % (num + 1, digest.encode("hex")))
+            xml.append("</CompleteMultipartUpload>")
+            completed = mp.bucket.complete_multipart_upload(remote_key, mp.id,
+                                                            "".join(xml))
+        except:
+            try:
+                mp.cancel_upload()
+            except:
+                print_exc(file = sys.stderr)
+            raise
+        # The ETag of a multipart upload is the MD5 of the parts' MD5s.
+        check_etag(completed.etag, "%s-%d" % (
+                hashlib.md5("".join(digests)).hexdigest(), len(digests)),
+                remote_key)
+
+    def upload_part(self, args):
+        """Upload one part of a multipart upload, returning its MD5 digest."""
+        upload_id, remote_key, local_filename, part_num, offset, size = args
+        mp = MultiPartUpload(self.get_bucket())
+        mp.key_name = remote_key
+        mp.id = upload_id
+        for retry in range(1, self.RETRIES + 1):
+            try:
+                with open(local_filename, "rb") as fp:
+                    fp.seek(offset)
+                    md5 = compute_md5(fp, size=size)
+                    k = mp.upload_part_from_file(fp, part_num, md5=md5,
+                                                 size=size)
+                check_etag(k.etag, md5[0], "%s part %d" % (remote_key,
+                                                           part_num))
+                return md5[0].decode("hex")
+            except:
+                if retry == self.RETRIES:
+                    raise
+                print >> sys.stderr, "Error uploading part %d on attempt " \
+                                     "#%i:" % (part_num, retry)
+                print_exc(file = sys.stderr)
+
+    def download(self, remote_key, local_filename, key=None):
+        """Download a key, returning (error, bytes, seconds).
+
+        `error` is None if the download succeeded. If `local_filename`
+        already matches the key, it is left alone and no bytes are
+        transferred. If `key` (from a bucket listing, say) is given, its
+        ETag and size are used rather than looking them up again.
+        """
+        start = datetime.now()
+        size = 0
+        success = False
+        for retry in range(1, self.RETRIES + 1):
+            try:
+                if key is None or retry > 1:
+                    key = self.get_bucket().get_key(remote_key)
+                if key is None:
+                    print >> sys.stderr, "Key not found:", remote_key
+                    break
+                if os.path.isfile(local_filename) and \
+                        os.path.getsize(local_filename) == key.size and \
+                        etag_matches(local_filename, key.etag):
+                    success = True
+                    break
+                target_dir = os.path.dirname(local_filename)
+                if target_dir and not os.path.exists(target_dir):
+                    fu.makedirs_concurrent(target_dir)
+                if key.size >= self.multipart_threshold:
+                    self.download_ranges(key, local_filename)
+                else:
+                    self.download_single(key, local_filename)
+                size = key.size
+                success = True
+                break
+            except S3ResponseError, e:
+                print >> sys.stderr, "S3 Error on attempt #%i:" % retry, e.status, e.reason
+            except:
+                print >> sys.stderr, "Error on attempt #%i:" % retry
+                print_exc(file = sys.stderr)
+        err = None
+        if not success:
+            err = "Failed to download '%s' as '%s'" % (remote_key, local_filename)
+            print >> sys.stderr, err
+        return err, size, timer.delta_sec(start)
+
+    def download_single(self, key, local_filename):
+        temp = local_filename + ".part"
+        # `key` may belong to another thread's connection.
+        k = Key(self.get_bucket(), key.name)
+        k.get_contents_to_filename(temp)
+        self.finish_download(key, temp, local_filename)
+
+    def download_ranges(self, key, local_filename):
+        """Download `key` as a series of ranges, in parallel.
+
+        The ranges are written into <local_filename>.part, which is sized up
+        front, and the ones that are done are listed in
+        <local_filename>.part.json. If the download is interrupted, the next
+        attempt only fetches the missing ranges (as long as the key hasn't
+        changed in the meantime).
+        """
+        temp = local_filename + ".part"
+        state_file = temp + ".json"
+        state = {"etag": key.etag, "size": key.size,
+                 "part_size": self.part_size, "done": []}
+        try:
+            with open(state_file) as fin:
+                saved = json.load(fin)
+            if os.path.getsize(temp) == key.size and \
+                    all(saved.get(k) == state[k] for k in ("etag", "size",
+                                                           "part_size")):
+                state = saved
+        except (IOError, OSError, ValueError):
+            pass
+        done = set(state["done"])
+        if not done:
+            with open(temp, "wb") as fout:
+                fout.truncate(key.size)
+
+        lock = threading.Lock()
+        def fetch(offset):
+            self.download_range(key, temp, offset,
+                                min(self.part_size, key.size - offset))
+            with lock:
+                done.add(offset)
+                state["done"] = sorted(done)
+                with open(state_file + ".tmp", "w") as fout:
+                    json.dump(state, fout)
+                os.rename(state_file + ".tmp", state_file)
+
+        self.get_part_pool().map(fetch, [o for o in range(0, key.size,
+                                         self.part_size) if o not in done])
+        try:
+            self.finish_download(key, temp, local_filename)
+        finally:
+            if os.path.exists(state_file):
+                os.remove(state_file)
+
+    def download_range(self, key, temp, offset, length):
+        # Make sure all the ranges come from the same version of the key.
+        headers = {"Range": "bytes=%d-%d" % (offset, offset + length - 1),
+                   "If-Match": key.etag}
+        for retry in range(1, self.RETRIES + 1):
+            try:
+                # A Key holds on to its response, even a failed one, so use
+                # a new one for each attempt.
+                k = Key(self.get_bucket(), key.name)
+                data = k.get_contents_as_string(headers=headers)
+                if len(data) != length:
+                    raise ValueError("Expected %d bytes at offset %d of %s, " \
+                                     "got %d" % (length, offset, key.name,
+                                                 len(data)))
+                with open(temp, "r+b") as fout:
+                    fout.seek(offset)
+                    fout.write(data)
+                return
+            except S3ResponseError, e:
+                # The key has changed, so start the download over.
+                if e.status == 412 or retry == self.RETRIES:
+                    raise
+                print >> sys.stderr, "S3 Error downloading %s at offset %d " \
+                                     "on attempt #%i:" % (key.name, offset,
+                                     retry), e.status, e.reason
+            except:
+                if retry == self.RETRIES:
+                    raise
+                print >> sys.stderr, "Error downloading %s at offset %d on " \
+                                     "attempt #%i:" % (key.name, offset, retry)
+                print_exc(file = sys.stderr)
+
+    def finish_download(self, key, temp, local_filename):
+        if not etag_matches(temp, key.etag):
+            os.remove(temp)
+            raise ValueError("Downloaded %s doesn't match ETag %s" % (key.name,
+                             key.etag))
+        os.rename(temp, local_filename)
+
+
+class TransferPool:
+    """Keeps up to `num_transfers` transfers in flight at once.
+
+    Each transfer starts as soon as a slot is free, rather than waiting for
+    a whole batch to finish, and uses a connection that belongs to its slot.
+    Extra arguments are passed to the TransferManager.
+    """
+    def __init__(self, bucket_name, aws_key=None, aws_secret_key=None,
+                 num_transfers=8, **kwargs):
+        self.transfers = TransferManager(bucket_name, aws_key,
+                                         aws_secret_key, **kwargs)
+        self._pool = ThreadPool(num_transfers)
+        self._done = Queue.Queue()
+        self.pending = 0
+
+    def _start(self, method, local_filename, remote_key, args):
+        def run():
+            try:
+                err, size, sec = method(*args)
+            except Exception, e:
+                err, size, sec = str(e), 0, 0
+            self._done.put((local_filename, remote_key, err, size, sec))
+        self.pending += 1
+        self._pool.apply_async(run)
+
+    def put(self, local_filename, remote_key, only_new=False):
+        self._start(self.transfers.upload, local_filename, remote_key,
+                    (local_filename, remote_key, only_new))
+
+    def get(self, remote_key, local_filename, key=None):
+        self._start(self.transfers.download, local_filename, remote_key,
+                    (remote_key, local_filename, key))
+
+    def results(self, wait=True):
+        """Yield (local, remote, error, bytes, seconds) for each finished
+        transfer, in the order they finish.
+
+        If `wait` is False, only yield the transfers that are already done.
+        """
+        while self.pending > 0:
+            try:
+                result = self._done.get(wait)
+            except Queue.Empty:
+                break
+            self.pending -= 1
+            yield result
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.transfers.close()
+
+
+def list_keys(bucket, names):
+    """Look up the keys for `names` with as few listing requests as we can.
+
+    Returns a dict of name -> Key (with its size and ETag) for each name
+    that exists. Names are listed a directory at a time, so this is much
+    cheaper than a HEAD request per name when they share directories.
+    """
+    wanted = set(names)
+    prefixes = set([n[0:n.rfind("/") + 1] for n in wanted])
+    keys = {}
+    for prefix in sorted(prefixes):
+        for k in bucket.list(prefix=prefix, delimiter="/"):
+            if k.name in wanted:
+                keys[k.name] = k
+    return keys
+
+def multipart_md5(filename, part_size):
+    """Return the ETag S3 gives `filename` if uploaded in `part_size` parts."""
+    digests = []
+    with open(filename, "rb") as fin:
+        while True:
+            md5 = hashlib.md5()
+            remaining = part_size
+            while remaining > 0:
+                chunk = fin.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                remaining -= len(chunk)
+            if remaining == part_size:
+                break
+            digests.append(md5.digest())
+    return "%s-%d" % (hashlib.md5("".join(digests)).hexdigest(), len(digests))
+
+def etag_matches(filename, etag):
+    """Check the contents of `filename` against an S3 ETag.
+
+    The ETag of a multipart upload doesn't say what part size was used, so
+    try our own part size first, then the other whole-MB part sizes that
+    give the right number of parts.
+    """
+    etag = etag.strip('"')
+    if "-" not in etag:
+        return fu.md5file(filename)[0] == etag
+    num_parts = int(etag.split("-")[1])
+    size = os.path.getsize(filename)
+    mb = 1024 * 1024
+    candidates = [TransferManager.PART_SIZE]
+    part_size = max(mb, ((size + num_parts - 1) / num_parts + mb - 1) / mb * mb)
+    while len(candidates) < 8 and (size + part_size - 1) / part_size == num_parts:
+        if part_size not in candidates:
+            candidates.append(part_size)
+        part_size += mb
+    for part_size in candidates:
+        if (size + part_size - 1) / part_size == num_parts and \
+                multipart_md5(filename, part_size) == etag:
+            return True
+    return False
+
+def check_etag(etag, expected_md5, name):
+    if etag is None or etag.strip('"') != expected_md5:
+        raise ValueError("MD5 mismatch for %s: expected %s, got %s" % (name,
+                         expected_md5, etag))
+
+def mb_per_sec(size, sec):
+    return float(size) / 1024.0 / 1024.0 / max(sec, 0.0001)
+
+
+# Each Loader worker process keeps a TransferManager (and so a connection)
+# for all of its transfers.
+_worker_transfers = None
+
+def _init_worker(bucket_name, aws_key, aws_secret_key):
+    global _worker_transfers
+    _worker_transfers = TransferManager(bucket_name, aws_key, aws_secret_key)
+
+def _download_worker(args):
+    local_path, remote_key = args
+    target = os.path.join(local_path, remote_key)
+    err, size, sec = _worker_transfers.download(remote_key, target)
+    return target, remote_key, err, size, sec
+
+def _upload_worker(args):
+    local_path, remote_key = args
+    target = os.path.join(local_path, remote_key)
+    err, size, sec = _worker_transfers.upload(target, remote_key)
+    return target, remote_key, err, size, sec
+
 
 class Loader:
-    def __init__(self, local_path, bucket_name, aws_key=None, aws_secret_key=None, poolsize=10, verbose=False):
+    """Downloads or uploads lists of files using a pool of processes.
+
+    The pool (and each worker's S3 connection) is kept until close() is
+    called. If given, `on_transfer(local, remote, bytes, seconds)` is called
+    after each successful transfer.
+    """
+    def __init__(self, local_path, bucket_name, aws_key=None, aws_secret_key=None, poolsize=10, verbose=False, on_transfer=None):
         self.verbose = verbose
         self.local_path = local_path
         self.aws_key = aws_key
@@ -24,87 +480,74 @@ class Loader:
         self.bucket_name = bucket_name
         self.bucket = self.conn.get_bucket(self.bucket_name)
         self.poolsize=poolsize
+        self.on_transfer = on_transfer
+        self.pool = None
 
     def make_args(self, files):
         for f in files:
-            yield [self.local_path, self.bucket, f.name if type(f) == Key else f]
+            yield [self.local_path, f.name if type(f) == Key else f]
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = Pool(processes=self.poolsize, initializer=_init_worker,
+                    initargs=(self.bucket_name, self.aws_key,
+                              self.aws_secret_key))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
     def load_list(self, files, load_function):
-        pool = Pool(processes=self.poolsize)
-        result_iterator = pool.imap_unordered(load_function, self.make_args(files))
-        pool.close()
+        result_iterator = self.get_pool().imap_unordered(load_function,
+                self.make_args(files))
         while True:
             try:
-                yield result_iterator.next(timeout=1)
+                local_filename, remote_filename, err, size, sec = \
+                        result_iterator.next(timeout=1)
             except multiprocessing.TimeoutError:
                 if self.verbose:
                     print "no results yet.."
+                continue
             except StopIteration:
                 break
-        pool.join()
+            if err is None and self.on_transfer is not None:
+                self.on_transfer(local_filename, remote_filename, size, sec)
+            yield local_filename, remote_filename, err
 
     def get_list(self, files):
-        for local_filename, remote_filename, err in self.load_list(files, download_one):
+        for local_filename, remote_filename, err in self.load_list(files, _download_worker):
             yield local_filename, remote_filename, err
 
     def get_schema(self, schema):
-        for local_filename, remote_filename, err in self.load_list(list_partitions(self.bucket, schema=schema, include_keys=True), download_one):
+        for local_filename, remote_filename, err in self.load_list(list_partitions(self.bucket, schema=schema, include_keys=True), _download_worker):
             yield local_filename, remote_filename, err
 
     def put_list(self, files):
-        for local_filename, remote_filename, err in self.load_list(files, upload_one):
+        for local_filename, remote_filename, err in self.load_list(files, _upload_worker):
             yield local_filename, remote_filename, err
 
 
 def download_one(args):
     local_path, bucket, remote_key = args
     target = os.path.join(local_path, remote_key)
-    target_dir = os.path.dirname(target)
-    if not os.path.exists(target_dir):
-        fu.makedirs_concurrent(target_dir)
-    success = False
-    err = None
-    for retry in range(1, 4):
-        try:
-            k = Key(bucket)
-            k.key = remote_key
-            k.get_contents_to_filename(target)
-            # TODO: compare md5? Note that it will fail if we switch to
-            #       multipart uploads.
-            success = True
-            break
-        except S3ResponseError, e:
-            print >> sys.stderr, "S3 Error on attempt #%i:" % retry, e.status, e.reason
-        except:
-            print >> sys.stderr, "Error on attempt #%i:" % retry
-            print_exc(file = sys.stderr)
-    if not success:
-        err = "Failed to download '%s' as '%s'" % (remote_key, target)
-        print >> sys.stderr, err
+    transfers = TransferManager.for_bucket(bucket)
+    try:
+        err, size, sec = transfers.download(remote_key, target)
+    finally:
+        transfers.close()
     return target, remote_key, err
 
 def upload_one(args):
     local_path, bucket, remote_key = args
     target = os.path.join(local_path, remote_key)
-    success = False
-    err = None
-    for retry in range(1, 4):
-        try:
-            k = Key(bucket)
-            k.key = remote_key
-            # TODO: use multipart upload for large files
-            k.set_contents_from_filename(target)
-            # TODO: compare md5?
-            success = True
-            break
-        except S3ResponseError, e:
-            print >> sys.stderr, "S3 Error on attempt #%i:" % retry, e.status, e.reason
-        except:
-            print >> sys.stderr, "Error on attempt #%i:" % retry
-            print_exc(file = sys.stderr)
-    if not success:
-        err = "Failed to upload '%s' as '%s'" % (target, remote_key)
-        print >> sys.stderr, err
+    transfers = TransferManager.for_bucket(bucket)
+    try:
+        err, size, sec = transfers.upload(target, remote_key)
+    finally:
+        transfers.close()
     return target, remote_key, err
 
 
@@ -17,13 +17,14 @@ def main():
     parser.add_argument("-o", "--output-dir", help="Base directory to store split files", required=True)
     parser.add_argument("-t", "--telemetry-schema", help="Filename of telemetry schema spec", required=True)
     parser.add_argument("-f", "--file-version", help="Log file version (if omitted, we'll guess)")
+    parser.add_argument("--max-open-files", metavar="N", help="Keep up to N output files open", type=int, default=256)
     args = parser.parse_args()
 
     schema_data = open(args.telemetry_schema)
     schema = TelemetrySchema(json.load(schema_data))
     schema_data.close()
 
-    storage = StorageLayout(schema, args.output_dir, args.max_output_size)
+    storage = StorageLayout(schema, args.output_dir, args.max_output_size, args.max_open_files)
 
     expected_dim_count = len(schema._dimensions)
 
@@ -70,6 +71,7 @@ def main():
         dimensions = schema.dimensions_from(info, submission_date)
         #print "  Converted path to filename", schema.get_filename(args.output_dir, dimensions)
         storage.write(key, data, dimensions)
+    storage.close_all()
     duration = timer.delta_sec(start)
     mb_read = bytes_read / 1024.0 / 1024.0
     print "Read %.2fMB in %.2fs (%.2fMB/s), %d of %d records were bad" % (mb_read, duration, mb_read / duration, bad_record_count, record_count)
@@ -2,10 +2,14 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import gzip
 import os
 import shutil
 import unittest
-from telemetry.util.compress import CompressedFile
+from cStringIO import StringIO
+from telemetry.util.compress import CompressedFile, CompressedStream, has_lzma
+from telemetry.util.compress import BLOCK_CODECS, block_codec_available, \
+        compress_block, decompress_block
 
 class TestCompressedFile(unittest.TestCase):
     def setUp(self):
@@ -116,6 +120,79 @@ class TestCompressedFile(unittest.TestCase):
         for i in range(c.line_num):
             self.assertEqual(expected[i], lines[i])
 
+    def read_chunks(self, filename, chunk_size):
+        with open(filename, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if chunk == '':
+                    break
+                yield chunk
+
+    def test_decompress_stream(self):
+        base_dir = self.get_test_dir()
+        expected = self.get_test_data()
+        for t in self.get_supported_compression_types():
+            filename = os.path.join(base_dir, "test.txt." + t)
+            # Use tiny chunks so that lines span chunk boundaries.
+            s = CompressedStream(self.read_chunks(filename, 7), t)
+            lines = [line.strip() for line in s]
+            s.close()
+            self.assertEqual(len(expected), s.line_num)
+            self.assertEqual(expected, lines)
+
+    def test_decompress_stream_gzip_members(self):
+        # Concatenated gzip files are one gzip file with several members.
+        expected = self.get_test_data()
+        data = ""
+        for line in expected:
+            out = StringIO()
+            with gzip.GzipFile(fileobj=out, mode="wb") as member:
+                member.write(line + "\n")
+            data += out.getvalue()
+        for chunk_size in [1, 7, len(data)]:
+            chunks = [data[i:i + chunk_size]
+                      for i in range(0, len(data), chunk_size)]
+            s = CompressedStream(chunks, "gz")
+            self.assertEqual(expected, [line.strip() for line in s])
+        with self.assertRaises(IOError):
+            list(CompressedStream([data + "junk"], "gz"))
+
+    @unittest.skipUnless(has_lzma, "needs the lzma module")
+    def test_decompress_stream_xz_streams(self):
+        # Appending to an xz file adds another stream to it.
+        expected = self.get_test_data()
+        filename = os.path.join(self.get_test_dir(), "streams.txt.xz")
+        for i, line in enumerate(expected):
+            f = CompressedFile(filename, mode="a" if i else "w",
+                               compression_type="xz", open_now=True)
+            f.write(line + "\n")
+            f.close()
+        with open(filename, "rb") as raw:
+            data = raw.read()
+        os.remove(filename)
+        for chunk_size in [1, 7, len(data)]:
+            chunks = [data[i:i + chunk_size]
+                      for i in range(0, len(data), chunk_size)]
+            s = CompressedStream(chunks, "xz")
+            self.assertEqual(expected, [line.strip() for line in s])
+
+    def test_stream_unknown_compression_type(self):
+        with self.assertRaises(ValueError):
+            s = CompressedStream([], "foo")
+
+    def test_block_codecs(self):
+        data = "\n".join(self.get_test_data()) * 100
+        for codec in BLOCK_CODECS:
+            if not block_codec_available(codec):
+                continue
+            compressed = compress_block(data, codec)
+            self.assertEqual(data, decompress_block(compressed, codec))
+        self.assertEqual("", decompress_block(compress_block("", "zlib"), "zlib"))
+
+    def test_unknown_block_codec(self):
+        with self.assertRaises(ValueError):
+            compress_block("data", "foo")
+
     def test_decompress_popen(self):
         base_dir = self.get_test_dir()
         for t in self.get_supported_popen_compression_types():
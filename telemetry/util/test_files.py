@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from cStringIO import StringIO
+import telemetry.util.files as fu
+
+class TestUnpack(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def gzip(self, data):
+        buf = StringIO()
+        g = gzip.GzipFile(fileobj=buf, mode="w")
+        g.write(data)
+        g.close()
+        return buf.getvalue()
+
+    def record(self, version, path, data, ip="127.0.0.1"):
+        if version == "v1":
+            preamble = struct.pack("<HIQ", len(path), len(data), 1000)
+            ip = ""
+        else:
+            preamble = struct.pack("<BHIQ", len(ip), len(path), len(data), 1000)
+        return chr(0x1e) + preamble + ip + path + data
+
+    def get_test_records(self):
+        return [("a/b", '{"x": 1}'), ("c/d", ""), ("e", '{"y": "' + "z" * 1000 + '"}')]
+
+    def write(self, name, contents):
+        filename = os.path.join(self.work_dir, name)
+        with open(filename, "wb") as f:
+            f.write(contents)
+        return filename
+
+    def test_unpack(self):
+        for version in ["v1", "v2"]:
+            contents = "".join([self.record(version, p, d)
+                                for p, d in self.get_test_records()])
+            filename = self.write("test." + version, contents)
+            self.assertEqual(version, fu.detect_file_version(filename))
+            records = list(fu.unpack(filename, file_version=version))
+            self.assertEqual(self.get_test_records(),
+                             [(r.path, r.data) for r in records])
+            for r in records:
+                self.assertIsNone(r.error)
+                self.assertEqual(1000, r.timestamp)
+                if version == "v2":
+                    self.assertEqual("127.0.0.1", r.ip)
+
+    def test_gzipped(self):
+        data = '{"gzipped": true}'
+        contents = self.record("v2", "a", self.gzip(data)) + \
+                   self.record("v2", "b", self.gzip(data) + self.gzip(data)) + \
+                   self.record("v2", "c", self.gzip(data)[0:-6]) + \
+                   self.record("v2", "d", "\x1f\x8bnot gzip")
+        filename = self.write("gzipped.v2", contents)
+        records = list(fu.unpack(filename, file_version="v2"))
+        self.assertEqual(data, records[0].data)
+        self.assertEqual(data + data, records[1].data)
+        self.assertIsNotNone(records[2].error)
+        self.assertIsNotNone(records[3].error)
+
+        # raw=True leaves the data alone.
+        records = list(fu.unpack(filename, file_version="v2", raw=True))
+        self.assertEqual(self.gzip(data), records[0].data)
+        self.assertIsNone(records[2].error)
+
+    def test_skip_garbage(self):
+        records = self.get_test_records()
+        contents = "junk" + self.record("v1", *records[0]) + "more junk" + \
+                   "".join([self.record("v1", p, d) for p, d in records[1:]])
+        filename = self.write("garbage.v1", contents)
+        self.assertEqual(records, [(r.path, r.data) for r in
+                                   fu.unpack(filename, file_version="v1")])
+        with self.assertRaises(ValueError):
+            list(fu.unpack(filename, file_version="v1", strict=True))
+
+    def test_truncated(self):
+        contents = "".join([self.record("v1", p, d)
+                            for p, d in self.get_test_records()])
+        filename = self.write("truncated.v1", contents[0:-10])
+        records = list(fu.unpack(filename, file_version="v1"))
+        self.assertEqual(3, len(records))
+        self.assertEqual(records[2].len_data - 10, len(records[2].data))
+
+    def test_split(self):
+        records = [("p%d" % i, "d" * (i % 17) + chr(0x1e) * (i % 3))
+                   for i in range(200)]
+        contents = "".join([self.record("v2", p, d) for p, d in records])
+        filename = self.write("split.v2", "junk" + contents)
+        for parts in [1, 2, 5, 300]:
+            ranges = fu.split_file(filename, "v2", parts)
+            self.assertTrue(len(ranges) <= parts)
+            self.assertEqual(0, ranges[0][0])
+            self.assertEqual(len(contents) + 4, ranges[-1][1])
+            pieces = []
+            for start, end in ranges:
+                pieces.extend([(r.path, r.data) for r in fu.unpack(filename,
+                               file_version="v2", start=start, end=end)])
+            self.assertEqual(records, pieces)
+        self.assertEqual(1, len(fu.split_file(filename, "v2", 5,
+                                              min_size=len(contents))))
+
+    def test_empty(self):
+        filename = self.write("empty.v1", "")
+        self.assertEqual([], list(fu.unpack(filename, file_version="v1")))
+
+
+if __name__ == "__main__":
+    unittest.main()
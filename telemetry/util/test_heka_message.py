@@ -0,0 +1,201 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import imp
+import os
+import struct
+import sys
+import unittest
+from cStringIO import StringIO
+import telemetry.util.message_pb2 as message_pb2
+import telemetry.util.heka_message as heka_message
+import telemetry.util.heka_message_parser as heka_message_parser
+from telemetry.util.heka_message import RecordReader, unpack_string
+
+class TestHekaMessage(unittest.TestCase):
+    def get_test_payloads(self):
+        return ['{"a": 1}', '{"b": "two"}', "", "x" * 5000, '{"c": [3]}']
+
+    def frame(self, payload):
+        message = message_pb2.Message()
+        message.uuid = "0123456789abcdef"
+        message.timestamp = 1
+        message.payload = payload
+        message_raw = message.SerializeToString()
+        header = message_pb2.Header()
+        header.message_length = len(message_raw)
+        header_raw = header.SerializeToString()
+        return chr(0x1e) + struct.pack("<B", len(header_raw)) + header_raw + \
+               chr(0x1f) + message_raw
+
+    def get_test_data(self):
+        return [self.frame(p) for p in self.get_test_payloads()]
+
+    def unpack(self, data, chunk_size, **kwargs):
+        # Use a small chunk size to make sure records that span chunks are
+        # handled properly.
+        return list(heka_message.unpack(StringIO(data), chunk_size=chunk_size,
+                                        **kwargs))
+
+    def test_unpack(self):
+        frames = self.get_test_data()
+        data = "".join(frames)
+        for chunk_size in [1, 7, 100, 1024 * 1024]:
+            records = self.unpack(data, chunk_size, try_snappy=False)
+            self.assertEqual(len(frames), len(records))
+            for i, (r, total_bytes) in enumerate(records):
+                self.assertEqual(self.get_test_payloads()[i], r.message.payload)
+                self.assertEqual(frames[i], r.raw)
+                self.assertEqual(len("".join(frames[0:i + 1])), total_bytes)
+
+    def test_chunk_size(self):
+        reads = []
+        class Stream:
+            def __init__(self, data):
+                self.data = StringIO(data)
+            def read(self, size):
+                reads.append(size)
+                return self.data.read(size)
+            def close(self):
+                pass
+        data = "".join(self.get_test_data())
+        list(heka_message.unpack(Stream(data), chunk_size=7))
+        self.assertEqual(7, reads[0])
+        del reads[:]
+        RecordReader(Stream(data)).read_record()
+        self.assertEqual([RecordReader.CHUNK_SIZE], reads)
+
+    def test_unpack_raw(self):
+        frames = self.get_test_data()
+        records = list(unpack_string("".join(frames), raw=True))
+        self.assertEqual(len(frames), len(records))
+        for i, (r, total_bytes) in enumerate(records):
+            self.assertIsNone(r.message)
+            self.assertEqual(frames[i], r.raw)
+
+    def test_skip_garbage(self):
+        frames = self.get_test_data()
+        data = "garbage" + frames[0] + "more garbage" + "".join(frames[1:])
+        records = self.unpack(data, 5, try_snappy=False)
+        self.assertEqual(len(frames), len(records))
+        self.assertEqual(len(data), records[-1][1])
+        with self.assertRaises(ValueError):
+            self.unpack(data, 5, strict=True)
+
+    def test_truncated(self):
+        frames = self.get_test_data()
+        data = "".join(frames)
+        records = self.unpack(data[0:-10], 7, try_snappy=False)
+        self.assertEqual(len(frames) - 1, len(records))
+
+    def test_bad_unit_separator(self):
+        frames = self.get_test_data()
+        bad = frames[0][0:-len(frames[0]) + 3 + ord(frames[0][1]) - 1] + "X"
+        records = self.unpack(bad + frames[1], 1024, try_snappy=False)
+        self.assertEqual(2, len(records))
+        self.assertIsNotNone(records[0][0].error)
+        self.assertEqual(self.get_test_payloads()[1], records[1][0].message.payload)
+
+    def test_backtrack(self):
+        frames = self.get_test_data()
+        # A header that claims to be longer than it is can't be parsed.
+        corrupt = chr(0x1e) + chr(10) + "\xff" * 10 + chr(0x1f)
+        data = frames[0] + corrupt + "".join(frames[1:])
+        records = self.unpack(data, 3, try_snappy=False, backtrack=True)
+        self.assertEqual(self.get_test_payloads(),
+                         [r.message.payload for r, b in records])
+
+    def get_test_record(self):
+        message = message_pb2.Message()
+        message.payload = '{"application": {"channel": "release"}, ' \
+                          '"environment": {"build": {"version": "43.0"}}}'
+        for name, value in [("documentId", "abc"),
+                            ("payload.slowSQL", '{"mainThread": {"q": [1, 2]}}'),
+                            ("payload.histograms", '{"A": [1]}'),
+                            ("payload.info", '["x"]'),
+                            ("payload.count", "3")]:
+            field = message.fields.add()
+            field.name = name
+            field.value_string.append(value)
+        return heka_message.UnpackedRecord(None, None, message=message)
+
+    def test_parse(self):
+        msg = heka_message_parser.parse_heka_record(self.get_test_record())
+        self.assertEqual("abc", msg["meta"]["documentId"])
+        self.assertEqual("release", msg["application"]["channel"])
+        self.assertEqual({"mainThread": {"q": [1, 2]}}, msg["payload"]["slowSQL"])
+        self.assertEqual(["x"], msg["payload"]["info"])
+        self.assertEqual(3, msg["payload"]["count"])
+        # Lazy values must not share their contents.
+        self.assertEqual({"A": [1]}, msg["payload"]["histograms"])
+        self.assertEqual(["mainThread"], msg["payload"]["slowSQL"].keys())
+
+    def test_parse_projection(self):
+        record = self.get_test_record()
+        msg = heka_message_parser.parse_heka_record(record,
+                ["payload.slowSQL.mainThread", "application.channel"])
+        self.assertEqual(["application", "meta", "payload"], sorted(msg.keys()))
+        self.assertEqual(["slowSQL"], msg["payload"].keys())
+        self.assertEqual("release", msg["application"]["channel"])
+        self.assertEqual("abc", msg["meta"]["documentId"])
+
+        # The JSON payload isn't needed at all here.
+        record.message.payload = "not json"
+        msg = heka_message_parser.parse_heka_record(record,
+                heka_message_parser.Projection(["payload.slowSQL"]))
+        self.assertEqual(["meta", "payload"], sorted(msg.keys()))
+        self.assertEqual({"mainThread": {"q": [1, 2]}}, msg["payload"]["slowSQL"])
+
+    def map_job(self, script, record, projected):
+        # Job scripts aren't in packages, so load them by path.
+        job = imp.load_source(os.path.basename(script)[0:-3], script)
+        fields = None
+        if projected:
+            fields = heka_message_parser.Projection(job.heka_fields)
+        msg = heka_message_parser.parse_heka_record(record, fields)
+        context = Context()
+        saved = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            job.map(msg["meta"]["documentId"], msg, context)
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = saved
+        self.assertEqual("", printed)
+        return context.records
+
+    def test_parse_projection_missing(self):
+        # A ping without the projected fields maps as it does unprojected.
+        record = self.get_test_record()
+        for name, value in [("submissionDate", "20150101"),
+                            ("application.name", "Firefox"),
+                            ("application.version", "43.0")]:
+            field = record.message.fields.add()
+            field.name = name
+            field.value_string.append(value)
+        # Drop payload.slowSQL, but keep the other payload fields.
+        del record.message.fields[1]
+        msg = heka_message_parser.parse_heka_record(record,
+                ["payload.slowSQL", "application.channel"])
+        self.assertEqual({}, msg["payload"])
+
+        slowsql = self.map_job("mapreduce/slowsql/slowsql.py", record, True)
+        self.assertEqual(1, len(slowsql))
+        self.assertIn("ALL_PINGS", slowsql[0][0])
+        self.assertEqual(slowsql, self.map_job("mapreduce/slowsql/slowsql.py",
+                                               record, False))
+        self.assertEqual([], self.map_job(
+                "mapreduce/chromehangs/chromehangs.py", record, True))
+
+
+class Context:
+    def __init__(self):
+        self.records = []
+
+    def write(self, key, value):
+        self.records.append((key, value))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from telemetry.util.lru import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+    def test_evict_least_recently_used(self):
+        c = LRUCache(2)
+        c.put("a", 1)
+        c.put("b", 2)
+        self.assertEqual(1, c.get("a"))
+        c.put("c", 3)
+        self.assertNotIn("b", c)
+        self.assertEqual(1, c.get("a"))
+        self.assertEqual(3, c.get("c"))
+        self.assertEqual(2, len(c))
+
+    def test_replace(self):
+        c = LRUCache(2)
+        c.put("a", 1)
+        c.put("a", 2)
+        self.assertEqual(1, len(c))
+        self.assertEqual(2, c.get("a"))
+
+    def test_stats(self):
+        c = LRUCache(1)
+        self.assertIsNone(c.get("a"))
+        c.put("a", 1)
+        c.get("a")
+        c.put("b", 2)
+        self.assertEqual({"hits": 1, "misses": 1, "evictions": 1, "size": 1},
+                         c.get_stats())
+
+    def test_on_evict(self):
+        evicted = []
+        c = LRUCache(1, on_evict=lambda k, v: evicted.append((k, v)))
+        c.put("a", 1)
+        c.put("a", 2)
+        self.assertEqual([], evicted)
+        c.put("b", 3)
+        self.assertEqual([("a", 2)], evicted)
+        self.assertEqual(3, c.pop("b"))
+        self.assertEqual([], c.items())
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            LRUCache(0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,409 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import os
+import shutil
+import simplejson as json
+import threading
+import unittest
+import urlparse
+import uuid
+from xml.sax.saxutils import escape
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+from boto.s3.key import Key
+from telemetry.util.s3 import TransferManager, TransferPool, list_keys, \
+        etag_matches, multipart_md5
+
+MB = 1024 * 1024
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Just enough of S3 (path-style, in memory) for TransferManager."""
+    protocol_version = "HTTP/1.1"
+    # Set up by TestS3.setUp()
+    keys = None
+    uploads = None
+    requests = None
+    connections = None
+    # Return a wrong ETag for these (key, part number) uploads.
+    bad_parts = None
+    # Maximum number of names per listing response.
+    page_size = 1000
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.lock:
+            self.connections.append(self.client_address)
+
+    def parse(self):
+        url = urlparse.urlparse(self.path)
+        bucket, _, name = url.path.lstrip("/").partition("/")
+        query = urlparse.parse_qs(url.query, keep_blank_values=True)
+        with self.lock:
+            self.requests.append((self.command, urlparse.unquote(name),
+                                  query, self.headers.get("Range")))
+        return urlparse.unquote(name), query
+
+    def reply(self, code, body="", headers={}):
+        self.send_response(code)
+        for k, v in headers.iteritems():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        name, query = self.parse()
+        if name == "":
+            return self.list(query)
+        if name not in self.keys:
+            return self.reply(404, "<Error><Code>NoSuchKey</Code></Error>")
+        data, etag = self.keys[name]
+        if self.headers.get("If-Match", etag) != etag:
+            return self.reply(412, "<Error><Code>PreconditionFailed</Code></Error>")
+        headers = {"ETag": etag, "Last-Modified": "Wed, 01 Jan 2014 00:00:00 GMT"}
+        byte_range = self.headers.get("Range")
+        if byte_range is None:
+            return self.reply(200, data, headers)
+        start, end = [int(b) for b in byte_range.split("=")[1].split("-")]
+        headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(data))
+        self.reply(206, data[start:end + 1], headers)
+
+    def list(self, query):
+        prefix = query.get("prefix", [""])[0]
+        delimiter = query.get("delimiter", [""])[0]
+        marker = query.get("marker", [""])[0]
+        names = set()
+        for name in self.keys:
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                name = prefix + rest[0:rest.index(delimiter) + 1]
+            if name > marker:
+                names.add(name)
+        names = sorted(names)
+        page = names[0:self.page_size]
+        xml = ['<?xml version="1.0" encoding="UTF-8"?><ListBucketResult>'
+               '<IsTruncated>%s</IsTruncated>' % (
+                "true" if len(names) > len(page) else "false")]
+        if page:
+            xml.append("<NextMarker>%s</NextMarker>" % escape(page[-1]))
+        for name in page:
+            if name in self.keys:
+                data, etag = self.keys[name]
+                xml.append("<Contents><Key>%s</Key><Size>%d</Size>"
+                           "<ETag>%s</ETag></Contents>" % (escape(name),
+                            len(data), escape(etag)))
+            else:
+                xml.append("<CommonPrefixes><Prefix>%s</Prefix>"
+                           "</CommonPrefixes>" % escape(name))
+        xml.append("</ListBucketResult>")
+        self.reply(200, "".join(xml))
+
+    def do_PUT(self):
+        name, query = self.parse()
+        data = self.read_body()
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if "uploadId" in query:
+            part = int(query["partNumber"][0])
+            with self.lock:
+                self.uploads[query["uploadId"][0]][part] = data
+                if (name, part) in self.bad_parts:
+                    self.bad_parts.remove((name, part))
+                    etag = '"%s"' % ("0" * 32)
+        else:
+            self.keys[name] = (data, etag)
+        self.reply(200, "", {"ETag": etag})
+
+    def do_POST(self):
+        name, query = self.parse()
+        self.read_body()
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = {}
+            return self.reply(200, "<InitiateMultipartUploadResult><Key>%s"
+                              "</Key><UploadId>%s</UploadId>"
+                              "</InitiateMultipartUploadResult>" % (
+                              escape(name), upload_id))
+        parts = self.uploads.pop(query["uploadId"][0])
+        data = "".join([parts[p] for p in sorted(parts)])
+        etag = '"%s-%d"' % (hashlib.md5("".join([hashlib.md5(parts[p]).digest()
+                            for p in sorted(parts)])).hexdigest(), len(parts))
+        self.keys[name] = (data, etag)
+        self.reply(200, "<CompleteMultipartUploadResult><Key>%s</Key>"
+                   "<ETag>%s</ETag></CompleteMultipartUploadResult>" % (
+                   escape(name), escape(etag)))
+
+    def do_DELETE(self):
+        name, query = self.parse()
+        if "uploadId" in query:
+            self.uploads.pop(query["uploadId"][0], None)
+        else:
+            self.keys.pop(name, None)
+        self.reply(204)
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class TestS3(unittest.TestCase):
+    def setUp(self):
+        test_dir = self.get_test_dir()
+        assert not os.path.exists(test_dir)
+        os.makedirs(test_dir)
+        FakeS3Handler.keys = {}
+        FakeS3Handler.uploads = {}
+        FakeS3Handler.requests = []
+        FakeS3Handler.connections = []
+        FakeS3Handler.bad_parts = set()
+        FakeS3Handler.page_size = 1000
+        self.server = FakeS3Server(("localhost", 0), FakeS3Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.get_test_dir())
+
+    def get_test_dir(self):
+        return "/tmp/test_telemetry_s3"
+
+    def get_connection_args(self):
+        return {"host": "localhost", "port": self.server.server_address[1],
+                "is_secure": False, "calling_format": OrdinaryCallingFormat()}
+
+    def get_manager(self, **kwargs):
+        return TransferManager("bucket", "fake", "fake", part_size=MB,
+                multipart_threshold=2 * MB,
+                connection_args=self.get_connection_args(), **kwargs)
+
+    def get_data(self, size):
+        return "".join([chr(i % 251) for i in range(size)])
+
+    def put_key(self, name, data, part_size=None):
+        if part_size is None:
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+        else:
+            digests = [hashlib.md5(data[o:o + part_size]).digest()
+                       for o in range(0, len(data), part_size)]
+            etag = '"%s-%d"' % (hashlib.md5("".join(digests)).hexdigest(),
+                                len(digests))
+        FakeS3Handler.keys[name] = (data, etag)
+
+    def get_key(self, name):
+        key = Key(None, name)
+        key.size = len(FakeS3Handler.keys[name][0])
+        key.etag = FakeS3Handler.keys[name][1]
+        return key
+
+    def write_file(self, name, data):
+        filename = os.path.join(self.get_test_dir(), name)
+        with open(filename, "wb") as fout:
+            fout.write(data)
+        return filename
+
+    def read_file(self, filename):
+        with open(filename, "rb") as fin:
+            return fin.read()
+
+    def get_ranges(self):
+        return [r for c, n, q, r in FakeS3Handler.requests if r is not None]
+
+    def get_puts(self):
+        return [(n, q.get("partNumber", [None])[0])
+                for c, n, q, r in FakeS3Handler.requests if c == "PUT"]
+
+    def test_upload(self):
+        filename = self.write_file("small", "some data")
+        manager = self.get_manager()
+        err, size, sec = manager.upload(filename, "a/small")
+        self.assertIsNone(err)
+        self.assertEqual(9, size)
+        self.assertEqual("some data", FakeS3Handler.keys["a/small"][0])
+        self.assertEqual([("a/small", None)], self.get_puts())
+        manager.close()
+
+    def test_upload_multipart(self):
+        data = self.get_data(3 * MB + 100)
+        filename = self.write_file("big", data)
+        manager = self.get_manager()
+        self.assertIsNone(manager.upload(filename, "big")[0])
+        manager.close()
+        self.assertEqual(data, FakeS3Handler.keys["big"][0])
+        self.assertEqual(multipart_md5(filename, MB),
+                         FakeS3Handler.keys["big"][1].strip('"'))
+        self.assertEqual(["1", "2", "3", "4"],
+                         sorted([p for n, p in self.get_puts()]))
+        self.assertEqual({}, FakeS3Handler.uploads)
+
+    def test_upload_part_retry(self):
+        data = self.get_data(3 * MB)
+        filename = self.write_file("big", data)
+        # The second part comes back with the wrong checksum once.
+        FakeS3Handler.bad_parts.add(("big", 2))
+        manager = self.get_manager()
+        self.assertIsNone(manager.upload(filename, "big")[0])
+        manager.close()
+        self.assertEqual(data, FakeS3Handler.keys["big"][0])
+        # Only that part is sent again.
+        self.assertEqual(["1", "2", "2", "3"],
+                         sorted([p for n, p in self.get_puts()]))
+
+    def test_upload_only_new(self):
+        filename = self.write_file("small", "some data")
+        self.put_key("same", "some data")
+        self.put_key("different", "other data")
+        manager = self.get_manager()
+        self.assertEqual((None, 0), manager.upload(filename, "same",
+                                                   only_new=True)[0:2])
+        self.assertIsNotNone(manager.upload(filename, "different",
+                                            only_new=True)[0])
+        self.assertIsNone(manager.upload(filename, "new", only_new=True)[0])
+        manager.close()
+        self.assertEqual([("new", None)], self.get_puts())
+        self.assertEqual("other data", FakeS3Handler.keys["different"][0])
+
+    def test_list_keys(self):
+        for name in ["a/1", "a/2", "a/3", "a/b/4", "c/5", "c/6", "d/7"]:
+            self.put_key(name, name)
+        # Make the listings take several pages.
+        FakeS3Handler.page_size = 2
+        conn = S3Connection("fake", "fake", **self.get_connection_args())
+        bucket = conn.get_bucket("bucket", validate=False)
+        keys = list_keys(bucket, ["a/1", "a/3", "c/6", "c/missing", "e/8"])
+        self.assertEqual(["a/1", "a/3", "c/6"], sorted(keys.keys()))
+        self.assertEqual(FakeS3Handler.keys["c/6"][1], keys["c/6"].etag)
+        self.assertEqual(3, keys["c/6"].size)
+        # One listing per directory, each of which may take several pages.
+        lists = [q for c, n, q, r in FakeS3Handler.requests if n == ""]
+        self.assertEqual(["a/", "a/", "c/", "e/"],
+                         [q["prefix"][0] for q in lists])
+
+    def test_pool(self):
+        names = ["f%d" % i for i in range(12)]
+        for name in names[0:6]:
+            self.write_file(name, name * 1000)
+        for name in names[6:]:
+            self.put_key("remote/" + name, name * 1000)
+        pool = TransferPool("bucket", "fake", "fake", num_transfers=3,
+                            connection_args=self.get_connection_args())
+        for name in names[0:6]:
+            pool.put(os.path.join(self.get_test_dir(), name), "remote/" + name)
+        for name in names[6:]:
+            pool.get("remote/" + name, os.path.join(self.get_test_dir(), name))
+        pool.put(os.path.join(self.get_test_dir(), "missing"), "missing")
+        results = dict([(r[1], r) for r in pool.results()])
+        pool.close()
+        self.assertEqual(13, len(results))
+        self.assertIsNotNone(results["missing"][2])
+        for name in names:
+            local, remote, err, size, sec = results["remote/" + name]
+            self.assertIsNone(err)
+            self.assertEqual(len(name) * 1000, size)
+            self.assertEqual(name * 1000, self.read_file(local))
+            self.assertEqual(name * 1000, FakeS3Handler.keys[remote][0])
+        # Each slot keeps its connection.
+        self.assertTrue(len(FakeS3Handler.connections) <= 3)
+
+    def test_multipart_etag(self):
+        data = self.get_data(2 * MB + 12345)
+        filename = self.write_file("data", data)
+        digests = [hashlib.md5(data[o:o + MB]).digest()
+                   for o in range(0, len(data), MB)]
+        etag = "%s-3" % hashlib.md5("".join(digests)).hexdigest()
+        self.assertEqual(etag, multipart_md5(filename, MB))
+        self.assertTrue(etag_matches(filename, '"%s"' % etag))
+        # Any part size that gives the right number of parts will do.
+        self.put_key("other", data, part_size=2 * MB)
+        self.assertTrue(etag_matches(filename, self.get_key("other").etag))
+        self.assertTrue(etag_matches(filename, '"%s"' % hashlib.md5(data).hexdigest()))
+        self.assertFalse(etag_matches(filename, '"%s-2"' % ("0" * 32)))
+        self.assertFalse(etag_matches(filename, '"%s"' % ("0" * 32)))
+
+    def test_download_single(self):
+        self.put_key("a/b", "some data")
+        manager = self.get_manager()
+        target = os.path.join(self.get_test_dir(), "a", "b")
+        # The key from the listing isn't tied to this thread's connection.
+        err, size, sec = manager.download("a/b", target, self.get_key("a/b"))
+        self.assertIsNone(err)
+        self.assertEqual("some data", self.read_file(target))
+        # Files that are already there aren't fetched again.
+        FakeS3Handler.requests = []
+        self.assertIsNone(manager.download("a/b", target, self.get_key("a/b"))[0])
+        self.assertEqual([], FakeS3Handler.requests)
+        manager.close()
+
+    def test_download_resume(self):
+        data = self.get_data(5 * MB + 100)
+        self.put_key("big", data, part_size=MB)
+        key = self.get_key("big")
+        target = os.path.join(self.get_test_dir(), "big")
+        # A previous attempt got the first and third ranges.
+        with open(target + ".part", "wb") as fout:
+            fout.write(data[0:MB] + "\0" * MB + data[2 * MB:3 * MB])
+            fout.truncate(len(data))
+        with open(target + ".part.json", "w") as fout:
+            json.dump({"etag": key.etag, "size": key.size, "part_size": MB,
+                       "done": [0, 2 * MB]}, fout)
+        manager = self.get_manager()
+        self.assertIsNone(manager.download("big", target, key)[0])
+        manager.close()
+        self.assertEqual(data, self.read_file(target))
+        self.assertFalse(os.path.exists(target + ".part"))
+        self.assertFalse(os.path.exists(target + ".part.json"))
+        self.assertEqual(["bytes=%d-%d" % (o, min(o + MB, len(data)) - 1)
+                          for o in [MB, 3 * MB, 4 * MB, 5 * MB]],
+                         sorted(self.get_ranges()))
+
+    def test_download_changed(self):
+        old = self.get_data(3 * MB)
+        self.put_key("big", old, part_size=MB)
+        key = self.get_key("big")
+        target = os.path.join(self.get_test_dir(), "big")
+        with open(target + ".part", "wb") as fout:
+            fout.write(old)
+        with open(target + ".part.json", "w") as fout:
+            json.dump({"etag": key.etag, "size": key.size, "part_size": MB,
+                       "done": [0]}, fout)
+        # The key changes after it was listed.
+        new = "x" + old[1:]
+        self.put_key("big", new, part_size=MB)
+        manager = self.get_manager()
+        self.assertIsNone(manager.download("big", target, key)[0])
+        manager.close()
+        self.assertEqual(new, self.read_file(target))
+        # The stale ranges fail their If-Match, and the retry starts over
+        # (including the range that was already done).
+        ranges = self.get_ranges()
+        self.assertEqual(1, ranges.count("bytes=0-%d" % (MB - 1)))
+        self.assertEqual(2, ranges.count("bytes=%d-%d" % (MB, 2 * MB - 1)))
+        self.assertFalse(os.path.exists(target + ".part.json"))
+
+
+if __name__ == "__main__":
+    unittest.main()